@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Almacén de archivos direccionado por contenido
+Guarda PDFs generados, firmas y otros artefactos en disco bajo su hash SHA-256,
+en subdirectorios por prefijo (ab/cd/abcd...). Un mismo contenido se guarda una
+sola vez y la escritura es atómica (archivo temporal + os.replace).
+"""
+
+import os
+import hashlib
+import tempfile
+from typing import BinaryIO, Dict, Optional
+
+# Directorio raíz del almacén (configurable por variable de entorno)
+ALMACEN_ARCHIVOS_DIR = os.getenv('ALMACEN_ARCHIVOS_DIR', 'almacen_archivos')
+
+# Tipos MIME de las extensiones que se guardan
+TIPOS_MIME = {
+    '.pdf': 'application/pdf',
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.webp': 'image/webp',
+    '.xml': 'application/xml',
+    '.xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    '.csv': 'text/csv'
+}
+
+# Bytes por bloque al copiar un stream
+TAMANO_BLOQUE = 1024 * 1024
+
+class AlmacenArchivos:
+    """Almacén de archivos en disco con llave SHA-256 y deduplicación"""
+    
+    def __init__(self, raiz: str = ALMACEN_ARCHIVOS_DIR):
+        self.raiz = os.path.abspath(raiz)
+        os.makedirs(self.raiz, exist_ok=True)
+    
+    @staticmethod
+    def ruta_relativa(hash_hex: str, extension: str = '') -> str:
+        """Ruta relativa de un contenido: ab/cd/abcd...<extension>"""
+        return os.path.join(hash_hex[:2], hash_hex[2:4], hash_hex + extension)
+    
+    def guardar(self, datos: bytes, extension: str = '') -> Dict:
+        """
+        Guarda un contenido (si no existe ya)
+        
+        Args:
+            datos: Bytes del archivo
+            extension: Extensión con punto (ej: '.pdf')
+        
+        Returns:
+            {'hash': str, 'ruta': str (relativa a la raíz), 'tamano': int, 'nuevo': bool}
+        """
+        hash_hex = hashlib.sha256(datos).hexdigest()
+        ruta = self.ruta_relativa(hash_hex, extension.lower())
+        destino = os.path.join(self.raiz, ruta)
+        
+        nuevo = not os.path.exists(destino)
+        if nuevo:
+            directorio = os.path.dirname(destino)
+            os.makedirs(directorio, exist_ok=True)
+            
+            # Escribir a un temporal en el mismo directorio y renombrar: nunca queda un archivo a medias
+            descriptor, temporal = tempfile.mkstemp(dir=directorio, prefix='.tmp_')
+            try:
+                with os.fdopen(descriptor, 'wb') as f:
+                    f.write(datos)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temporal, destino)
+            except Exception:
+                if os.path.exists(temporal):
+                    os.unlink(temporal)
+                raise
+        
+        return {'hash': hash_hex, 'ruta': ruta, 'tamano': len(datos), 'nuevo': nuevo}
+    
+    def guardar_stream(self, stream: BinaryIO, extension: str = '') -> Dict:
+        """
+        Guarda un archivo leyéndolo por bloques (ej: un upload grande), calculando
+        el hash mientras se copia a un temporal. Mismo resultado que guardar().
+        """
+        os.makedirs(self.raiz, exist_ok=True)
+        hasher = hashlib.sha256()
+        tamano = 0
+        
+        descriptor, temporal = tempfile.mkstemp(dir=self.raiz, prefix='.tmp_')
+        try:
+            with os.fdopen(descriptor, 'wb') as f:
+                for bloque in iter(lambda: stream.read(TAMANO_BLOQUE), b''):
+                    hasher.update(bloque)
+                    f.write(bloque)
+                    tamano += len(bloque)
+                f.flush()
+                os.fsync(f.fileno())
+            
+            hash_hex = hasher.hexdigest()
+            ruta = self.ruta_relativa(hash_hex, extension.lower())
+            destino = os.path.join(self.raiz, ruta)
+            
+            nuevo = not os.path.exists(destino)
+            if nuevo:
+                os.makedirs(os.path.dirname(destino), exist_ok=True)
+                os.replace(temporal, destino)
+            else:
+                os.unlink(temporal)
+        except Exception:
+            if os.path.exists(temporal):
+                os.unlink(temporal)
+            raise
+        
+        return {'hash': hash_hex, 'ruta': ruta, 'tamano': tamano, 'nuevo': nuevo}
+    
+    def ruta_absoluta(self, ruta: str) -> Optional[str]:
+        """
+        Ruta absoluta de un archivo guardado, o None si no existe o la ruta
+        sale del almacén
+        """
+        if not ruta:
+            return None
+        destino = os.path.abspath(os.path.join(self.raiz, ruta))
+        if os.path.commonpath([self.raiz, destino]) != self.raiz or not os.path.isfile(destino):
+            return None
+        return destino
+    
+    @staticmethod
+    def hash_de_ruta(ruta: str) -> str:
+        """Hash SHA-256 de un archivo a partir de su ruta en el almacén (sirve como ETag)"""
+        return os.path.splitext(os.path.basename(ruta))[0]
+    
+    @staticmethod
+    def tipo_mime(ruta: str) -> str:
+        """Tipo MIME según la extensión"""
+        return TIPOS_MIME.get(os.path.splitext(ruta)[1].lower(), 'application/octet-stream')
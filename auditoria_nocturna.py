@@ -6,6 +6,7 @@ Ejecuta auditoría automática de cumplimiento legal cruzando consultas vs docum
 
 Uso:
     python auditoria_nocturna.py
+    python auditoria_nocturna.py --completa   # ignora la marca de agua y audita todo el historial
     
 O configurar como cron job para ejecutar diariamente:
     0 2 * * * /usr/bin/python3 /ruta/a/auditoria_nocturna.py
@@ -14,9 +15,136 @@ O configurar como cron job para ejecutar diariamente:
 import os
 import sys
 from datetime import datetime
+from typing import Dict
 from database import ConsultaDB, LegalDB
 
-def ejecutar_auditoria_nocturna():
+# Palabras en diagnóstico, tratamiento o transcripción que indican un procedimiento con consentimiento obligatorio
+PROCEDIMIENTOS_REQUIEREN_CONSENTIMIENTO = [
+    'cirugía', 'biopsia', 'endoscopia', 'colonoscopia', 
+    'operación', 'intervención', 'quirúrgico', 'anestesia',
+    'procedimiento invasivo', 'extracción', 'inyección'
+]
+
+# Consultas que se revisan juntas (una consulta de consentimientos y una de alertas por bloque)
+CONSULTAS_POR_BLOQUE = 500
+
+def requiere_consentimiento(consulta: Dict) -> bool:
+    """Indica si la consulta menciona un procedimiento que requiere consentimiento informado"""
+    texto = ' '.join(
+        (consulta.get(campo) or '').lower()
+        for campo in ('diagnostico', 'tratamiento', 'transcripcion')
+    )
+    return any(proc in texto for proc in PROCEDIMIENTOS_REQUIEREN_CONSENTIMIENTO)
+
+def auditar_consentimientos(db: ConsultaDB, legal_db: LegalDB, medico_id: str = 'default',
+                            completa: bool = False, verbose: bool = False) -> Dict:
+    """
+    Crea alertas de consentimiento faltante para las consultas nuevas o modificadas
+    desde la última auditoría (marca de agua en marcas_auditoria). Por bloque de
+    consultas se buscan solo sus consentimientos firmados y sus alertas activas, así
+    que el tiempo es proporcional a las consultas del día y no al historial.
+    
+    Args:
+        completa: Ignora la marca de agua y audita todas las consultas (ej: al
+            cambiar PROCEDIMIENTOS_REQUIEREN_CONSENTIMIENTO)
+    
+    Returns:
+        {'alertas_creadas', 'total_consultas_revisadas', 'consultas_con_consentimiento',
+         'desde_consulta_id', 'hasta_consulta_id'}
+    """
+    marca = {'ultimo_consulta_id': 0, 'ultimo_updated_at': ''} if completa else legal_db.obtener_marca_auditoria(medico_id)
+    ultimo_id = marca['ultimo_consulta_id']
+    ultimo_updated_at = marca['ultimo_updated_at']
+    
+    revisadas = 0
+    con_consentimiento = 0
+    alertas_creadas = 0
+    
+    def revisar_bloque(bloque):
+        """Crea las alertas faltantes de un bloque de consultas que requieren consentimiento"""
+        nonlocal con_consentimiento, alertas_creadas
+        ids = [c['id'] for c in bloque]
+        firmadas = legal_db.obtener_consultas_con_consentimiento(ids, medico_id=medico_id)
+        con_consentimiento += len(firmadas)
+        pendientes = [c for c in bloque if c['id'] not in firmadas]
+        if not pendientes:
+            return
+        
+        con_alerta = legal_db.obtener_entidades_con_alerta(
+            'consentimiento_faltante', medico_id=medico_id, entidad_ids=[c['id'] for c in pendientes]
+        )
+        for consulta in pendientes:
+            if consulta['id'] in con_alerta:
+                continue
+            diagnostico = (consulta.get('diagnostico') or '').lower()
+            legal_db.crear_alerta_legal({
+                'medico_id': medico_id,
+                'tipo_alerta': 'consentimiento_faltante',
+                'severidad': 'alta',
+                'titulo': f'Consentimiento faltante para consulta #{consulta["id"]}',
+                'descripcion': f'La consulta del {consulta.get("fecha_consulta", "")} requiere consentimiento informado pero no se encontró documento firmado. Procedimiento detectado: {diagnostico[:50]}...',
+                'entidad_tipo': 'consulta',
+                'entidad_id': consulta['id']
+            })
+            alertas_creadas += 1
+            if verbose:
+                print(f"[ALERTA] Creada alerta para consulta #{consulta['id']}")
+    
+    bloque = []
+    for consulta in db.iterar_consultas_modificadas(
+        medico_id=medico_id, desde_id=marca['ultimo_consulta_id'],
+        desde_updated_at=marca['ultimo_updated_at'], tamano_bloque=CONSULTAS_POR_BLOQUE
+    ):
+        revisadas += 1
+        ultimo_id = max(ultimo_id, consulta['id'])
+        ultimo_updated_at = max(ultimo_updated_at, consulta.get('updated_at') or '')
+        if requiere_consentimiento(consulta):
+            bloque.append(consulta)
+            if len(bloque) >= CONSULTAS_POR_BLOQUE:
+                revisar_bloque(bloque)
+                bloque = []
+    if bloque:
+        revisar_bloque(bloque)
+    
+    # La marca avanza solo al terminar: si la auditoría falla, la siguiente repite el tramo
+    legal_db.guardar_marca_auditoria(medico_id, ultimo_id, ultimo_updated_at)
+    
+    return {
+        'alertas_creadas': alertas_creadas,
+        'total_consultas_revisadas': revisadas,
+        'consultas_con_consentimiento': con_consentimiento,
+        'desde_consulta_id': marca['ultimo_consulta_id'],
+        'hasta_consulta_id': ultimo_id
+    }
+
+def auditar_contratos(legal_db: LegalDB, medico_id: str = 'default', dias: int = 30, verbose: bool = False) -> Dict:
+    """Crea alertas para los contratos que vencen en los próximos días y aún no tienen una activa"""
+    contratos_vencer = legal_db.obtener_contratos_por_vencer(medico_id=medico_id, dias=dias)
+    con_alerta = legal_db.obtener_entidades_con_alerta('contrato_vencido', medico_id=medico_id)
+    
+    alertas_creadas = 0
+    for contrato in contratos_vencer:
+        if contrato.get('id') in con_alerta:
+            continue
+        
+        dias_restantes = int(contrato.get('dias_restantes', 0))
+        severidad = 'media' if dias_restantes > 7 else 'alta'
+        legal_db.crear_alerta_legal({
+            'medico_id': medico_id,
+            'tipo_alerta': 'contrato_vencido',
+            'severidad': severidad,
+            'titulo': f'Contrato de {contrato.get("empleado_nombre")} vence en {dias_restantes} días',
+            'descripcion': f'El contrato de {contrato.get("empleado_nombre")} ({contrato.get("puesto", "N/A")}) vence en {dias_restantes} días. ¿Renovar o terminar?',
+            'entidad_tipo': 'contrato_staff',
+            'entidad_id': contrato.get('id')
+        })
+        alertas_creadas += 1
+        if verbose:
+            print(f"[ALERTA] Creada alerta para contrato de {contrato.get('empleado_nombre')}")
+    
+    return {'alertas_creadas': alertas_creadas, 'contratos_por_vencer': len(contratos_vencer)}
+
+def ejecutar_auditoria_nocturna(completa: bool = False):
     """Ejecuta la auditoría de cumplimiento legal"""
     print(f"[{datetime.now()}] Iniciando auditoría nocturna de cumplimiento legal...")
     
@@ -27,109 +155,22 @@ def ejecutar_auditoria_nocturna():
     medico_id = 'default'  # En producción, iterar sobre todos los médicos
     
     try:
-        # Obtener consultas recientes (últimos 30 días)
-        consultas = db.obtener_consultas(medico_id=medico_id, limite=1000)
-        print(f"[INFO] Revisando {len(consultas)} consultas...")
-        
-        # Obtener documentos firmados
-        documentos = legal_db.obtener_documentos_firmados(medico_id=medico_id, limite=1000)
-        print(f"[INFO] Encontrados {len(documentos)} documentos firmados...")
-        
-        # Crear mapa de consultas con consentimiento
-        consultas_con_consentimiento = set()
-        for doc in documentos:
-            if doc.get('consulta_id') and doc.get('tipo_documento') == 'consentimiento_informado':
-                consultas_con_consentimiento.add(doc['consulta_id'])
-        
-        print(f"[INFO] {len(consultas_con_consentimiento)} consultas tienen consentimiento firmado")
-        
-        # Identificar consultas sin consentimiento
-        alertas_creadas = 0
-        procedimientos_requieren_consentimiento = [
-            'cirugía', 'biopsia', 'endoscopia', 'colonoscopia', 
-            'operación', 'intervención', 'quirúrgico', 'anestesia',
-            'procedimiento invasivo', 'extracción', 'inyección'
-        ]
-        
-        for consulta in consultas:
-            consulta_id = consulta.get('id')
-            diagnostico = consulta.get('diagnostico', '').lower()
-            tratamiento = consulta.get('tratamiento', '').lower()
-            transcripcion = consulta.get('transcripcion', '').lower()
-            
-            # Verificar si requiere consentimiento
-            requiere_consentimiento = any(
-                proc in diagnostico or proc in tratamiento or proc in transcripcion 
-                for proc in procedimientos_requieren_consentimiento
-            )
-            
-            if requiere_consentimiento and consulta_id not in consultas_con_consentimiento:
-                # Verificar si ya existe una alerta para esta consulta
-                alertas_existentes = legal_db.obtener_alertas_legales(
-                    medico_id=medico_id, 
-                    estado='activa', 
-                    limite=1000
-                )
-                ya_existe = any(
-                    a.get('entidad_id') == consulta_id and a.get('estado') == 'activa' 
-                    for a in alertas_existentes
-                )
-                
-                if not ya_existe:
-                    legal_db.crear_alerta_legal({
-                        'medico_id': medico_id,
-                        'tipo_alerta': 'consentimiento_faltante',
-                        'severidad': 'alta',
-                        'titulo': f'Consentimiento faltante para consulta #{consulta_id}',
-                        'descripcion': f'La consulta del {consulta.get("fecha_consulta", "")} requiere consentimiento informado pero no se encontró documento firmado. Procedimiento detectado: {diagnostico[:50]}...',
-                        'entidad_tipo': 'consulta',
-                        'entidad_id': consulta_id
-                    })
-                    alertas_creadas += 1
-                    print(f"[ALERTA] Creada alerta para consulta #{consulta_id}")
+        consentimientos = auditar_consentimientos(db, legal_db, medico_id=medico_id, completa=completa, verbose=True)
+        print(f"[INFO] Consultas nuevas o modificadas desde la consulta #{consentimientos['desde_consulta_id']}: {consentimientos['total_consultas_revisadas']}")
         
-        # Verificar contratos por vencer
-        contratos_vencer = legal_db.obtener_contratos_por_vencer(medico_id=medico_id, dias=30)
-        for contrato in contratos_vencer:
-            dias_restantes = int(contrato.get('dias_restantes', 0))
-            
-            # Verificar si ya existe alerta
-            alertas_existentes = legal_db.obtener_alertas_legales(
-                medico_id=medico_id, 
-                estado='activa', 
-                limite=1000
-            )
-            ya_existe = any(
-                a.get('entidad_id') == contrato.get('id') and 
-                a.get('tipo_alerta') == 'contrato_vencido'
-                for a in alertas_existentes
-            )
-            
-            if not ya_existe:
-                severidad = 'media' if dias_restantes > 7 else 'alta'
-                legal_db.crear_alerta_legal({
-                    'medico_id': medico_id,
-                    'tipo_alerta': 'contrato_vencido',
-                    'severidad': severidad,
-                    'titulo': f'Contrato de {contrato.get("empleado_nombre")} vence en {dias_restantes} días',
-                    'descripcion': f'El contrato de {contrato.get("empleado_nombre")} ({contrato.get("puesto", "N/A")}) vence en {dias_restantes} días. ¿Renovar o terminar?',
-                    'entidad_tipo': 'contrato_staff',
-                    'entidad_id': contrato.get('id')
-                })
-                print(f"[ALERTA] Creada alerta para contrato de {contrato.get('empleado_nombre')}")
+        contratos = auditar_contratos(legal_db, medico_id=medico_id, dias=30, verbose=True)
         
         print(f"[{datetime.now()}] ✅ Auditoría completada.")
-        print(f"[RESUMEN] Alertas creadas: {alertas_creadas}")
-        print(f"[RESUMEN] Contratos por vencer: {len(contratos_vencer)}")
-        print(f"[RESUMEN] Consultas revisadas: {len(consultas)}")
-        print(f"[RESUMEN] Consultas con consentimiento: {len(consultas_con_consentimiento)}")
+        print(f"[RESUMEN] Alertas creadas: {consentimientos['alertas_creadas']}")
+        print(f"[RESUMEN] Contratos por vencer: {contratos['contratos_por_vencer']}")
+        print(f"[RESUMEN] Consultas revisadas: {consentimientos['total_consultas_revisadas']}")
+        print(f"[RESUMEN] Consultas con consentimiento: {consentimientos['consultas_con_consentimiento']}")
         
         return {
             'success': True,
-            'alertas_creadas': alertas_creadas,
-            'total_consultas_revisadas': len(consultas),
-            'consultas_con_consentimiento': len(consultas_con_consentimiento),
-            'contratos_por_vencer': len(contratos_vencer)
+            **consentimientos,
+            'alertas_contratos': contratos['alertas_creadas'],
+            'contratos_por_vencer': contratos['contratos_por_vencer']
         }
         
     except Exception as e:
@@ -142,6 +183,6 @@ def ejecutar_auditoria_nocturna():
         }
 
 if __name__ == '__main__':
-    resultado = ejecutar_auditoria_nocturna()
+    resultado = ejecutar_auditoria_nocturna(completa='--completa' in sys.argv)
     sys.exit(0 if resultado.get('success') else 1)
 
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark: detección de aseguradora, tipo de documento, plan, vigencia y
+datos del plan en el texto de un tabulador grande. Compara la implementación
+anterior (una búsqueda con `in` por palabra clave sobre el texto en minúsculas
+por función, y regex con re.IGNORECASE) contra el escáner de una sola pasada
+de seguro_pdf.
+
+Uso:
+    python bench_escaner_pdf.py [num_paginas] [repeticiones]
+"""
+
+import random
+import re
+import sys
+import time
+
+from seguro_pdf import (
+    DETECTORES_ASEGURADORA,
+    KEYWORDS_TIPO_DOCUMENTO,
+    PLANES_COMUNES,
+    KEYWORDS_PLAN,
+    escanear_senales_pdf,
+    detectar_aseguradora_del_texto,
+    detectar_tipo_documento,
+    extraer_plan_del_texto,
+    extraer_fecha_vigencia,
+    extraer_datos_plan_del_texto
+)
+
+# Patrones de extraer_fecha_vigencia / extraer_datos_plan_del_texto, como se buscaban antes
+PATRONES_ANTERIORES = [
+    r'vigencia[:\s]+(\d{1,2})[\/\-](\d{1,2})[\/\-](\d{4})',
+    r'vigente[:\s]+(\d{1,2})[\/\-](\d{1,2})[\/\-](\d{4})',
+    r'válido[:\s]+(\d{1,2})[\/\-](\d{1,2})[\/\-](\d{4})',
+    r'año[:\s]+(\d{4})',
+    r'(\d{4})[:\s]+vigencia',
+    r'deducible[^$\d\n]{0,60}\$\s?(\d{1,3}(?:,\d{3})+|\d{4,})(?:\.\d{2})?',
+    r'coaseguro[^%\d\n]{0,60}(\d{1,2}(?:\.\d+)?)\s?%',
+    r'hospitales (?:en convenio|de la red|en red)[:\s]+([^\n]{5,200})'
+]
+
+PALABRAS = (
+    'consulta cirugía apendicectomía laparoscópica colecistectomía hernioplastia '
+    'inguinal artroscopia rodilla ayudante anestesia general revisión urgencias '
+    'biopsia endoscopia resección tumor hospitalización'
+).split()
+
+def generar_tabulador(num_paginas: int, renglones_por_pagina: int = 45) -> str:
+    """Texto con el formato de extraer_texto_pdf (renglones código / descripción / monto)"""
+    random.seed(42)
+    paginas = []
+    for i in range(num_paginas):
+        renglones = [
+            f"{random.randint(10000, 99999)} {' '.join(random.choices(PALABRAS, k=5)).capitalize()} "
+            f"${random.randint(1, 99)},{random.randint(100, 999)}.00"
+            for _ in range(renglones_por_pagina)
+        ]
+        paginas.append(f"--- PÁGINA {i + 1} ---\n" + '\n'.join(renglones) + '\n')
+    
+    # Encabezado con la aseguradora y el plan en la última página (peor caso para `in`)
+    paginas.append("GRUPO NACIONAL PROVINCIAL - TABULADOR DE HONORARIOS MÉDICOS - LÍNEA AZUL PREMIUM\n")
+    return '\n'.join(paginas)
+
+def detectar_anterior(texto: str):
+    """Implementación anterior: cada función baja a minúsculas y recorre sus palabras clave"""
+    texto_lower = texto.lower()
+    aseguradora = None
+    for nombre, palabras in DETECTORES_ASEGURADORA.items():
+        if any(palabra in texto_lower for palabra in palabras):
+            aseguradora = nombre
+            break
+    
+    texto_lower = texto.lower()
+    conteos = {
+        tipo: sum(1 for kw in palabras if kw in texto_lower)
+        for tipo, palabras in KEYWORDS_TIPO_DOCUMENTO.items()
+    }
+    tipo = 'tabulador' if conteos['tabulador'] > conteos['condiciones_generales'] else 'condiciones_generales'
+    
+    texto_lower = texto.lower()
+    plan = next((p.title() for p in PLANES_COMUNES if p in texto_lower), None)
+    if plan is None:
+        for keyword in KEYWORDS_PLAN:
+            if texto_lower.find(keyword) != -1:
+                break
+    
+    return aseguradora, tipo, plan
+
+def analizar_anterior(texto: str):
+    """Análisis completo anterior: detección con `in` + regex con re.IGNORECASE"""
+    detectar_anterior(texto)
+    for patron in PATRONES_ANTERIORES:
+        re.search(patron, texto, re.IGNORECASE)
+
+def analizar_actual(texto: str):
+    """Análisis completo actual (lo que hace procesar_tabulador_pdf con el texto)"""
+    detectar_una_pasada(texto)
+    extraer_datos_plan_del_texto(texto)
+    extraer_fecha_vigencia(texto)
+
+def detectar_una_pasada(texto: str):
+    """Implementación actual: un escaneo compartido por las tres funciones"""
+    senales = escanear_senales_pdf(texto)
+    return (
+        detectar_aseguradora_del_texto(texto, senales),
+        detectar_tipo_documento(texto, senales),
+        extraer_plan_del_texto(texto, senales)
+    )
+
+def medir(funcion, texto: str, repeticiones: int) -> float:
+    """Mejor tiempo (ms) de varias repeticiones"""
+    mejor = float('inf')
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion(texto)
+        mejor = min(mejor, time.perf_counter() - inicio)
+    return mejor * 1000
+
+if __name__ == '__main__':
+    num_paginas = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    repeticiones = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    
+    texto = generar_tabulador(num_paginas)
+    assert detectar_anterior(texto) == detectar_una_pasada(texto)
+    
+    print(f"Tabulador sintético: {num_paginas} páginas, {len(texto) / 1e6:.2f} MB")
+    for titulo, anterior, actual in [
+        ("Aseguradora / tipo / plan", detectar_anterior, detectar_una_pasada),
+        ("Análisis completo del texto", analizar_anterior, analizar_actual)
+    ]:
+        tiempo_anterior = medir(anterior, texto, repeticiones)
+        tiempo_actual = medir(actual, texto, repeticiones)
+        print(f"{titulo}:")
+        print(f"  Anterior:   {tiempo_anterior:8.1f} ms")
+        print(f"  Una pasada: {tiempo_actual:8.1f} ms")
+        print(f"  Relación:   {tiempo_anterior / tiempo_actual:.2f}x")
+    
+    senales = escanear_senales_pdf(texto)
+    print("Señales encontradas (conteo):")
+    for categoria, valores in senales.items():
+        resumen = ', '.join(f"{valor}={datos['conteo']}" for valor, datos in valores.items())
+        print(f"  {categoria}: {resumen}")
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark: informes médicos PDF por segundo por núcleo, construyendo estilos y
+flowables fijos en cada informe (comportamiento anterior) contra la plantilla
+en caché por aseguradora de seguro_informe.
+
+Uso:
+    python bench_informe_seguro.py [num_informes]
+"""
+
+import sys
+import time
+
+from seguro_informe import PlantillaInforme, construir_informe, generar_informe_medico
+
+ASEGURADORAS = ['GNP', 'AXA', 'Seguros Monterrey', 'MetLife']
+
+DATOS_CONSULTA = {
+    'diagnostico': 'Apendicitis aguda',
+    'codigo_cie10': 'K35.8',
+    'procedimiento': 'Apendicectomía laparoscópica',
+    'codigo_cpt': '44970',
+    'soap_subjetivo': 'Dolor abdominal en fosa iliaca derecha de 12 horas de evolución, con náusea y fiebre.',
+    'soap_objetivo': 'Rebote positivo, McBurney positivo, leucocitosis 15,000.',
+    'soap_analisis': 'Cuadro compatible con apendicitis aguda no complicada.',
+    'soap_plan': 'Apendicectomía laparoscópica urgente.',
+    'tratamiento': 'Ceftriaxona 1 g IV cada 24 h, metronidazol 500 mg IV cada 8 h, analgesia.'
+}
+DATOS_PACIENTE = {'nombre': 'Juan Pérez López', 'edad': '34', 'sexo': 'M'}
+DATOS_SEGURO = {'aseguradora': 'GNP', 'numero_poliza': '1234567', 'plan_nombre': 'Línea Azul'}
+
+def sin_cache(tipo_aseguradora: str):
+    """Comportamiento anterior: estilos y flowables fijos nuevos en cada informe"""
+    plantilla = PlantillaInforme(tipo_aseguradora)
+    return construir_informe(plantilla, DATOS_CONSULTA, DATOS_PACIENTE, DATOS_SEGURO)
+
+def con_cache(tipo_aseguradora: str):
+    """Comportamiento actual: plantilla en caché por aseguradora"""
+    return generar_informe_medico(DATOS_CONSULTA, DATOS_PACIENTE, DATOS_SEGURO, tipo_aseguradora)
+
+def informes_por_segundo(funcion, num_informes: int) -> float:
+    """Informes por segundo en un solo proceso (un núcleo)"""
+    for tipo in ASEGURADORAS:
+        funcion(tipo)  # calentar
+    inicio = time.perf_counter()
+    for i in range(num_informes):
+        funcion(ASEGURADORAS[i % len(ASEGURADORAS)])
+    return num_informes / (time.perf_counter() - inicio)
+
+if __name__ == '__main__':
+    num_informes = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    
+    antes = informes_por_segundo(sin_cache, num_informes)
+    despues = informes_por_segundo(con_cache, num_informes)
+    print(f"Informes por segundo por núcleo ({num_informes} informes):")
+    print(f"  Sin caché de plantilla: {antes:7.1f}")
+    print(f"  Con caché de plantilla: {despues:7.1f}")
+    print(f"  Mejora: {despues / antes:.2f}x")
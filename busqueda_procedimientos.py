@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+Búsqueda difusa de procedimientos médicos con índice de trigramas
+Compara nombres de procedimientos sin importar acentos, mayúsculas ni palabras vacías
+(ej: "apendicectomia laparoscopica" vs. "Apendicectomía Laparoscópica")
+"""
+
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Optional, List, Tuple
+
+# Palabras vacías en español que no aportan al nombre del procedimiento
+STOP_WORDS = {
+    'a', 'al', 'con', 'de', 'del', 'e', 'el', 'en', 'la', 'las', 'lo', 'los',
+    'o', 'para', 'por', 'sin', 'su', 'sus', 'u', 'un', 'una', 'uno', 'y'
+}
+
+# Similitud mínima para considerar un candidato
+UMBRAL_SIMILITUD = 0.3
+
+# Número máximo de índices de tabuladores en memoria
+MAX_INDICES_TABULADOR = 32
+
+# Posiciones que se guardan por señal en el escáner de palabras clave
+MAX_POSICIONES_SENAL = 20
+
+def plegar_acentos(texto: str) -> str:
+    """Convierte a minúsculas y elimina acentos/diacríticos"""
+    if not texto:
+        return ''
+    texto = unicodedata.normalize('NFKD', texto.lower())
+    return ''.join(c for c in texto if not unicodedata.combining(c))
+
+def normalizar_nombre(texto: str) -> str:
+    """
+    Normaliza un nombre para compararlo exacto: sin acentos, en minúsculas y sin
+    puntuación, pero con todas sus palabras ("con" / "sin" reconstrucción son
+    procedimientos distintos)
+    """
+    return ' '.join(re.sub(r'[^a-z0-9]+', ' ', plegar_acentos(texto)).split())
+
+def normalizar_texto(texto: str) -> str:
+    """
+    Normaliza un texto para búsqueda: sin acentos, en minúsculas,
+    sin puntuación y sin palabras vacías. Solo para ordenar por similitud;
+    para comparar nombres exactos usar normalizar_nombre.
+    """
+    return ' '.join(p for p in normalizar_nombre(texto).split() if p not in STOP_WORDS)
+
+def trigramas(texto: str) -> set:
+    """
+    Calcula el conjunto de trigramas de un texto normalizado.
+    Cada palabra se rellena con espacios (estilo pg_trgm) para dar peso
+    al inicio y al final de la palabra.
+    """
+    resultado = set()
+    for palabra in texto.split():
+        relleno = f"  {palabra} "
+        for i in range(len(relleno) - 2):
+            resultado.add(relleno[i:i + 3])
+    return resultado
+
+class IndiceTrigramas:
+    """Índice invertido de trigramas para búsqueda difusa de textos cortos"""
+    
+    def __init__(self):
+        self._entradas: Dict[int, Dict] = {}
+        self._invertido: Dict[str, set] = {}
+    
+    def __len__(self):
+        return len(self._entradas)
+    
+    def agregar(self, clave, texto: str, datos: Dict = None):
+        """Agrega un texto al índice bajo una clave (ej: ID de plantilla)"""
+        normalizado = normalizar_texto(texto)
+        tri = trigramas(normalizado)
+        if not tri:
+            return
+        
+        self._entradas[clave] = {
+            'texto': texto,
+            'normalizado': normalizado,
+            'num_trigramas': len(tri),
+            'datos': datos or {}
+        }
+        for t in tri:
+            self._invertido.setdefault(t, set()).add(clave)
+    
+    def buscar(self, consulta: str, limite: int = 5, umbral: float = UMBRAL_SIMILITUD) -> List[Dict]:
+        """
+        Busca los textos más parecidos a la consulta
+        
+        Returns:
+            Lista ordenada de candidatos:
+            [{'clave', 'texto', 'similitud', 'datos'}, ...]
+        """
+        tri_consulta = trigramas(normalizar_texto(consulta))
+        if not tri_consulta:
+            return []
+        
+        # Contar trigramas compartidos usando el índice invertido
+        compartidos: Dict = {}
+        for t in tri_consulta:
+            for clave in self._invertido.get(t, ()):
+                compartidos[clave] = compartidos.get(clave, 0) + 1
+        
+        candidatos = []
+        for clave, comunes in compartidos.items():
+            entrada = self._entradas[clave]
+            # Similitud de Jaccard entre conjuntos de trigramas
+            similitud = comunes / (len(tri_consulta) + entrada['num_trigramas'] - comunes)
+            if similitud >= umbral:
+                candidatos.append({
+                    'clave': clave,
+                    'texto': entrada['texto'],
+                    'similitud': round(similitud, 3),
+                    'datos': entrada['datos']
+                })
+        
+        candidatos.sort(key=lambda c: c['similitud'], reverse=True)
+        return candidatos[:limite]
+
+def _regex_trie(palabras: List[str]) -> str:
+    """
+    Construye una expresión regular en forma de trie (prefijos compartidos) que
+    reconoce cualquiera de las palabras, prefiriendo la más larga. Con una sola
+    alternativa por carácter el motor de regex decide la rama sin retroceder.
+    """
+    trie: Dict = {}
+    for palabra in palabras:
+        nodo = trie
+        for c in palabra:
+            nodo = nodo.setdefault(c, {})
+        nodo[''] = {}
+    
+    def construir(nodo: Dict) -> str:
+        ramas = [re.escape(c) + construir(hijo) for c, hijo in sorted(nodo.items()) if c != '']
+        if not ramas:
+            return ''
+        patron = ramas[0] if len(ramas) == 1 else '(?:' + '|'.join(ramas) + ')'
+        return f'(?:{patron})?' if '' in nodo else patron
+    
+    return construir(trie)
+
+class EscanerPalabrasClave:
+    """
+    Busca muchas palabras clave en una sola pasada sobre el texto (sin importar
+    mayúsculas) y agrupa los resultados por señal.
+    
+    Cada palabra clave pertenece a una o más señales (categoría, valor), ej:
+    ('aseguradora', 'GNP', 'grupo nacional provincial').
+    
+    Las palabras de un solo carácter (ej: '$', que aparece en casi todos los
+    renglones de un tabulador) se cuentan con str.count fuera del patrón: dentro
+    de él cada aparición sería un match que procesar en Python.
+    """
+    
+    def __init__(self, senales: List[Tuple[str, str, str]]):
+        self._senales_por_palabra: Dict[str, List[Tuple[str, str]]] = {}
+        for categoria, valor, palabra in senales:
+            self._senales_por_palabra.setdefault(palabra.lower(), []).append((categoria, valor))
+        
+        self._caracteres = [palabra for palabra in self._senales_por_palabra if len(palabra) == 1]
+        palabras = [palabra for palabra in self._senales_por_palabra if len(palabra) > 1]
+        # Palabras contenidas en otras: al encontrar la larga también cuentan las cortas
+        # (ej: 'seguros monterrey' también es una aparición de 'monterrey')
+        self._apariciones = {
+            palabra: [(palabra, 0)] + [
+                (otra, palabra.find(otra)) for otra in palabras if otra != palabra and otra in palabra
+            ]
+            for palabra in palabras
+        }
+        self._patron = re.compile(_regex_trie(palabras)) if palabras else None
+    
+    def escanear(self, texto: str) -> Dict:
+        """
+        Recorre el texto una vez y cuenta las apariciones de cada señal
+        
+        Returns:
+            {
+                'palabras': {palabra: conteo},
+                'senales': {categoria: {valor: {
+                    'conteo': int,
+                    'palabras_distintas': int,
+                    'posiciones': [int, ...]  # primeras MAX_POSICIONES_SENAL
+                }}}
+            }
+            Las posiciones son índices en el texto.
+        """
+        conteos: Dict[str, int] = dict.fromkeys(self._apariciones, 0)
+        primeras: Dict[str, List[int]] = {palabra: [] for palabra in self._apariciones}
+        apariciones = self._apariciones
+        texto = (texto or '').lower()
+        
+        if self._patron is not None:
+            for match in self._patron.finditer(texto):
+                inicio = match.start()
+                for encontrada, desplazamiento in apariciones[match.group()]:
+                    conteos[encontrada] += 1
+                    if conteos[encontrada] <= MAX_POSICIONES_SENAL:
+                        primeras[encontrada].append(inicio + desplazamiento)
+        
+        for caracter in self._caracteres:
+            conteos[caracter] = texto.count(caracter)
+            primeras[caracter] = []
+            posicion = texto.find(caracter)
+            while posicion != -1 and len(primeras[caracter]) < MAX_POSICIONES_SENAL:
+                primeras[caracter].append(posicion)
+                posicion = texto.find(caracter, posicion + 1)
+        
+        conteos = {palabra: conteo for palabra, conteo in conteos.items() if conteo}
+        
+        senales: Dict[str, Dict[str, Dict]] = {}
+        for palabra, conteo in conteos.items():
+            for categoria, valor in self._senales_por_palabra[palabra]:
+                senal = senales.setdefault(categoria, {}).setdefault(
+                    valor, {'conteo': 0, 'palabras_distintas': 0, 'posiciones': []}
+                )
+                senal['conteo'] += conteo
+                senal['palabras_distintas'] += 1
+                senal['posiciones'] = sorted(senal['posiciones'] + primeras[palabra])[:MAX_POSICIONES_SENAL]
+        
+        return {'palabras': conteos, 'senales': senales}
+
+def _parsear_monto(texto_monto: str) -> Optional[float]:
+    """Convierte un monto como '$12,500.00' a float"""
+    try:
+        return float(texto_monto.replace('$', '').replace(',', '').replace(' ', ''))
+    except ValueError:
+        return None
+
+def extraer_partidas_tabulador(texto: str) -> List[Dict]:
+    """
+    Extrae las partidas (renglones con procedimiento y monto) del texto de un tabulador
+    
+    Args:
+        texto: Texto extraído del PDF del tabulador
+    
+    Returns:
+        Lista de partidas:
+        [{'linea': str, 'codigo': str o None, 'descripcion': str, 'monto': float o None}, ...]
+    """
+    patron_codigo = re.compile(r'^\s*(\d{5}|[A-Z]\d{4})\b')
+    patron_monto = re.compile(r'\$?\s?(\d{1,3}(?:,\d{3})+(?:\.\d{2})?|\d+\.\d{2})\s*$')
+    
+    partidas = []
+    for linea in (texto or '').splitlines():
+        linea = linea.strip()
+        if not linea or linea.startswith('--- PÁGINA'):
+            continue
+        
+        match_monto = patron_monto.search(linea)
+        match_codigo = patron_codigo.match(linea)
+        
+        descripcion = linea
+        if match_monto:
+            descripcion = descripcion[:match_monto.start()]
+        if match_codigo:
+            descripcion = descripcion[match_codigo.end():]
+        descripcion = descripcion.strip(' .:-\t$')
+        
+        # Solo renglones con texto y algún dato tabular (código o monto)
+        if not re.search(r'[A-Za-zÁÉÍÓÚáéíóúÑñ]{3,}', descripcion):
+            continue
+        if not (match_monto or match_codigo):
+            continue
+        
+        partidas.append({
+            'linea': linea,
+            'codigo': match_codigo.group(1) if match_codigo else None,
+            'descripcion': descripcion,
+            'monto': _parsear_monto(match_monto.group(1)) if match_monto else None
+        })
+    
+    return partidas
+
+# Caché de índices por tabulador {tabulador_id: (partidas, índice)}
+# El texto de un tabulador no cambia para un mismo ID, así que no requiere invalidación
+_indices_tabulador: "OrderedDict[int, tuple]" = OrderedDict()
+_indices_lock = threading.Lock()
+
+def obtener_indice_tabulador(tabulador_id: int, contenido_texto: str) -> tuple:
+    """
+    Obtiene (partidas, índice de trigramas) de un tabulador, construyéndolo
+    la primera vez y manteniéndolo en una caché LRU en memoria
+    """
+    with _indices_lock:
+        if tabulador_id in _indices_tabulador:
+            _indices_tabulador.move_to_end(tabulador_id)
+            return _indices_tabulador[tabulador_id]
+    
+    partidas = extraer_partidas_tabulador(contenido_texto)
+    indice = IndiceTrigramas()
+    for i, partida in enumerate(partidas):
+        indice.agregar(i, partida['descripcion'], partida)
+    
+    with _indices_lock:
+        _indices_tabulador[tabulador_id] = (partidas, indice)
+        while len(_indices_tabulador) > MAX_INDICES_TABULADOR:
+            _indices_tabulador.popitem(last=False)
+    
+    return partidas, indice
+
+def buscar_partidas_tabulador(
+    tabulador_id: int,
+    contenido_texto: str,
+    procedimiento: str,
+    codigo_cpt: str = None,
+    limite: int = 5
+) -> List[Dict]:
+    """
+    Busca las partidas del tabulador más parecidas a un procedimiento.
+    Si se proporciona código CPT y aparece en el tabulador, esa partida va primero
+    con similitud 1.0.
+    
+    Returns:
+        Lista ordenada de candidatos con 'similitud', 'exacta' (mismo código CPT o
+        mismo nombre con normalizar_nombre) y los datos de la partida. Una similitud alta no
+        basta para usar una partida: "hernioplastia inguinal bilateral" y
+        "unilateral" se parecen más de 0.8.
+    """
+    partidas, indice = obtener_indice_tabulador(tabulador_id, contenido_texto)
+    
+    candidatos = []
+    if codigo_cpt:
+        for partida in partidas:
+            if partida['codigo'] == codigo_cpt.strip():
+                candidatos.append({**partida, 'similitud': 1.0, 'exacta': True})
+                break
+    
+    procedimiento_normalizado = normalizar_nombre(procedimiento)
+    for candidato in indice.buscar(procedimiento, limite=limite):
+        partida = candidato['datos']
+        if candidatos and partida['linea'] == candidatos[0]['linea']:
+            continue
+        candidatos.append({
+            **partida,
+            'similitud': candidato['similitud'],
+            'exacta': normalizar_nombre(partida['descripcion']) == procedimiento_normalizado
+        })
+    
+    return candidatos[:limite]
@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+"""
+Lectura de CFDI (XML versión 3.3 y 4.0) para el módulo del contador
+Cada XML se recorre una sola vez con iterparse (sin armar el árbol completo) y
+se extraen UUID, RFC de emisor y receptor, totales, impuestos, forma y método
+de pago y fecha. Un ZIP con miles de XML se lee entrada por entrada y los XML
+se reparten en bloques entre un pool de procesos; los resultados se entregan
+en el orden del ZIP para que el avance de la importación se pueda reanudar.
+"""
+
+import io
+import os
+import re
+import zipfile
+import itertools
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Iterator, List, Optional, Tuple
+from xml.etree.ElementTree import iterparse, ParseError
+
+from formas_pago_sat import FORMAS_PAGO_SAT
+
+# Versiones de CFDI que se importan
+VERSIONES_CFDI = ('3.3', '4.0')
+
+# Claves de impuesto del catálogo del SAT
+IMPUESTO_ISR = '001'
+IMPUESTO_IVA = '002'
+
+# Monedas que no requieren tipo de cambio
+MONEDAS_NACIONALES = ('MXN', 'XXX')
+
+# Tipos de comprobante que generan una transacción (I = ingreso, E = egreso / nota de crédito)
+TIPOS_COMPROBANTE_IMPORTABLES = ('I', 'E')
+
+# RFC de persona física (13) o moral (12)
+PATRON_RFC = re.compile(r'^[A-ZÑ&]{3,4}\d{6}[A-Z0-9]{3}$')
+
+# Tamaño máximo de un XML dentro del ZIP (los CFDI reales pesan unos KB)
+MAX_BYTES_XML = 5 * 1024 * 1024
+
+# XML que procesa cada tarea del pool (menos viajes entre procesos que uno por uno)
+XMLS_POR_TAREA = 200
+
+# Largo máximo del concepto armado con las descripciones del CFDI
+MAX_LARGO_CONCEPTO = 250
+
+def _nombre_local(tag: str) -> str:
+    """Nombre de un elemento sin el espacio de nombres (cfdi:Emisor -> Emisor)"""
+    return tag.rsplit('}', 1)[-1]
+
+def _importe(valor) -> float:
+    """Importe de un atributo (0 si no viene)"""
+    return float(valor) if valor not in (None, '') else 0.0
+
+def parsear_cfdi(xml: bytes) -> Dict:
+    """
+    Extrae los datos fiscales de un CFDI 3.3 o 4.0
+    
+    Args:
+        xml: Contenido del XML
+    
+    Returns:
+        {'version', 'uuid', 'fecha', 'tipo_comprobante', 'rfc_emisor', 'nombre_emisor',
+         'rfc_receptor', 'nombre_receptor', 'subtotal', 'descuento', 'total', 'moneda',
+         'tipo_cambio', 'forma_pago', 'metodo_pago', 'iva_trasladado', 'iva_retenido',
+         'isr_retenido', 'conceptos': [descripciones]}
+    
+    Raises:
+        ValueError: Si el XML no es un CFDI de una versión soportada
+    """
+    cfdi = None
+    ruta = []  # Elementos abiertos (nombres locales), de la raíz al actual
+    
+    for evento, elem in iterparse(io.BytesIO(xml), events=('start', 'end')):
+        if evento == 'end':
+            ruta.pop()
+            elem.clear()
+            continue
+        
+        nombre = _nombre_local(elem.tag)
+        ruta.append(nombre)
+        profundidad = len(ruta)
+        atributos = elem.attrib
+        
+        if profundidad == 1:
+            if nombre != 'Comprobante':
+                raise ValueError('El XML no es un CFDI')
+            version = atributos.get('Version', atributos.get('version', ''))
+            if version not in VERSIONES_CFDI:
+                raise ValueError(f'Versión de CFDI no soportada: {version or "desconocida"}')
+            cfdi = {
+                'version': version,
+                'uuid': '',
+                'fecha': atributos.get('Fecha', '')[:10],
+                'tipo_comprobante': atributos.get('TipoDeComprobante', ''),
+                'rfc_emisor': '',
+                'nombre_emisor': '',
+                'rfc_receptor': '',
+                'nombre_receptor': '',
+                'subtotal': _importe(atributos.get('SubTotal')),
+                'descuento': _importe(atributos.get('Descuento')),
+                'total': _importe(atributos.get('Total')),
+                'moneda': atributos.get('Moneda', 'MXN'),
+                'tipo_cambio': _importe(atributos.get('TipoCambio')) or 1.0,
+                'forma_pago': atributos.get('FormaPago', ''),
+                'metodo_pago': atributos.get('MetodoPago', ''),
+                'iva_trasladado': 0.0,
+                'iva_retenido': 0.0,
+                'isr_retenido': 0.0,
+                'conceptos': []
+            }
+        elif profundidad == 2 and nombre in ('Emisor', 'Receptor'):
+            # Solo los hijos directos del comprobante (el complemento de nómina tiene su propio Emisor)
+            sufijo = nombre.lower()
+            cfdi[f'rfc_{sufijo}'] = atributos.get('Rfc', '').strip().upper()
+            cfdi[f'nombre_{sufijo}'] = atributos.get('Nombre', '').strip()
+        elif profundidad == 3 and nombre == 'Concepto' and ruta[1] == 'Conceptos':
+            descripcion = atributos.get('Descripcion', '').strip()
+            if descripcion:
+                cfdi['conceptos'].append(descripcion)
+        elif profundidad == 4 and ruta[1] == 'Impuestos' and nombre in ('Traslado', 'Retencion'):
+            # Impuestos totales del comprobante (los de cada concepto ya están sumados aquí)
+            impuesto = atributos.get('Impuesto')
+            importe = _importe(atributos.get('Importe'))
+            if nombre == 'Traslado' and impuesto == IMPUESTO_IVA:
+                cfdi['iva_trasladado'] += importe
+            elif nombre == 'Retencion' and impuesto == IMPUESTO_IVA:
+                cfdi['iva_retenido'] += importe
+            elif nombre == 'Retencion' and impuesto == IMPUESTO_ISR:
+                cfdi['isr_retenido'] += importe
+        elif nombre == 'TimbreFiscalDigital':
+            cfdi['uuid'] = atributos.get('UUID', '').strip().upper()
+    
+    if cfdi is None:
+        raise ValueError('El XML no es un CFDI')
+    return cfdi
+
+def transaccion_desde_cfdi(cfdi: Dict, rfc_medico: str) -> Tuple[Optional[Dict], Optional[str]]:
+    """
+    Convierte un CFDI en transacción (sin clasificar). Es ingreso si el médico
+    lo emitió y gasto si lo recibió; los egresos (notas de crédito) se guardan
+    con monto negativo. Los importes en moneda extranjera se convierten a pesos.
+    
+    Returns:
+        (transaccion_data, None) o (None, mensaje de error)
+    """
+    rfc = (rfc_medico or '').strip().upper()
+    
+    if cfdi['tipo_comprobante'] not in TIPOS_COMPROBANTE_IMPORTABLES:
+        return None, f"Tipo de comprobante '{cfdi['tipo_comprobante']}' no se importa (solo Ingreso o Egreso)"
+    
+    if not cfdi['uuid']:
+        return None, "CFDI sin timbre fiscal (UUID)"
+    
+    if cfdi['rfc_emisor'] == rfc:
+        tipo = 'ingreso'
+        contraparte = cfdi['nombre_receptor'] or cfdi['rfc_receptor']
+    elif cfdi['rfc_receptor'] == rfc:
+        tipo = 'gasto'
+        contraparte = cfdi['nombre_emisor'] or cfdi['rfc_emisor']
+    else:
+        return None, f"El CFDI no corresponde al RFC {rfc} (emisor {cfdi['rfc_emisor']}, receptor {cfdi['rfc_receptor']})"
+    
+    if not cfdi['fecha']:
+        return None, "CFDI sin fecha"
+    
+    factor = 1.0 if cfdi['moneda'] in MONEDAS_NACIONALES else cfdi['tipo_cambio']
+    if cfdi['tipo_comprobante'] == 'E':
+        factor = -factor
+    
+    def en_pesos(importe):
+        # + 0.0 evita guardar -0.0 en los impuestos en cero de una nota de crédito
+        return round(importe * factor, 2) + 0.0
+    
+    concepto = '; '.join(cfdi['conceptos']) or 'CFDI sin descripción'
+    if cfdi['tipo_comprobante'] == 'E':
+        concepto = f'Nota de crédito: {concepto}'
+    
+    forma_pago = cfdi['forma_pago']
+    if forma_pago in FORMAS_PAGO_SAT:
+        forma_pago = f"{forma_pago} - {FORMAS_PAGO_SAT[forma_pago]['descripcion']}"
+    
+    transaccion_data = {
+        'tipo': tipo,
+        'fecha': cfdi['fecha'],
+        'monto': en_pesos(cfdi['total']),
+        'concepto': concepto[:MAX_LARGO_CONCEPTO],
+        'proveedor': contraparte,
+        'cfdi_uuid': cfdi['uuid'],
+        'forma_pago': forma_pago,
+        'metodo_pago': cfdi['metodo_pago'],
+        'clasificacion': '',
+        'deducible_porcentaje': None,
+        'notas_contador': '',
+        'rfc_emisor': cfdi['rfc_emisor'],
+        'rfc_receptor': cfdi['rfc_receptor'],
+        # Base sin IVA: el SubTotal del CFDI es antes del descuento
+        'subtotal': en_pesos(cfdi['subtotal'] - cfdi['descuento']),
+        'iva_trasladado': en_pesos(cfdi['iva_trasladado']),
+        'iva_retenido': en_pesos(cfdi['iva_retenido']),
+        'isr_retenido': en_pesos(cfdi['isr_retenido'])
+    }
+    return transaccion_data, None
+
+def validar_rfc(rfc: str) -> bool:
+    """True si el RFC tiene el formato del SAT"""
+    return bool(PATRON_RFC.match((rfc or '').strip().upper()))
+
+def es_archivo_cfdi(nombre_archivo: str) -> bool:
+    """True si el archivo es un XML o un ZIP de XML"""
+    return nombre_archivo.lower().endswith(('.xml', '.zip'))
+
+def _es_xml_del_zip(info: zipfile.ZipInfo) -> bool:
+    """Entradas del ZIP que son XML (sin carpetas ni metadatos de macOS)"""
+    return (
+        not info.is_dir()
+        and info.filename.lower().endswith('.xml')
+        and not info.filename.startswith('__MACOSX/')
+    )
+
+def contar_xmls(ruta: str, nombre_archivo: str) -> int:
+    """XML que contiene el archivo (lee solo el directorio del ZIP)"""
+    if not nombre_archivo.lower().endswith('.zip'):
+        return 1
+    with zipfile.ZipFile(ruta) as archivo_zip:
+        return sum(1 for info in archivo_zip.infolist() if _es_xml_del_zip(info))
+
+def leer_xmls(ruta: str, nombre_archivo: str, desde: int = 0) -> Iterator[Tuple[int, str, Optional[bytes]]]:
+    """
+    XML de un archivo .xml o .zip como (número, nombre, contenido), numerados desde 1.
+    El contenido es None si el XML pasa de MAX_BYTES_XML.
+    
+    Args:
+        desde: Omitir los XML con número menor o igual (para continuar una importación)
+    """
+    if not nombre_archivo.lower().endswith('.zip'):
+        if desde < 1:
+            with open(ruta, 'rb') as f:
+                contenido = f.read(MAX_BYTES_XML + 1)
+            yield 1, nombre_archivo, contenido if len(contenido) <= MAX_BYTES_XML else None
+        return
+    
+    with zipfile.ZipFile(ruta) as archivo_zip:
+        numero = 0
+        for info in archivo_zip.infolist():
+            if not _es_xml_del_zip(info):
+                continue
+            numero += 1
+            if numero <= desde:
+                continue
+            if info.file_size > MAX_BYTES_XML:
+                yield numero, info.filename, None
+                continue
+            with archivo_zip.open(info) as f:
+                contenido = f.read(MAX_BYTES_XML + 1)
+            yield numero, info.filename, contenido if len(contenido) <= MAX_BYTES_XML else None
+
+def _parsear_bloque(xmls: List[Optional[bytes]]) -> List[Tuple[Optional[Dict], Optional[str]]]:
+    """Parsea un bloque de XML en un proceso del pool. Retorna [(cfdi o None, error o None)]"""
+    resultados = []
+    for xml in xmls:
+        if xml is None:
+            resultados.append((None, f'El XML pasa del tamaño máximo ({MAX_BYTES_XML // (1024 * 1024)} MB)'))
+            continue
+        try:
+            resultados.append((parsear_cfdi(xml), None))
+        except ParseError as e:
+            resultados.append((None, f'XML inválido: {str(e)}'))
+        except ValueError as e:
+            resultados.append((None, str(e)))
+    return resultados
+
+# Pool de procesos de lectura de XML (se crea la primera vez y se reutiliza entre importaciones)
+_pool = None
+_pool_lock = threading.Lock()
+
+def _obtener_pool(reiniciar: bool = False) -> ProcessPoolExecutor:
+    """Obtiene el pool de lectura de XML, creándolo (o recreándolo si se rompió)"""
+    global _pool
+    with _pool_lock:
+        if _pool is None or reiniciar:
+            if _pool is not None:
+                _pool.shutdown(wait=False, cancel_futures=True)
+            # 'spawn' para no heredar el estado del servidor web (hilos, locks, conexiones)
+            _pool = ProcessPoolExecutor(
+                max_workers=os.cpu_count() or 1,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _pool
+
+def _en_bloques(xmls: Iterator[Tuple[int, str, Optional[bytes]]], tamano: int) -> Iterator[List[Tuple]]:
+    """Agrupa los XML en listas de hasta tamano elementos"""
+    while True:
+        bloque = list(itertools.islice(xmls, tamano))
+        if not bloque:
+            return
+        yield bloque
+
+def _resultados_bloque(bloque: List[Tuple], parseados: List[Tuple]) -> Iterator[Tuple[int, Dict]]:
+    """Une cada XML del bloque con su resultado"""
+    for (numero, nombre, xml), (cfdi, error) in zip(bloque, parseados):
+        yield numero, {'archivo': nombre, 'xml': xml, 'cfdi': cfdi, 'error': error}
+
+def parsear_cfdis(xmls: Iterator[Tuple[int, str, Optional[bytes]]], max_procesos: Optional[int] = None) -> Iterator[Tuple[int, Dict]]:
+    """
+    Parsea los XML en el pool de procesos, en bloques de XMLS_POR_TAREA, y los
+    entrega en el mismo orden en que llegan. Solo mantiene en vuelo un par de
+    bloques por proceso, así la memoria no crece con el tamaño del ZIP.
+    
+    Args:
+        xmls: Iterador de (número, nombre, contenido), como el de leer_xmls
+        max_procesos: Procesos a usar (default: núcleos disponibles)
+    
+    Yields:
+        (número, {'archivo', 'xml', 'cfdi' (dict o None), 'error' (str o None)})
+    """
+    max_procesos = max(1, max_procesos or os.cpu_count() or 1)
+    bloques = _en_bloques(iter(xmls), XMLS_POR_TAREA)
+    
+    # Un solo bloque (o un solo núcleo): no vale la pena usar otros procesos
+    primeros = list(itertools.islice(bloques, 2))
+    if max_procesos == 1 or len(primeros) < 2:
+        for bloque in itertools.chain(primeros, bloques):
+            yield from _resultados_bloque(bloque, _parsear_bloque([xml for _, _, xml in bloque]))
+        return
+    
+    pool = _obtener_pool()
+    en_vuelo = deque()
+    
+    def enviar(bloque):
+        nonlocal pool
+        contenidos = [xml for _, _, xml in bloque]
+        try:
+            futuro = pool.submit(_parsear_bloque, contenidos)
+        except BrokenProcessPool:
+            pool = _obtener_pool(reiniciar=True)
+            futuro = pool.submit(_parsear_bloque, contenidos)
+        en_vuelo.append((bloque, futuro))
+    
+    def entregar():
+        bloque, futuro = en_vuelo.popleft()
+        try:
+            parseados = futuro.result()
+        except Exception as e:
+            parseados = [(None, f'Error leyendo el XML: {str(e)}')] * len(bloque)
+        return _resultados_bloque(bloque, parseados)
+    
+    try:
+        for bloque in itertools.chain(primeros, bloques):
+            enviar(bloque)
+            if len(en_vuelo) >= max_procesos * 2:
+                yield from entregar()
+        while en_vuelo:
+            yield from entregar()
+    finally:
+        # Si la importación se interrumpe, no seguir parseando este archivo
+        for _, futuro in en_vuelo:
+            futuro.cancel()
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Clasificador de transacciones entrenado localmente (Naive Bayes multinomial)
+Aprende de las transacciones aprobadas por el contador y de las reglas de
+clasificación; sugiere una clasificación de clasificaciones_fiscales para los
+conceptos que ninguna regla reconoce. Las palabras del concepto y del proveedor
+se convierten en características con hashing (vector de tamaño fijo, sin
+vocabulario) y un lote completo se califica con una sola operación de NumPy.
+"""
+
+import zlib
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from busqueda_procedimientos import normalizar_texto
+from clasificaciones_fiscales import TODAS_CLASIFICACIONES, obtener_porcentaje_deducible
+
+# Tamaño del vector de características (hashing de palabras)
+DIMENSION_HASH = 2 ** 15
+
+# Suavizado de Lidstone (los conceptos son textos cortos: un alfa menor a 1 funciona mejor)
+ALFA_SUAVIZADO = 0.1
+
+# Probabilidad mínima para sugerir la clasificación del modelo
+UMBRAL_PROBABILIDAD_MODELO = 0.5
+
+# Ejemplos (ponderados) mínimos de la clasificación ganadora: con pocos ejemplos por
+# médico las probabilidades de Naive Bayes están mal calibradas (una palabra en común
+# da más de 0.9)
+MIN_EJEMPLOS_CLASE = 5
+
+# Fracción mínima de las características de la transacción vistas en el entrenamiento
+MIN_FRACCION_CONOCIDAS = 0.5
+
+# Ejemplos que se acumulan antes de sumarlos a la matriz de conteos
+TAMANO_BLOQUE_ENTRENAMIENTO = 5000
+
+def caracteristicas(concepto: str, proveedor: str = '') -> List[int]:
+    """
+    Índices de características de una transacción: palabras y pares de palabras
+    del concepto, raíces (primeras 5 letras) de palabras largas y palabras del
+    proveedor. crc32 da el mismo índice en todos los procesos (hash() no).
+    """
+    palabras = normalizar_texto(concepto).split()
+    tokens = palabras + [f'{a}_{b}' for a, b in zip(palabras, palabras[1:])]
+    tokens += [f'~{p[:5]}' for p in palabras if len(p) > 5]
+    tokens += [f'prov:{p}' for p in normalizar_texto(proveedor).split()]
+    return [zlib.crc32(t.encode('utf-8')) % DIMENSION_HASH for t in tokens]
+
+class ClasificadorTransacciones:
+    """
+    Naive Bayes multinomial sobre características con hashing. Solo aprende
+    clasificaciones que existen en clasificaciones_fiscales; el entrenamiento es
+    aditivo, así que cada validación nueva se suma sin reentrenar todo.
+    """
+    
+    def __init__(self):
+        self.clases: List[str] = []
+        self._indice_clase: Dict[str, int] = {}
+        self._tipos = np.empty(0, dtype=object)
+        self._conteos = np.zeros((0, DIMENSION_HASH))
+        self._documentos = np.zeros(0)
+        # Log-probabilidades y características vistas en el entrenamiento (se invalidan al aprender)
+        self._log_theta = None
+        self._log_prior = None
+        self._vistas = None
+    
+    def __len__(self):
+        """Ejemplos (ponderados) con que se ha entrenado"""
+        return int(self._documentos.sum())
+    
+    def _clase(self, clasificacion: str) -> Optional[int]:
+        """Índice de una clasificación (la agrega si es nueva; None si no es fiscal)"""
+        indice = self._indice_clase.get(clasificacion)
+        if indice is None:
+            datos = TODAS_CLASIFICACIONES.get(clasificacion)
+            if not datos:
+                return None
+            indice = len(self.clases)
+            self.clases.append(clasificacion)
+            self._indice_clase[clasificacion] = indice
+            self._tipos = np.append(self._tipos, datos['tipo'])
+            self._conteos = np.vstack([self._conteos, np.zeros((1, DIMENSION_HASH))])
+            self._documentos = np.append(self._documentos, 0.0)
+        return indice
+    
+    def _sumar(self, filas: List[int], columnas: List[int], pesos: List[float], documentos: Dict[int, float]):
+        """Suma un bloque de conteos a la matriz"""
+        if filas:
+            np.add.at(self._conteos, (np.array(filas), np.array(columnas)), np.array(pesos))
+        for clase, peso in documentos.items():
+            self._documentos[clase] += peso
+        self._log_theta = None
+    
+    def entrenar(self, ejemplos: Iterable[Tuple[str, str, str, float]]) -> int:
+        """
+        Suma ejemplos al modelo
+        
+        Args:
+            ejemplos: Iterable de (concepto, proveedor, clasificacion, peso)
+        
+        Returns:
+            Número de ejemplos usados (los de clasificaciones no fiscales se omiten)
+        """
+        usados = 0
+        filas, columnas, pesos, documentos = [], [], [], {}
+        for concepto, proveedor, clasificacion, peso in ejemplos:
+            clase = self._clase(clasificacion)
+            if clase is None:
+                continue
+            indices = caracteristicas(concepto, proveedor)
+            filas.extend([clase] * len(indices))
+            columnas.extend(indices)
+            pesos.extend([peso] * len(indices))
+            documentos[clase] = documentos.get(clase, 0.0) + peso
+            usados += 1
+            
+            if usados % TAMANO_BLOQUE_ENTRENAMIENTO == 0:
+                self._sumar(filas, columnas, pesos, documentos)
+                filas, columnas, pesos, documentos = [], [], [], {}
+        
+        self._sumar(filas, columnas, pesos, documentos)
+        return usados
+    
+    def agregar_ejemplo(self, concepto: str, proveedor: str, clasificacion: str, peso: float = 1.0) -> bool:
+        """Aprende una validación nueva (entrenamiento incremental)"""
+        return self.entrenar([(concepto, proveedor, clasificacion, peso)]) > 0
+    
+    def _parametros(self):
+        """
+        Log-probabilidades de cada característica por clase, log-prior de cada clase
+        y máscara de características que aparecieron en el entrenamiento
+        """
+        if self._log_theta is None:
+            suavizados = self._conteos + ALFA_SUAVIZADO
+            self._log_theta = np.log(suavizados) - np.log(suavizados.sum(axis=1, keepdims=True))
+            self._log_prior = np.log(self._documentos) - np.log(self._documentos.sum())
+            self._vistas = self._conteos.sum(axis=0) > 0
+        return self._log_theta, self._log_prior, self._vistas
+    
+    def predecir_lote(self, transacciones: List[Tuple[str, str]], tipos: List[Optional[str]] = None) -> List[Optional[Dict]]:
+        """
+        Clasifica un lote de transacciones con una sola operación matricial
+        
+        Args:
+            transacciones: Lista de (concepto, proveedor)
+            tipos: 'ingreso'/'gasto' de cada transacción para limitar las clasificaciones (opcional)
+        
+        Returns:
+            Por transacción, {'clasificacion', 'probabilidad'} o None si no hay con qué
+            decidir: menos de MIN_FRACCION_CONOCIDAS de sus características vistas en el
+            entrenamiento, o una clasificación ganadora con menos de MIN_EJEMPLOS_CLASE ejemplos
+        """
+        resultados: List[Optional[Dict]] = [None] * len(transacciones)
+        if not self.clases or not transacciones:
+            return resultados
+        
+        # Características de todo el lote en un solo arreglo, con el inicio de cada transacción
+        indices, inicios, con_caracteristicas = [], [], []
+        for posicion, (concepto, proveedor) in enumerate(transacciones):
+            actuales = caracteristicas(concepto, proveedor)
+            if actuales:
+                inicios.append(len(indices))
+                con_caracteristicas.append(posicion)
+                indices.extend(actuales)
+        if not indices:
+            return resultados
+        
+        log_theta, log_prior, vistas = self._parametros()
+        indices = np.array(indices)
+        inicios = np.array(inicios)
+        # (características, clases) sumadas por transacción: log P(texto | clase) + log P(clase)
+        puntajes = np.add.reduceat(log_theta.T[indices], inicios, axis=0) + log_prior
+        
+        # Con pocas características conocidas el modelo casi solo repite el prior
+        longitudes = np.diff(np.append(inicios, len(indices)))
+        conocidas = np.add.reduceat(vistas[indices].astype(np.int64), inicios) >= MIN_FRACCION_CONOCIDAS * longitudes
+        
+        if tipos is not None:
+            tipos_lote = np.array([tipos[p] or '' for p in con_caracteristicas], dtype=object)
+            permitidas = (tipos_lote[:, None] == self._tipos[None, :]) | (tipos_lote[:, None] == '')
+            puntajes = np.where(permitidas, puntajes, -np.inf)
+        
+        # Softmax por fila (restando el máximo para estabilidad numérica)
+        maximos = puntajes.max(axis=1, keepdims=True)
+        validas = np.isfinite(maximos[:, 0]) & conocidas
+        exponentes = np.exp(puntajes - np.where(np.isfinite(maximos), maximos, 0))
+        probabilidades = exponentes / np.maximum(exponentes.sum(axis=1, keepdims=True), 1e-300)
+        ganadoras = probabilidades.argmax(axis=1)
+        validas &= self._documentos[ganadoras] >= MIN_EJEMPLOS_CLASE
+        
+        for fila, posicion in enumerate(con_caracteristicas):
+            if validas[fila]:
+                resultados[posicion] = {
+                    'clasificacion': self.clases[ganadoras[fila]],
+                    'probabilidad': float(probabilidades[fila, ganadoras[fila]])
+                }
+        return resultados
+
+def resultado_modelo(prediccion: Optional[Dict]) -> Optional[Dict]:
+    """
+    Convierte una predicción en el formato de clasificar_con_ia, o None si la
+    probabilidad no alcanza UMBRAL_PROBABILIDAD_MODELO. La clasificación del modelo
+    es solo una sugerencia (confianza 'baja'): no asigna porcentaje deducible, que
+    queda en 'deducible_sugerido' hasta que el contador la valide.
+    """
+    if not prediccion or prediccion['probabilidad'] < UMBRAL_PROBABILIDAD_MODELO:
+        return None
+    return {
+        'clasificacion': prediccion['clasificacion'],
+        'deducible_porcentaje': 0,
+        'deducible_sugerido': obtener_porcentaje_deducible(prediccion['clasificacion']),
+        'confianza': 'baja',
+        'metodo': 'modelo',
+        'probabilidad': round(prediccion['probabilidad'], 3)
+    }
@@ -1,8 +1,23 @@
 # -*- coding: utf-8 -*-
 import sqlite3
+import json
 import os
+import threading
 from datetime import datetime
-from typing import List, Dict, Optional
+from typing import List, Dict, Iterator, Optional, Tuple
+from busqueda_procedimientos import IndiceTrigramas, normalizar_nombre
+from indice_reglas import IndiceReglas
+from clasificador_transacciones import ClasificadorTransacciones, resultado_modelo
+from seguro_rag import VERSION_CONTEXTO_COBERTURA
+from seguro_ocr import (
+    PLANES_PREDEFINIDOS, clave_plan, normalizar_nombre_aseguradora
+)
+
+def _agregar_columna_si_falta(conn: sqlite3.Connection, tabla: str, columna: str, definicion: str):
+    """Agrega una columna a una tabla existente si aún no existe (migración ligera)"""
+    columnas = {row[1] for row in conn.execute(f'PRAGMA table_info({tabla})')}
+    if columna not in columnas:
+        conn.execute(f'ALTER TABLE {tabla} ADD COLUMN {columna} {definicion}')
 
 class ConsultaDB:
     def __init__(self, db_path: str = "consultas.db"):
@@ -37,6 +52,7 @@ class ConsultaDB:
             conn.execute('CREATE INDEX IF NOT EXISTS idx_fecha ON consultas(fecha_consulta)')
             conn.execute('CREATE INDEX IF NOT EXISTS idx_medico ON consultas(medico_id)')
             conn.execute('CREATE INDEX IF NOT EXISTS idx_diagnostico ON consultas(diagnostico)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_consultas_medico_updated ON consultas(medico_id, updated_at)')
             
             conn.commit()
     
@@ -79,6 +95,45 @@ class ConsultaDB:
             
             return [dict(row) for row in cursor.fetchall()]
     
+    def iterar_consultas_modificadas(self, medico_id: str = 'default', desde_id: int = 0,
+                                     desde_updated_at: str = '', tamano_bloque: int = 500) -> Iterator[Dict]:
+        """
+        Recorre en orden de id las consultas de un médico modificadas (updated_at >=
+        desde_updated_at, id <= desde_id) y nuevas (id > desde_id). Ambas búsquedas
+        usan índice (idx_consultas_medico_updated; idx_medico termina en el rowid),
+        así que el costo es proporcional a las consultas devueltas, no al historial.
+        Las nuevas se leen por páginas de id sin dejar abierta la lectura entre
+        páginas, para que quien recorre pueda escribir en la misma base.
+        updated_at tiene resolución de segundos: con >= se repiten las consultas del
+        último segundo auditado en lugar de perder las modificadas en ese segundo.
+        """
+        columnas = 'id, fecha_consulta, diagnostico, tratamiento, transcripcion, updated_at'
+        with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            modificadas = conn.execute(f'''
+                SELECT {columnas} FROM consultas
+                WHERE medico_id = ? AND updated_at >= ? AND id <= ?
+                ORDER BY id
+            ''', (medico_id, desde_updated_at, desde_id)).fetchall()
+        for fila in modificadas:
+            yield dict(fila)
+        
+        ultimo_id = desde_id
+        while True:
+            with sqlite3.connect(self.db_path) as conn:
+                conn.row_factory = sqlite3.Row
+                filas = conn.execute(f'''
+                    SELECT {columnas} FROM consultas
+                    WHERE medico_id = ? AND id > ?
+                    ORDER BY id
+                    LIMIT ?
+                ''', (medico_id, ultimo_id, tamano_bloque)).fetchall()
+            if not filas:
+                break
+            for fila in filas:
+                yield dict(fila)
+            ultimo_id = filas[-1]['id']
+    
     def obtener_consulta(self, consulta_id: int) -> Optional[Dict]:
         """Obtiene una consulta específica por ID"""
         with sqlite3.connect(self.db_path) as conn:
@@ -171,8 +226,37 @@ class ConsultaDB:
 class TransaccionDB:
     """Gestión de transacciones financieras (ingresos y gastos) para el módulo del contador"""
     
+    # Columnas de resumen_mensual y su agregado sobre las transacciones del mes. Las
+    # rechazadas no cuentan; deducciones e IVA acreditable solo de gastos aprobados.
+    # Sin CFDI (sin subtotal) el monto se toma como ingreso sin IVA (honorarios al 0%).
+    # Las deducciones *_sin_iva son sin el IVA del gasto: se usan en los meses en que ese
+    # IVA se acredita, para no contarlo dos veces (impuestos_provisionales).
+    AGREGADOS_RESUMEN_MENSUAL = {
+        'ingresos': "CASE WHEN tipo = 'ingreso' AND estatus_validacion != 'rechazado' THEN monto END",
+        'ingresos_sin_iva': "CASE WHEN tipo = 'ingreso' AND estatus_validacion != 'rechazado' THEN COALESCE(subtotal, monto) END",
+        'gastos': "CASE WHEN tipo = 'gasto' AND estatus_validacion != 'rechazado' THEN monto END",
+        'deducciones': "CASE WHEN tipo = 'gasto' AND estatus_validacion = 'aprobado' THEN monto * COALESCE(deducible_porcentaje, 0) / 100.0 END",
+        'deducciones_por_validar': "CASE WHEN tipo = 'gasto' AND estatus_validacion = 'pendiente' THEN monto * COALESCE(deducible_porcentaje, 0) / 100.0 END",
+        'deducciones_sin_iva': "CASE WHEN tipo = 'gasto' AND estatus_validacion = 'aprobado' THEN COALESCE(subtotal, monto) * COALESCE(deducible_porcentaje, 0) / 100.0 END",
+        'deducciones_por_validar_sin_iva': "CASE WHEN tipo = 'gasto' AND estatus_validacion = 'pendiente' THEN COALESCE(subtotal, monto) * COALESCE(deducible_porcentaje, 0) / 100.0 END",
+        'iva_trasladado': "CASE WHEN tipo = 'ingreso' AND estatus_validacion != 'rechazado' THEN iva_trasladado END",
+        'iva_acreditable': "CASE WHEN tipo = 'gasto' AND estatus_validacion = 'aprobado' THEN iva_trasladado * COALESCE(deducible_porcentaje, 0) / 100.0 END",
+        'iva_retenido': "CASE WHEN tipo = 'ingreso' AND estatus_validacion != 'rechazado' THEN iva_retenido END",
+        'isr_retenido': "CASE WHEN tipo = 'ingreso' AND estatus_validacion != 'rechazado' THEN isr_retenido END",
+        'transacciones': "1",
+        'pendientes': "CASE WHEN estatus_validacion = 'pendiente' THEN 1 END"
+    }
+    
+    # Gastos que van en la hoja Deducibles del reporte (detalle y totales usan la misma condición)
+    CONDICION_DEDUCIBLE = "tipo = 'gasto' AND estatus_validacion = 'aprobado' AND deducible_porcentaje > 0"
+    
     def __init__(self, db_path: str = "consultas.db"):
         self.db_path = db_path
+        # Índices en memoria de reglas de clasificación por médico (se cargan bajo demanda)
+        self._indices_reglas: Dict[str, IndiceReglas] = {}
+        # Clasificadores Naive Bayes por médico (se entrenan bajo demanda)
+        self._clasificadores: Dict[str, ClasificadorTransacciones] = {}
+        self._reglas_lock = threading.Lock()
         self.init_database()
     
     def init_database(self):
@@ -221,15 +305,159 @@ class TransaccionDB:
                 )
             ''')
             
+            # Importaciones de Excel/CSV en segundo plano (avance por lote para poder reanudar)
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS importaciones (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    medico_id TEXT DEFAULT 'default',
+                    nombre_archivo TEXT NOT NULL,
+                    archivo_path TEXT NOT NULL,
+                    estado TEXT DEFAULT 'pendiente' CHECK(estado IN ('pendiente', 'procesando', 'completado', 'error')),
+                    total_filas INTEGER,
+                    ultima_fila INTEGER DEFAULT 0,
+                    procesadas INTEGER DEFAULT 0,
+                    exitosas INTEGER DEFAULT 0,
+                    duplicadas INTEGER DEFAULT 0,
+                    total_errores INTEGER DEFAULT 0,
+                    errores TEXT,
+                    mensaje_error TEXT,
+                    procesadas_al_iniciar INTEGER DEFAULT 0,
+                    fecha_creacion DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    fecha_inicio DATETIME,
+                    fecha_actualizacion DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    fecha_fin DATETIME
+                )
+            ''')
+            
+            # Datos fiscales de los CFDI importados desde XML
+            _agregar_columna_si_falta(conn, 'transacciones', 'rfc_emisor', 'TEXT')
+            _agregar_columna_si_falta(conn, 'transacciones', 'rfc_receptor', 'TEXT')
+            _agregar_columna_si_falta(conn, 'transacciones', 'subtotal', 'REAL')
+            _agregar_columna_si_falta(conn, 'transacciones', 'iva_trasladado', 'REAL')
+            _agregar_columna_si_falta(conn, 'transacciones', 'iva_retenido', 'REAL')
+            _agregar_columna_si_falta(conn, 'transacciones', 'isr_retenido', 'REAL')
+            
+            # RFC del médico en importaciones de CFDI (define si cada XML es ingreso o gasto)
+            _agregar_columna_si_falta(conn, 'importaciones', 'rfc_medico', 'TEXT')
+            
+            # Totales por médico y mes (base del cálculo de pagos provisionales); se
+            # mantienen al guardar y validar transacciones, sin volver a recorrerlas
+            conn.execute(f'''
+                CREATE TABLE IF NOT EXISTS resumen_mensual (
+                    medico_id TEXT NOT NULL,
+                    periodo TEXT NOT NULL,
+                    {', '.join(
+                        f"{columna} {'INTEGER' if columna in ('transacciones', 'pendientes') else 'REAL'} DEFAULT 0"
+                        for columna in self.AGREGADOS_RESUMEN_MENSUAL
+                    )},
+                    fecha_actualizacion DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (medico_id, periodo)
+                )
+            ''')
+            
             # Índices para búsquedas rápidas
             conn.execute('CREATE INDEX IF NOT EXISTS idx_trans_fecha ON transacciones(fecha)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_trans_medico_fecha ON transacciones(medico_id, fecha)')
             conn.execute('CREATE INDEX IF NOT EXISTS idx_trans_tipo ON transacciones(tipo)')
             conn.execute('CREATE INDEX IF NOT EXISTS idx_trans_estatus ON transacciones(estatus_validacion)')
             conn.execute('CREATE INDEX IF NOT EXISTS idx_trans_medico ON transacciones(medico_id)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_trans_uuid ON transacciones(cfdi_uuid)')
             conn.execute('CREATE INDEX IF NOT EXISTS idx_reglas_medico ON reglas_clasificacion(medico_id)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_importaciones_estado ON importaciones(estado)')
+            
+            # Columnas de resumen agregadas después de crear la tabla: se llenan reconstruyéndolo
+            existentes = {row[1] for row in conn.execute('PRAGMA table_info(resumen_mensual)')}
+            faltantes = [c for c in self.AGREGADOS_RESUMEN_MENSUAL if c not in existentes]
+            for columna in faltantes:
+                _agregar_columna_si_falta(conn, 'resumen_mensual', columna, 'REAL DEFAULT 0')
+            
+            # Bases de datos con transacciones anteriores al resumen: llenarlo una vez
+            if faltantes or conn.execute('SELECT 1 FROM resumen_mensual LIMIT 1').fetchone() is None:
+                self._reconstruir_resumen_mensual(conn)
             
             conn.commit()
     
+    def _agregados_resumen_mensual(self) -> str:
+        """Expresiones SELECT de las columnas de resumen_mensual"""
+        return ', '.join(
+            f'COALESCE(SUM({expresion}), 0) AS {columna}'
+            for columna, expresion in self.AGREGADOS_RESUMEN_MENSUAL.items()
+        )
+    
+    def _reconstruir_resumen_mensual(self, conn, medico_id: str = None):
+        """Recalcula resumen_mensual desde las transacciones (todas o las de un médico). No hace commit."""
+        condicion = 'WHERE medico_id = ?' if medico_id else ''
+        params = [medico_id] if medico_id else []
+        conn.execute(f'DELETE FROM resumen_mensual {condicion}', params)
+        conn.execute(f'''
+            INSERT INTO resumen_mensual (medico_id, periodo, {', '.join(self.AGREGADOS_RESUMEN_MENSUAL)})
+            SELECT medico_id, substr(fecha, 1, 7), {self._agregados_resumen_mensual()}
+            FROM transacciones
+            {condicion}
+            GROUP BY 1, 2
+        ''', params)
+    
+    def _sumar_a_resumen_mensual(self, conn, desde_id: int):
+        """
+        Suma al resumen las transacciones recién insertadas (ID mayor a desde_id),
+        agrupadas por médico y mes. No hace commit.
+        """
+        columnas = list(self.AGREGADOS_RESUMEN_MENSUAL)
+        conn.execute(f'''
+            INSERT INTO resumen_mensual (medico_id, periodo, {', '.join(columnas)})
+            SELECT medico_id, substr(fecha, 1, 7), {self._agregados_resumen_mensual()}
+            FROM transacciones
+            WHERE id > ?
+            GROUP BY 1, 2
+            ON CONFLICT (medico_id, periodo) DO UPDATE SET
+                {', '.join(f'{c} = {c} + excluded.{c}' for c in columnas)},
+                fecha_actualizacion = CURRENT_TIMESTAMP
+        ''', (desde_id,))
+    
+    def _recalcular_periodos(self, conn, periodos: set):
+        """
+        Recalcula el resumen de los meses afectados {(medico_id, periodo)}, con el
+        periodo como substr(fecha, 1, 7) igual que al reconstruirlo. No hace commit.
+        """
+        for medico_id, periodo in periodos:
+            conn.execute(f'''
+                INSERT OR REPLACE INTO resumen_mensual (medico_id, periodo, {', '.join(self.AGREGADOS_RESUMEN_MENSUAL)})
+                SELECT ?, ?, {self._agregados_resumen_mensual()}
+                FROM transacciones
+                WHERE medico_id = ? AND substr(fecha, 1, 7) = ?
+            ''', (medico_id, periodo, medico_id, periodo))
+    
+    def recalcular_resumen_mensual(self, medico_id: str = None):
+        """Reconstruye el resumen mensual (ej: después de modificar transacciones con SQL directo)"""
+        with sqlite3.connect(self.db_path) as conn:
+            self._reconstruir_resumen_mensual(conn, medico_id)
+            conn.commit()
+    
+    def obtener_resumen_mensual(self, anio: int, medico_id: Optional[str] = 'default', hasta_mes: int = 12) -> List[Dict]:
+        """
+        Totales mensuales de un año, de enero a hasta_mes
+        
+        Args:
+            medico_id: Médico, o None para todos los médicos
+        
+        Returns:
+            Filas de resumen_mensual ordenadas por médico y periodo
+        """
+        condiciones = 'periodo >= ? AND periodo <= ?'
+        params = [f'{anio}-01', f'{anio}-{hasta_mes:02d}']
+        if medico_id is not None:
+            condiciones += ' AND medico_id = ?'
+            params.append(medico_id)
+        
+        with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.execute(f'''
+                SELECT * FROM resumen_mensual
+                WHERE {condiciones}
+                ORDER BY medico_id, periodo
+            ''', params)
+            return [dict(row) for row in cursor.fetchall()]
+    
     def guardar_transaccion(self, transaccion_data: Dict) -> int:
         """Guarda una nueva transacción"""
         with sqlite3.connect(self.db_path) as conn:
@@ -255,34 +483,238 @@ class TransaccionDB:
                 transaccion_data.get('metodo_pago', ''),
                 transaccion_data.get('forma_pago', '')
             ))
+            periodo = conn.execute(
+                'SELECT medico_id, substr(fecha, 1, 7) FROM transacciones WHERE id = ?', (cursor.lastrowid,)
+            ).fetchone()
+            self._recalcular_periodos(conn, {tuple(periodo)})
             return cursor.lastrowid
     
-    def obtener_transacciones(self, filtros: Dict = None, limite: int = 100) -> List[Dict]:
-        """Obtiene transacciones con filtros opcionales"""
-        query = 'SELECT * FROM transacciones WHERE medico_id = ?'
+    def guardar_transacciones_lote(self, transacciones: List[Dict], medico_id: str = 'default', importacion: Dict = None) -> Dict:
+        """
+        Guarda un lote de transacciones en una sola transacción de SQLite.
+        Las que traen un UUID de CFDI ya registrado (o repetido dentro del lote)
+        se cuentan como duplicadas y no se guardan.
+        
+        Args:
+            importacion: Avance de la importación en segundo plano ({'id', 'ultima_fila',
+                'procesadas', 'total_errores', 'errores'}); se guarda en la misma
+                transacción que el lote, así al reanudar no se repite ninguna fila
+        
+        Returns:
+            {'insertadas': int, 'duplicadas': int}
+        """
+        with sqlite3.connect(self.db_path) as conn:
+            uuids = list({t['cfdi_uuid'] for t in transacciones if t.get('cfdi_uuid')})
+            existentes = set()
+            # Consultar en bloques para no pasar el límite de parámetros de SQLite
+            for i in range(0, len(uuids), 500):
+                bloque = uuids[i:i + 500]
+                cursor = conn.execute(
+                    f"SELECT cfdi_uuid FROM transacciones WHERE medico_id = ? AND cfdi_uuid IN ({','.join('?' * len(bloque))})",
+                    [medico_id] + bloque
+                )
+                existentes.update(row[0] for row in cursor.fetchall())
+            
+            filas = []
+            duplicadas = 0
+            for t in transacciones:
+                uuid = t.get('cfdi_uuid')
+                if uuid:
+                    if uuid in existentes:
+                        duplicadas += 1
+                        continue
+                    existentes.add(uuid)
+                filas.append((
+                    t.get('medico_id', medico_id),
+                    t.get('tipo'),
+                    t.get('fecha'),
+                    t.get('monto'),
+                    t.get('concepto'),
+                    t.get('proveedor', ''),
+                    uuid or '',
+                    t.get('cfdi_xml_path', ''),
+                    t.get('cfdi_pdf_path', ''),
+                    t.get('cfdi_vigente', 1),
+                    t.get('clasificacion_ia', ''),
+                    t.get('deducible_porcentaje', 0),
+                    t.get('metodo_pago', ''),
+                    t.get('forma_pago', ''),
+                    t.get('notas_contador', ''),
+                    t.get('rfc_emisor'),
+                    t.get('rfc_receptor'),
+                    t.get('subtotal'),
+                    t.get('iva_trasladado'),
+                    t.get('iva_retenido'),
+                    t.get('isr_retenido')
+                ))
+            
+            conn.executemany('''
+                INSERT INTO transacciones (
+                    medico_id, tipo, fecha, monto, concepto, proveedor,
+                    cfdi_uuid, cfdi_xml_path, cfdi_pdf_path, cfdi_vigente,
+                    clasificacion_ia, deducible_porcentaje, metodo_pago, forma_pago,
+                    notas_contador, rfc_emisor, rfc_receptor, subtotal,
+                    iva_trasladado, iva_retenido, isr_retenido
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', filas)
+            
+            if filas:
+                # Las filas del lote tienen los IDs más altos (un solo escritor dentro de la transacción)
+                ultimo_id = conn.execute('SELECT MAX(id) FROM transacciones').fetchone()[0]
+                self._sumar_a_resumen_mensual(conn, ultimo_id - len(filas))
+            
+            if importacion:
+                conn.execute('''
+                    UPDATE importaciones SET
+                        ultima_fila = ?,
+                        procesadas = ?,
+                        exitosas = exitosas + ?,
+                        duplicadas = duplicadas + ?,
+                        total_errores = ?,
+                        errores = ?,
+                        fecha_actualizacion = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                ''', (
+                    importacion['ultima_fila'],
+                    importacion['procesadas'],
+                    len(filas),
+                    duplicadas,
+                    importacion['total_errores'],
+                    json.dumps(importacion['errores'], ensure_ascii=False),
+                    importacion['id']
+                ))
+            
+            conn.commit()
+            return {'insertadas': len(filas), 'duplicadas': duplicadas}
+    
+    def crear_importacion(self, importacion_data: Dict) -> int:
+        """Registra una importación de Excel/CSV o de CFDI pendiente de procesar"""
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.execute('''
+                INSERT INTO importaciones (medico_id, nombre_archivo, archivo_path, total_filas, rfc_medico)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (
+                importacion_data.get('medico_id', 'default'),
+                importacion_data.get('nombre_archivo'),
+                importacion_data.get('archivo_path'),
+                importacion_data.get('total_filas'),
+                importacion_data.get('rfc_medico')
+            ))
+            return cursor.lastrowid
+    
+    def obtener_importacion(self, importacion_id: int) -> Optional[Dict]:
+        """Obtiene una importación con su avance y errores"""
+        with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute('SELECT * FROM importaciones WHERE id = ?', (importacion_id,)).fetchone()
+        
+        if not row:
+            return None
+        importacion = dict(row)
+        importacion['errores'] = json.loads(importacion['errores']) if importacion['errores'] else []
+        return importacion
+    
+    def obtener_importaciones(self, medico_id: str = 'default', limite: int = 20) -> List[Dict]:
+        """Obtiene las importaciones más recientes (sin la lista de errores)"""
+        with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.execute('''
+                SELECT id, nombre_archivo, estado, total_filas, procesadas, exitosas, duplicadas,
+                    total_errores, mensaje_error, fecha_creacion, fecha_actualizacion, fecha_fin
+                FROM importaciones
+                WHERE medico_id = ?
+                ORDER BY id DESC
+                LIMIT ?
+            ''', (medico_id, limite))
+            return [dict(row) for row in cursor.fetchall()]
+    
+    def reclamar_importacion(self, importacion_id: int, minutos_inactiva: int = 5) -> bool:
+        """
+        Marca una importación como 'procesando' si está pendiente, con error, o
+        'procesando' sin avance en minutos_inactiva (el proceso que la llevaba se
+        cayó). Retorna False si otro proceso ya la está importando.
+        """
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.execute('''
+                UPDATE importaciones SET
+                    estado = 'procesando',
+                    mensaje_error = NULL,
+                    procesadas_al_iniciar = procesadas,
+                    fecha_inicio = CURRENT_TIMESTAMP,
+                    fecha_actualizacion = CURRENT_TIMESTAMP
+                WHERE id = ? AND (
+                    estado IN ('pendiente', 'error')
+                    OR (estado = 'procesando' AND fecha_actualizacion < datetime('now', ?))
+                )
+            ''', (importacion_id, f'-{minutos_inactiva} minutes'))
+            return cursor.rowcount > 0
+    
+    def liberar_importaciones_interrumpidas(self) -> int:
+        """
+        Regresa a 'pendiente' todas las importaciones en 'procesando'. Se llama al
+        iniciar el servidor (un solo proceso): ninguna puede seguir en curso, aunque
+        su último lote se haya guardado hace menos de minutos_inactiva.
+        """
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.execute("UPDATE importaciones SET estado = 'pendiente' WHERE estado = 'procesando'")
+            return cursor.rowcount
+    
+    def obtener_importaciones_por_reanudar(self, minutos_inactiva: int = 5) -> List[int]:
+        """IDs de importaciones pendientes o interrumpidas (sin avance en minutos_inactiva)"""
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.execute('''
+                SELECT id FROM importaciones
+                WHERE estado = 'pendiente'
+                    OR (estado = 'procesando' AND fecha_actualizacion < datetime('now', ?))
+                ORDER BY id
+            ''', (f'-{minutos_inactiva} minutes',))
+            return [row[0] for row in cursor.fetchall()]
+    
+    def finalizar_importacion(self, importacion_id: int, estado: str, mensaje_error: str = None):
+        """Marca una importación como 'completado' o 'error'"""
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute('''
+                UPDATE importaciones SET
+                    estado = ?,
+                    mensaje_error = ?,
+                    fecha_actualizacion = CURRENT_TIMESTAMP,
+                    fecha_fin = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (estado, mensaje_error, importacion_id))
+            conn.commit()
+    
+    @staticmethod
+    def _condiciones_transacciones(filtros: Dict = None) -> Tuple[str, List]:
+        """Condiciones WHERE y parámetros para los filtros de transacciones"""
+        condiciones = 'medico_id = ?'
         params = [filtros.get('medico_id', 'default') if filtros else 'default']
         
         if filtros:
             if filtros.get('tipo'):
-                query += ' AND tipo = ?'
+                condiciones += ' AND tipo = ?'
                 params.append(filtros['tipo'])
             if filtros.get('estatus_validacion'):
-                query += ' AND estatus_validacion = ?'
+                condiciones += ' AND estatus_validacion = ?'
                 params.append(filtros['estatus_validacion'])
             if filtros.get('fecha_desde'):
-                query += ' AND fecha >= ?'
+                condiciones += ' AND fecha >= ?'
                 params.append(filtros['fecha_desde'])
             if filtros.get('fecha_hasta'):
-                query += ' AND fecha <= ?'
+                condiciones += ' AND fecha <= ?'
                 params.append(filtros['fecha_hasta'])
             if filtros.get('clasificacion'):
-                query += ' AND (clasificacion_ia = ? OR clasificacion_contador = ?)'
+                condiciones += ' AND (clasificacion_ia = ? OR clasificacion_contador = ?)'
                 params.extend([filtros['clasificacion'], filtros['clasificacion']])
             if filtros.get('cfdi_uuid'):
-                query += ' AND cfdi_uuid = ?'
+                condiciones += ' AND cfdi_uuid = ?'
                 params.append(filtros['cfdi_uuid'])
         
-        query += ' ORDER BY fecha DESC LIMIT ?'
+        return condiciones, params
+    
+    def obtener_transacciones(self, filtros: Dict = None, limite: int = 100) -> List[Dict]:
+        """Obtiene transacciones con filtros opcionales"""
+        condiciones, params = self._condiciones_transacciones(filtros)
+        query = f'SELECT * FROM transacciones WHERE {condiciones} ORDER BY fecha DESC LIMIT ?'
         params.append(limite)
         
         with sqlite3.connect(self.db_path) as conn:
@@ -290,10 +722,134 @@ class TransaccionDB:
             cursor = conn.execute(query, params)
             return [dict(row) for row in cursor.fetchall()]
     
+    def _iterar_consulta(self, query: str, params: List, tamano_bloque: int) -> Iterator[Dict]:
+        """Recorre una consulta con el cursor por bloques (sin cargar todo el resultado)"""
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        try:
+            cursor = conn.execute(query, params)
+            while True:
+                filas = cursor.fetchmany(tamano_bloque)
+                if not filas:
+                    break
+                for fila in filas:
+                    yield dict(fila)
+        finally:
+            conn.close()
+    
+    def iterar_transacciones(self, filtros: Dict = None, tamano_bloque: int = 1000) -> Iterator[Dict]:
+        """
+        Recorre todas las transacciones de los filtros (sin límite) leyendo del
+        cursor por bloques, para exportaciones de cualquier tamaño
+        """
+        condiciones, params = self._condiciones_transacciones(filtros)
+        return self._iterar_consulta(
+            f'SELECT * FROM transacciones WHERE {condiciones} ORDER BY fecha DESC',
+            params,
+            tamano_bloque
+        )
+    
+    def iterar_gastos_deducibles(self, filtros: Dict = None, tamano_bloque: int = 1000) -> Iterator[Dict]:
+        """
+        Recorre los gastos aprobados con porcentaje deducible de los filtros, con
+        el monto deducible calculado en SQL
+        """
+        condiciones, params = self._condiciones_transacciones(filtros)
+        return self._iterar_consulta(f'''
+            SELECT fecha, concepto, proveedor, monto, deducible_porcentaje,
+                monto * deducible_porcentaje / 100.0 AS monto_deducible
+            FROM transacciones
+            WHERE {condiciones} AND {self.CONDICION_DEDUCIBLE}
+            ORDER BY fecha DESC
+        ''', params, tamano_bloque)
+    
+    def obtener_agregados_reporte(self, filtros: Dict = None) -> Dict:
+        """
+        Totales de las hojas Resumen y Deducibles con los mismos filtros que la hoja
+        Transacciones, en una sola consulta: agrupada por clasificación (la del
+        contador o, si no hay, la de la IA) y con los totales generales calculados
+        como funciones de ventana
+        
+        Returns:
+            {'ingresos_totales', 'gastos_totales', 'utilidad', 'deducible_total',
+             'por_clasificacion': [{'clasificacion', 'monto', 'fraccion', 'deducibles', 'monto_deducible'}]}
+            con las clasificaciones de mayor a menor monto
+        """
+        condiciones, params = self._condiciones_transacciones(filtros)
+        with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.execute(f'''
+                SELECT
+                    COALESCE(NULLIF(clasificacion_contador, ''), NULLIF(clasificacion_ia, ''), 'Sin clasificar') AS clasificacion,
+                    SUM(monto) AS monto,
+                    SUM(monto) / NULLIF(SUM(SUM(monto)) OVER (), 0) AS fraccion,
+                    SUM(CASE WHEN {self.CONDICION_DEDUCIBLE} THEN 1 ELSE 0 END) AS deducibles,
+                    SUM(CASE WHEN {self.CONDICION_DEDUCIBLE} THEN monto * deducible_porcentaje / 100.0 ELSE 0 END) AS monto_deducible,
+                    SUM(SUM(CASE WHEN tipo = 'ingreso' THEN monto ELSE 0 END)) OVER () AS ingresos_totales,
+                    SUM(SUM(CASE WHEN tipo = 'gasto' THEN monto ELSE 0 END)) OVER () AS gastos_totales,
+                    SUM(SUM(CASE WHEN {self.CONDICION_DEDUCIBLE} THEN monto * deducible_porcentaje / 100.0 ELSE 0 END)) OVER () AS deducible_total
+                FROM transacciones
+                WHERE {condiciones}
+                GROUP BY 1
+                ORDER BY monto DESC
+            ''', params)
+            filas = [dict(row) for row in cursor.fetchall()]
+        
+        # Los totales generales vienen repetidos en cada fila
+        totales = filas[0] if filas else {}
+        ingresos = totales.get('ingresos_totales', 0.0)
+        gastos = totales.get('gastos_totales', 0.0)
+        return {
+            'ingresos_totales': ingresos,
+            'gastos_totales': gastos,
+            'utilidad': ingresos - gastos,
+            'deducible_total': totales.get('deducible_total', 0.0),
+            'por_clasificacion': [
+                {clave: fila[clave] for clave in ('clasificacion', 'monto', 'fraccion', 'deducibles', 'monto_deducible')}
+                for fila in filas
+            ]
+        }
+    
     def validar_transaccion(self, transaccion_id: int, validacion_data: Dict) -> bool:
         """Valida una transacción (aprueba, rechaza o ajusta)"""
+        resultado = self.validar_transacciones_lote([{**validacion_data, 'id': transaccion_id}])
+        return resultado['actualizadas'] > 0
+    
+    def obtener_tipos_transacciones(self, transaccion_ids: List[int]) -> Dict[int, str]:
+        """Tipo ('ingreso'/'gasto') de cada transacción existente {id: tipo}"""
+        tipos = {}
         with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.execute('''
+            for inicio in range(0, len(transaccion_ids), 500):
+                bloque = transaccion_ids[inicio:inicio + 500]
+                marcadores = ','.join('?' * len(bloque))
+                cursor = conn.execute(f'SELECT id, tipo FROM transacciones WHERE id IN ({marcadores})', bloque)
+                tipos.update(cursor.fetchall())
+        return tipos
+    
+    def validar_transacciones_lote(self, validaciones: List[Dict], medico_id: str = 'default') -> Dict:
+        """
+        Valida muchas transacciones en una sola transacción de SQLite (executemany) y
+        aprende las reglas de las aprobadas en lote
+        
+        Args:
+            validaciones: Lista de {'id', 'estatus', 'clasificacion', 'deducible_porcentaje', 'notas', 'validado_por'}
+            medico_id: Médico cuyas transacciones pendientes se cuentan al final
+        
+        Returns:
+            {'actualizadas': int, 'reglas_aprendidas': int, 'pendientes_validacion': int}
+        """
+        filas = [(
+            v.get('estatus', 'aprobado'),
+            v.get('clasificacion', ''),
+            v.get('deducible_porcentaje', 0),
+            v.get('notas', ''),
+            v.get('validado_por', 'contador'),
+            v['id']
+        ) for v in validaciones]
+        
+        with sqlite3.connect(self.db_path) as conn:
+            antes = conn.total_changes
+            conn.executemany('''
                 UPDATE transacciones 
                 SET estatus_validacion = ?,
                     clasificacion_contador = ?,
@@ -303,110 +859,250 @@ class TransaccionDB:
                     validado_at = CURRENT_TIMESTAMP,
                     updated_at = CURRENT_TIMESTAMP
                 WHERE id = ?
-            ''', (
-                validacion_data.get('estatus', 'aprobado'),
-                validacion_data.get('clasificacion', ''),
-                validacion_data.get('deducible_porcentaje', 0),
-                validacion_data.get('notas', ''),
-                validacion_data.get('validado_por', 'contador'),
-                transaccion_id
-            ))
-            
-            # Si se aprueba, aprender la regla
-            if validacion_data.get('estatus') == 'aprobado' and validacion_data.get('clasificacion'):
-                self._aprender_regla(transaccion_id, validacion_data)
-            
-            return cursor.rowcount > 0
-    
-    def _aprender_regla(self, transaccion_id: int, validacion_data: Dict):
-        """Aprende una regla de clasificación basada en la validación del contador"""
-        with sqlite3.connect(self.db_path) as conn:
-            # Obtener la transacción
-            cursor = conn.execute('SELECT concepto, proveedor, medico_id FROM transacciones WHERE id = ?', (transaccion_id,))
-            trans = cursor.fetchone()
-            if not trans:
-                return
-            
-            concepto, proveedor, medico_id = trans
+            ''', filas)
+            actualizadas = conn.total_changes - antes
             
-            # Verificar si ya existe una regla similar
-            cursor = conn.execute('''
-                SELECT id, frecuencia_uso FROM reglas_clasificacion 
-                WHERE medico_id = ? AND patron_concepto = ? AND proveedor = ?
-            ''', (medico_id, concepto, proveedor or ''))
+            # Recalcular el resumen de los meses de las transacciones validadas
+            periodos = set()
+            ids = [v['id'] for v in validaciones]
+            for inicio in range(0, len(ids), 500):
+                bloque = ids[inicio:inicio + 500]
+                cursor = conn.execute(
+                    f"SELECT DISTINCT medico_id, substr(fecha, 1, 7) FROM transacciones WHERE id IN ({','.join('?' * len(bloque))})",
+                    bloque
+                )
+                periodos.update(cursor.fetchall())
+            self._recalcular_periodos(conn, periodos)
             
-            regla_existente = cursor.fetchone()
+            # Si se aprueba, aprender la regla (en la misma transacción)
+            aprobadas = [v for v in validaciones if v.get('estatus', 'aprobado') == 'aprobado' and v.get('clasificacion')]
+            aprendidas = self._aprender_reglas(conn, aprobadas) if aprobadas else []
+            conn.commit()
             
-            if regla_existente:
-                # Incrementar frecuencia
-                conn.execute('''
-                    UPDATE reglas_clasificacion 
-                    SET frecuencia_uso = frecuencia_uso + 1,
-                        clasificacion = ?,
-                        deducible_porcentaje = ?,
-                        updated_at = CURRENT_TIMESTAMP
-                    WHERE id = ?
-                ''', (validacion_data['clasificacion'], validacion_data.get('deducible_porcentaje', 0), regla_existente[0]))
+            pendientes = conn.execute(
+                "SELECT COUNT(*) FROM transacciones WHERE medico_id = ? AND estatus_validacion = 'pendiente'",
+                (medico_id,)
+            ).fetchone()[0]
+        
+        if aprendidas:
+            self._actualizar_aprendizaje_en_memoria(aprendidas)
+        
+        return {
+            'actualizadas': actualizadas,
+            'reglas_aprendidas': len({(a['medico_id'], a['concepto'], a['proveedor']) for a in aprendidas}),
+            'pendientes_validacion': pendientes
+        }
+    
+    def _aprender_reglas(self, conn, aprobadas: List[Dict]) -> List[Dict]:
+        """
+        Aprende las reglas de clasificación de un lote de validaciones aprobadas: una
+        regla por (médico, concepto, proveedor), sumando a frecuencia_uso las veces
+        que aparece en el lote. No hace commit.
+        
+        Returns:
+            Ejemplos aprendidos [{'medico_id', 'concepto', 'proveedor', 'clasificacion'}]
+        """
+        # Concepto, proveedor y médico de las transacciones aprobadas
+        por_id = {v['id']: v for v in aprobadas}
+        ids = list(por_id)
+        transacciones = []
+        for inicio in range(0, len(ids), 500):
+            bloque = ids[inicio:inicio + 500]
+            marcadores = ','.join('?' * len(bloque))
+            cursor = conn.execute(
+                f'SELECT id, concepto, proveedor, medico_id FROM transacciones WHERE id IN ({marcadores})', bloque
+            )
+            transacciones.extend(cursor.fetchall())
+        
+        # Agrupar por regla: la última validación del lote define la clasificación
+        aprendidas = []
+        reglas: Dict[tuple, Dict] = {}
+        for transaccion_id, concepto, proveedor, medico_id in transacciones:
+            validacion = por_id[transaccion_id]
+            clave = (medico_id, concepto, proveedor or '')
+            regla = reglas.setdefault(clave, {'veces': 0})
+            regla['veces'] += 1
+            regla['clasificacion'] = validacion['clasificacion']
+            regla['deducible_porcentaje'] = validacion.get('deducible_porcentaje', 0)
+            aprendidas.append({
+                'medico_id': medico_id,
+                'concepto': concepto,
+                'proveedor': proveedor or '',
+                'clasificacion': validacion['clasificacion']
+            })
+        
+        # Reglas que ya existen
+        existentes = {}
+        for medico_id in {clave[0] for clave in reglas}:
+            conceptos = list({clave[1] for clave in reglas if clave[0] == medico_id})
+            for inicio in range(0, len(conceptos), 500):
+                bloque = conceptos[inicio:inicio + 500]
+                marcadores = ','.join('?' * len(bloque))
+                cursor = conn.execute(f'''
+                    SELECT id, patron_concepto, proveedor FROM reglas_clasificacion
+                    WHERE medico_id = ? AND patron_concepto IN ({marcadores})
+                ''', [medico_id] + bloque)
+                for regla_id, patron, proveedor in cursor.fetchall():
+                    existentes[(medico_id, patron, proveedor or '')] = regla_id
+        
+        # Incrementar frecuencia de las existentes y crear las nuevas
+        conn.executemany('''
+            UPDATE reglas_clasificacion 
+            SET frecuencia_uso = frecuencia_uso + ?,
+                clasificacion = ?,
+                deducible_porcentaje = ?,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', [
+            (regla['veces'], regla['clasificacion'], regla['deducible_porcentaje'], existentes[clave])
+            for clave, regla in reglas.items() if clave in existentes
+        ])
+        conn.executemany('''
+            INSERT INTO reglas_clasificacion (
+                medico_id, patron_concepto, proveedor, clasificacion, deducible_porcentaje, frecuencia_uso
+            ) VALUES (?, ?, ?, ?, ?, ?)
+        ''', [
+            (clave[0], clave[1], clave[2], regla['clasificacion'], regla['deducible_porcentaje'], regla['veces'])
+            for clave, regla in reglas.items() if clave not in existentes
+        ])
+        
+        return aprendidas
+    
+    def _actualizar_aprendizaje_en_memoria(self, aprendidas: List[Dict]):
+        """Actualiza los índices de reglas y clasificadores ya cargados con lo aprendido en un lote"""
+        with self._reglas_lock:
+            for medico_id in {a['medico_id'] for a in aprendidas}:
+                del_medico = [a for a in aprendidas if a['medico_id'] == medico_id]
+                
+                # Releer solo las reglas afectadas
+                indice = self._indices_reglas.get(medico_id)
+                if indice is not None:
+                    conceptos = list({a['concepto'] for a in del_medico})
+                    claves = {(a['concepto'], a['proveedor']) for a in del_medico}
+                    with sqlite3.connect(self.db_path) as conn:
+                        conn.row_factory = sqlite3.Row
+                        for inicio in range(0, len(conceptos), 500):
+                            bloque = conceptos[inicio:inicio + 500]
+                            marcadores = ','.join('?' * len(bloque))
+                            cursor = conn.execute(f'''
+                                SELECT id, patron_concepto, proveedor, clasificacion, deducible_porcentaje, frecuencia_uso
+                                FROM reglas_clasificacion
+                                WHERE medico_id = ? AND patron_concepto IN ({marcadores})
+                            ''', [medico_id] + bloque)
+                            for regla in cursor:
+                                if (regla['patron_concepto'], regla['proveedor'] or '') in claves:
+                                    indice.registrar(dict(regla))
+                
+                # Las validaciones también son ejemplos para el clasificador
+                clasificador = self._clasificadores.get(medico_id)
+                if clasificador is not None:
+                    clasificador.entrenar((a['concepto'], a['proveedor'], a['clasificacion'], 1.0) for a in del_medico)
+    
+    def _indice_reglas(self, medico_id: str) -> IndiceReglas:
+        """Índice de reglas de un médico (lo carga de la base de datos la primera vez)"""
+        with self._reglas_lock:
+            indice = self._indices_reglas.get(medico_id)
+            if indice is None:
+                with sqlite3.connect(self.db_path) as conn:
+                    conn.row_factory = sqlite3.Row
+                    cursor = conn.execute('''
+                        SELECT id, patron_concepto, proveedor, clasificacion, deducible_porcentaje, frecuencia_uso
+                        FROM reglas_clasificacion
+                        WHERE medico_id = ?
+                    ''', (medico_id,))
+                    indice = IndiceReglas(dict(row) for row in cursor)
+                self._indices_reglas[medico_id] = indice
+            return indice
+    
+    def _clasificador(self, medico_id: str) -> ClasificadorTransacciones:
+        """
+        Clasificador de un médico, entrenado la primera vez con sus transacciones
+        aprobadas y sus reglas de clasificación
+        """
+        with self._reglas_lock:
+            clasificador = self._clasificadores.get(medico_id)
+            if clasificador is None:
+                clasificador = ClasificadorTransacciones()
+                ejemplos = self._iterar_consulta('''
+                    SELECT concepto, proveedor, clasificacion_contador AS clasificacion
+                    FROM transacciones
+                    WHERE medico_id = ? AND estatus_validacion = 'aprobado' AND clasificacion_contador <> ''
+                    UNION ALL
+                    SELECT patron_concepto, proveedor, clasificacion
+                    FROM reglas_clasificacion
+                    WHERE medico_id = ?
+                ''', [medico_id, medico_id], 1000)
+                clasificador.entrenar(
+                    (e['concepto'], e['proveedor'] or '', e['clasificacion'], 1.0) for e in ejemplos
+                )
+                self._clasificadores[medico_id] = clasificador
+            return clasificador
+    
+    def recargar_reglas(self, medico_id: str = None):
+        """
+        Descarta los índices de reglas y clasificadores en memoria (ej: tras editar
+        reglas_clasificacion con SQL)
+        """
+        with self._reglas_lock:
+            if medico_id is None:
+                self._indices_reglas.clear()
+                self._clasificadores.clear()
             else:
-                # Crear nueva regla
-                conn.execute('''
-                    INSERT INTO reglas_clasificacion (
-                        medico_id, patron_concepto, proveedor, clasificacion, deducible_porcentaje
-                    ) VALUES (?, ?, ?, ?, ?)
-                ''', (medico_id, concepto, proveedor or '', validacion_data['clasificacion'], validacion_data.get('deducible_porcentaje', 0)))
-            
-            conn.commit()
+                self._indices_reglas.pop(medico_id, None)
+                self._clasificadores.pop(medico_id, None)
     
-    def clasificar_con_ia(self, concepto: str, proveedor: str = '', medico_id: str = 'default') -> Dict:
-        """Clasifica una transacción usando reglas aprendidas"""
-        with sqlite3.connect(self.db_path) as conn:
-            # Buscar regla exacta
-            cursor = conn.execute('''
-                SELECT clasificacion, deducible_porcentaje, frecuencia_uso
-                FROM reglas_clasificacion 
-                WHERE medico_id = ? AND patron_concepto = ? AND proveedor = ?
-                ORDER BY frecuencia_uso DESC
-                LIMIT 1
-            ''', (medico_id, concepto, proveedor))
-            
-            regla = cursor.fetchone()
-            
-            if regla:
-                return {
-                    'clasificacion': regla[0],
-                    'deducible_porcentaje': regla[1],
-                    'confianza': 'alta',
-                    'metodo': 'regla_aprendida'
-                }
-            
-            # Buscar regla por similitud de concepto
-            cursor = conn.execute('''
-                SELECT clasificacion, deducible_porcentaje, frecuencia_uso
-                FROM reglas_clasificacion 
-                WHERE medico_id = ? AND (
-                    patron_concepto LIKE ? OR ? LIKE patron_concepto
+    def clasificar_con_ia(self, concepto: str, proveedor: str = '', medico_id: str = 'default', tipo: str = None) -> Dict:
+        """
+        Clasifica una transacción usando reglas aprendidas (índice en memoria, sin
+        consultas) y, si ninguna aplica, el clasificador entrenado con las validaciones
+        """
+        return self.clasificar_lote([(concepto, proveedor, tipo)], medico_id)[0]
+    
+    def clasificar_lote(self, transacciones: List[Tuple[str, str, Optional[str]]], medico_id: str = 'default') -> List[Dict]:
+        """
+        Clasifica un lote de transacciones: primero con las reglas aprendidas y las
+        restantes con el clasificador en una sola operación matricial
+        
+        Args:
+            transacciones: Lista de (concepto, proveedor, tipo o None)
+        
+        Returns:
+            Por transacción, {'clasificacion', 'deducible_porcentaje', 'confianza', 'metodo'}
+        """
+        indice = self._indice_reglas(medico_id)
+        resultados: List[Optional[Dict]] = []
+        with self._reglas_lock:
+            for concepto, proveedor, _ in transacciones:
+                encontrada = indice.buscar(concepto, proveedor)
+                if encontrada:
+                    regla = encontrada['regla']
+                    resultados.append({
+                        'clasificacion': regla['clasificacion'],
+                        'deducible_porcentaje': regla['deducible_porcentaje'],
+                        'confianza': 'alta' if encontrada['metodo'] == 'regla_aprendida' else 'media',
+                        'metodo': encontrada['metodo']
+                    })
+                else:
+                    resultados.append(None)
+        
+        pendientes = [i for i, resultado in enumerate(resultados) if resultado is None]
+        if pendientes:
+            clasificador = self._clasificador(medico_id)
+            with self._reglas_lock:
+                predicciones = clasificador.predecir_lote(
+                    [(transacciones[i][0], transacciones[i][1]) for i in pendientes],
+                    [transacciones[i][2] for i in pendientes]
                 )
-                ORDER BY frecuencia_uso DESC
-                LIMIT 1
-            ''', (medico_id, f'%{concepto}%', f'%{concepto}%'))
-            
-            regla_similar = cursor.fetchone()
-            
-            if regla_similar:
-                return {
-                    'clasificacion': regla_similar[0],
-                    'deducible_porcentaje': regla_similar[1],
-                    'confianza': 'media',
-                    'metodo': 'similitud'
+            for i, prediccion in zip(pendientes, predicciones):
+                # Sin regla ni predicción confiable, usar clasificación por defecto
+                resultados[i] = resultado_modelo(prediccion) or {
+                    'clasificacion': 'Sin clasificar',
+                    'deducible_porcentaje': 0,
+                    'confianza': 'baja',
+                    'metodo': 'default'
                 }
-            
-            # Sin regla, usar clasificación por defecto
-            return {
-                'clasificacion': 'Sin clasificar',
-                'deducible_porcentaje': 0,
-                'confianza': 'baja',
-                'metodo': 'default'
-            }
+        
+        return resultados
     
     def obtener_estadisticas_financieras(self, medico_id: str = 'default', fecha_desde: str = None, fecha_hasta: str = None) -> Dict:
         """Obtiene estadísticas financieras para el dashboard del contador"""
@@ -455,8 +1151,17 @@ class TransaccionDB:
 class SeguroDB:
     """Gestión de datos de seguros médicos (credenciales, tabuladores, informes)"""
     
+    # Columnas de tabuladores sin el texto completo (para la caché de metadatos)
+    COLUMNAS_METADATA_TABULADOR = (
+        'id', 'aseguradora', 'plan_nombre', 'tipo_documento', 'archivo_path',
+        'archivo_hash', 'fecha_vigencia', 'fecha_carga', 'activo'
+    )
+    
     def __init__(self, db_path: str = "consultas.db"):
         self.db_path = db_path
+        # Caché en proceso de metadatos de tabuladores {id: dict}
+        self._cache_tabuladores: Dict[int, Dict] = {}
+        self._cache_lock = threading.Lock()
         self.init_database()
     
     def init_database(self):
@@ -535,15 +1240,119 @@ class SeguroDB:
                 )
             ''')
             
+            # Catálogo de planes (deducible, coaseguro, hospitales) por aseguradora
+            # plan_nombre vacío = valores por defecto de la aseguradora
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS planes_seguro (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    aseguradora TEXT NOT NULL,
+                    plan_nombre TEXT NOT NULL DEFAULT '',
+                    plan_normalizado TEXT NOT NULL DEFAULT '',
+                    deducible_estimado REAL,
+                    coaseguro_porcentaje REAL,
+                    hospitales_red TEXT,
+                    fuente_tabulador_id INTEGER,
+                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    UNIQUE(aseguradora, plan_normalizado),
+                    FOREIGN KEY (fuente_tabulador_id) REFERENCES tabuladores(id)
+                )
+            ''')
+            
+            # Cargas de varias credenciales a la vez (OCR en segundo plano) y el estado de cada imagen
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS lotes_credenciales (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    medico_id TEXT DEFAULT 'default',
+                    total INTEGER NOT NULL,
+                    fecha_creacion DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS lote_credenciales_items (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    lote_id INTEGER NOT NULL,
+                    indice INTEGER NOT NULL,
+                    nombre_archivo TEXT,
+                    estado TEXT DEFAULT 'pendiente' CHECK(estado IN ('pendiente', 'procesando', 'completado', 'error')),
+                    credencial_id INTEGER,
+                    resultado TEXT,
+                    error TEXT,
+                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (lote_id) REFERENCES lotes_credenciales(id),
+                    FOREIGN KEY (credencial_id) REFERENCES credenciales_seguros(id)
+                )
+            ''')
+            
+            # Cláusulas/secciones de las condiciones generales, clasificadas por tema
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS secciones_condiciones (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    tabulador_id INTEGER NOT NULL,
+                    orden INTEGER NOT NULL,
+                    numero TEXT,
+                    titulo TEXT,
+                    temas TEXT,
+                    texto TEXT NOT NULL,
+                    FOREIGN KEY (tabulador_id) REFERENCES tabuladores(id)
+                )
+            ''')
+            
+            # Caché de veredictos de cobertura por documento de condiciones generales (archivo_hash)
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS coberturas_cache (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    archivo_hash TEXT NOT NULL,
+                    plan_normalizado TEXT NOT NULL DEFAULT '',
+                    procedimiento_normalizado TEXT NOT NULL,
+                    procedimiento TEXT,
+                    resultado TEXT NOT NULL,
+                    fuente_tabulador_id INTEGER,
+                    fecha_consulta DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    UNIQUE(archivo_hash, plan_normalizado, procedimiento_normalizado),
+                    FOREIGN KEY (fuente_tabulador_id) REFERENCES tabuladores(id)
+                )
+            ''')
+            
+            # Versión del contexto con que se obtuvo cada veredicto: los de otra versión
+            # (ej: los primeros 5000 caracteres, antes de elegir secciones) no se reutilizan
+            _agregar_columna_si_falta(conn, 'coberturas_cache', 'version_contexto', 'INTEGER NOT NULL DEFAULT 1')
+            conn.execute('DELETE FROM coberturas_cache WHERE version_contexto != ?', (VERSION_CONTEXTO_COBERTURA,))
+            
+            # Columnas para reutilizar respuestas previas (memoización de honorarios)
+            _agregar_columna_si_falta(conn, 'consultas_honorarios', 'procedimiento_normalizado', 'TEXT')
+            _agregar_columna_si_falta(conn, 'consultas_honorarios', 'descripcion', 'TEXT')
+            _agregar_columna_si_falta(conn, 'consultas_honorarios', 'confianza', 'TEXT')
+            
+            # Métricas del OCR de credenciales (ahorro de bytes por preprocesamiento y latencia)
+            _agregar_columna_si_falta(conn, 'credenciales_seguros', 'ocr_bytes_original', 'INTEGER')
+            _agregar_columna_si_falta(conn, 'credenciales_seguros', 'ocr_bytes_enviados', 'INTEGER')
+            _agregar_columna_si_falta(conn, 'credenciales_seguros', 'ocr_ms', 'INTEGER')
+            
+            # SHA-256 de la foto para reutilizar el OCR de credenciales repetidas
+            _agregar_columna_si_falta(conn, 'credenciales_seguros', 'imagen_hash', 'TEXT')
+            # Los hashes perceptuales anteriores (16 caracteres) daban la credencial de otro paciente
+            conn.execute("UPDATE credenciales_seguros SET imagen_hash = NULL WHERE length(imagen_hash) != 64")
+            
             # Índices
             conn.execute('CREATE INDEX IF NOT EXISTS idx_credencial_aseguradora ON credenciales_seguros(aseguradora)')
             conn.execute('CREATE INDEX IF NOT EXISTS idx_credencial_poliza ON credenciales_seguros(numero_poliza)')
             conn.execute('CREATE INDEX IF NOT EXISTS idx_credencial_paciente ON credenciales_seguros(paciente_id)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_credencial_imagen_hash ON credenciales_seguros(imagen_hash)')
             conn.execute('CREATE INDEX IF NOT EXISTS idx_tabulador_aseguradora ON tabuladores(aseguradora)')
             conn.execute('CREATE INDEX IF NOT EXISTS idx_tabulador_activo ON tabuladores(activo)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_tabulador_hash ON tabuladores(archivo_hash)')
             conn.execute('CREATE INDEX IF NOT EXISTS idx_informe_consulta ON informes_medicos(consulta_id)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_seccion_condiciones ON secciones_condiciones(tabulador_id, orden)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_lote_credenciales_item ON lote_credenciales_items(lote_id, indice)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_honorario_tabulador_proc ON consultas_honorarios(fuente_tabulador_id, procedimiento_normalizado)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_honorario_tabulador_cpt ON consultas_honorarios(fuente_tabulador_id, codigo_cpt)')
             
             conn.commit()
+        
+        # Planes conocidos (no sobreescribe los que ya estén en el catálogo)
+        for plan in PLANES_PREDEFINIDOS:
+            self.guardar_plan(plan, sobreescribir=False)
     
     def guardar_credencial(self, credencial_data: Dict) -> int:
         """Guarda una credencial de seguro procesada"""
@@ -553,8 +1362,9 @@ class SeguroDB:
                     medico_id, paciente_id, paciente_nombre,
                     aseguradora, numero_poliza, plan_nombre, nivel_hospitalario,
                     deducible_estimado, coaseguro_porcentaje, hospitales_red,
-                    imagen_path, datos_extractos
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    imagen_path, datos_extractos,
+                    ocr_bytes_original, ocr_bytes_enviados, ocr_ms, imagen_hash
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''', (
                 credencial_data.get('medico_id', 'default'),
                 credencial_data.get('paciente_id'),
@@ -567,10 +1377,25 @@ class SeguroDB:
                 credencial_data.get('coaseguro_porcentaje'),
                 credencial_data.get('hospitales_red', ''),
                 credencial_data.get('imagen_path', ''),
-                credencial_data.get('datos_extractos', '')
+                credencial_data.get('datos_extractos', ''),
+                credencial_data.get('ocr_bytes_original'),
+                credencial_data.get('ocr_bytes_enviados'),
+                credencial_data.get('ocr_ms'),
+                credencial_data.get('imagen_hash')
             ))
             return cursor.lastrowid
     
+    def buscar_credencial_por_hash(self, imagen_hash: str) -> Optional[Dict]:
+        """Busca la credencial más reciente procesada con una foto idéntica (mismo SHA-256)"""
+        with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.execute(
+                'SELECT * FROM credenciales_seguros WHERE imagen_hash = ? ORDER BY id DESC LIMIT 1',
+                (imagen_hash,)
+            )
+            row = cursor.fetchone()
+            return dict(row) if row else None
+    
     def obtener_credencial(self, credencial_id: int) -> Optional[Dict]:
         """Obtiene una credencial por ID"""
         with sqlite3.connect(self.db_path) as conn:
@@ -579,6 +1404,84 @@ class SeguroDB:
             row = cursor.fetchone()
             return dict(row) if row else None
     
+    def crear_lote_credenciales(self, nombres_archivo: List[str], medico_id: str = 'default') -> Dict:
+        """
+        Registra una carga de varias credenciales con todas sus imágenes en 'pendiente'
+        
+        Returns:
+            {'lote_id': int, 'item_ids': [int, ...]} en el orden de nombres_archivo
+        """
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.execute(
+                'INSERT INTO lotes_credenciales (medico_id, total) VALUES (?, ?)',
+                (medico_id, len(nombres_archivo))
+            )
+            lote_id = cursor.lastrowid
+            
+            item_ids = []
+            for indice, nombre in enumerate(nombres_archivo):
+                cursor = conn.execute(
+                    'INSERT INTO lote_credenciales_items (lote_id, indice, nombre_archivo) VALUES (?, ?, ?)',
+                    (lote_id, indice, nombre)
+                )
+                item_ids.append(cursor.lastrowid)
+            conn.commit()
+            return {'lote_id': lote_id, 'item_ids': item_ids}
+    
+    def actualizar_item_lote_credenciales(self, item_id: int, estado: str, credencial_id: int = None,
+                                          resultado: Dict = None, error: str = None):
+        """Actualiza el estado de una imagen de una carga de credenciales"""
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute('''
+                UPDATE lote_credenciales_items
+                SET estado = ?, credencial_id = ?, resultado = ?, error = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (
+                estado,
+                credencial_id,
+                json.dumps(resultado, ensure_ascii=False) if resultado is not None else None,
+                error,
+                item_id
+            ))
+            conn.commit()
+    
+    def cerrar_lotes_credenciales_interrumpidos(self) -> int:
+        """
+        Marca como 'error' las imágenes en 'pendiente' o 'procesando'. Se llama al
+        iniciar el servidor: las imágenes en cola solo vivían en memoria del pool de OCR.
+        """
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.execute('''
+                UPDATE lote_credenciales_items
+                SET estado = 'error', error = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE estado IN ('pendiente', 'procesando')
+            ''', ('El servidor se reinició antes de procesar la imagen; vuelve a subirla.',))
+            return cursor.rowcount
+    
+    def obtener_lote_credenciales(self, lote_id: int) -> Optional[Dict]:
+        """Obtiene una carga de credenciales con el estado y resultado de cada imagen"""
+        with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            lote = conn.execute('SELECT * FROM lotes_credenciales WHERE id = ?', (lote_id,)).fetchone()
+            if not lote:
+                return None
+            
+            cursor = conn.execute('''
+                SELECT indice, nombre_archivo, estado, credencial_id, resultado, error, updated_at
+                FROM lote_credenciales_items
+                WHERE lote_id = ?
+                ORDER BY indice
+            ''', (lote_id,))
+            items = []
+            for row in cursor.fetchall():
+                item = dict(row)
+                item['resultado'] = json.loads(item['resultado']) if item['resultado'] else None
+                items.append(item)
+        
+        lote = dict(lote)
+        lote['items'] = items
+        return lote
+    
     def obtener_credenciales(self, medico_id: str = 'default', limite: int = 50) -> List[Dict]:
         """Obtiene las credenciales más recientes"""
         with sqlite3.connect(self.db_path) as conn:
@@ -610,7 +1513,76 @@ class SeguroDB:
                 tabulador_data.get('contenido_texto', ''),
                 tabulador_data.get('contenido_embedding', '')
             ))
-            return cursor.lastrowid
+            tabulador_id = cursor.lastrowid
+        
+        self._invalidar_cache_tabuladores()
+        return tabulador_id
+    
+    def obtener_tabulador(self, tabulador_id: int, solo_activos: bool = True) -> Optional[Dict]:
+        """
+        Obtiene un tabulador por ID (con texto completo) usando la llave primaria.
+        Los desactivados solo se regresan con solo_activos=False.
+        """
+        condicion = ' AND activo = 1' if solo_activos else ''
+        with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.execute(f'SELECT * FROM tabuladores WHERE id = ?{condicion}', (tabulador_id,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+    
+    def obtener_tabulador_metadata(self, tabulador_id: int, solo_activos: bool = True) -> Optional[Dict]:
+        """
+        Obtiene los metadatos de un tabulador (sin contenido_texto).
+        Lee a través de una caché en proceso que se invalida al insertar,
+        desactivar o cambiar la activación de un tabulador. Los desactivados
+        solo se regresan con solo_activos=False.
+        """
+        with self._cache_lock:
+            metadata = self._cache_tabuladores.get(tabulador_id)
+        if metadata is not None:
+            return dict(metadata) if metadata['activo'] or not solo_activos else None
+        
+        columnas = ', '.join(self.COLUMNAS_METADATA_TABULADOR)
+        with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.execute(f'SELECT {columnas} FROM tabuladores WHERE id = ?', (tabulador_id,))
+            row = cursor.fetchone()
+        
+        if not row:
+            return None
+        
+        metadata = dict(row)
+        with self._cache_lock:
+            self._cache_tabuladores[tabulador_id] = metadata
+        return dict(metadata) if metadata['activo'] or not solo_activos else None
+    
+    def actualizar_activo_tabulador(self, tabulador_id: int, activo: bool) -> bool:
+        """Activa o desactiva un tabulador. Retorna False si no existe"""
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.execute('''
+                UPDATE tabuladores
+                SET activo = ?
+                WHERE id = ?
+            ''', (1 if activo else 0, tabulador_id))
+            actualizado = cursor.rowcount > 0
+        
+        if actualizado:
+            self._invalidar_cache_tabuladores(tabulador_id)
+            if not activo:
+                self.purgar_coberturas_cache()
+        return actualizado
+    
+    def desactivar_tabulador(self, tabulador_id: int) -> bool:
+        """Desactiva un tabulador (soft delete)"""
+        return self.actualizar_activo_tabulador(tabulador_id, False)
+    
+    def _invalidar_cache_tabuladores(self, tabulador_id: int = None):
+        """Invalida la caché de metadatos de tabuladores (una entrada o completa)"""
+        with self._cache_lock:
+            if tabulador_id is None:
+                self._cache_tabuladores.clear()
+            else:
+                self._cache_tabuladores.pop(tabulador_id, None)
     
     def obtener_tabuladores(self, aseguradora: str = None, activo: bool = True) -> List[Dict]:
         """Obtiene tabuladores, filtrados opcionalmente por aseguradora"""
@@ -627,6 +1599,244 @@ class SeguroDB:
             cursor = conn.execute(query, params)
             return [dict(row) for row in cursor.fetchall()]
     
+    def obtener_tabulador_vigente(self, aseguradora: str) -> Optional[Dict]:
+        """Documento activo más reciente de la aseguradora (con texto completo)"""
+        with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.execute('''
+                SELECT * FROM tabuladores
+                WHERE activo = 1 AND aseguradora = ?
+                ORDER BY fecha_carga DESC, id DESC
+                LIMIT 1
+            ''', (aseguradora,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+    
+    def buscar_tabulador_por_hash(self, archivo_hash: str) -> Optional[Dict]:
+        """Metadatos (sin contenido_texto) del documento activo con ese hash de archivo"""
+        columnas = ', '.join(self.COLUMNAS_METADATA_TABULADOR)
+        with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.execute(
+                f'SELECT {columnas} FROM tabuladores WHERE archivo_hash = ? AND activo = 1 LIMIT 1',
+                (archivo_hash,)
+            )
+            row = cursor.fetchone()
+            return dict(row) if row else None
+    
+    def obtener_condiciones_vigentes(self, aseguradora: str) -> Optional[Dict]:
+        """
+        Metadatos (sin contenido_texto) del documento de condiciones generales
+        activo más reciente de la aseguradora
+        """
+        columnas = ', '.join(self.COLUMNAS_METADATA_TABULADOR)
+        with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.execute(f'''
+                SELECT {columnas} FROM tabuladores
+                WHERE activo = 1 AND aseguradora = ? AND tipo_documento = 'condiciones_generales'
+                ORDER BY fecha_carga DESC, id DESC
+                LIMIT 1
+            ''', (aseguradora,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+    
+    def guardar_secciones_condiciones(self, tabulador_id: int, secciones: List[Dict]) -> int:
+        """Guarda (reemplazando las anteriores) las secciones de unas condiciones generales"""
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute('DELETE FROM secciones_condiciones WHERE tabulador_id = ?', (tabulador_id,))
+            conn.executemany('''
+                INSERT INTO secciones_condiciones (tabulador_id, orden, numero, titulo, temas, texto)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', [
+                (
+                    tabulador_id,
+                    seccion['orden'],
+                    seccion.get('numero', ''),
+                    seccion.get('titulo', ''),
+                    ','.join(seccion.get('temas', [])),
+                    seccion['texto']
+                )
+                for seccion in secciones
+            ])
+            conn.commit()
+        return len(secciones)
+    
+    def obtener_secciones_condiciones(self, tabulador_id: int, tema: str = None) -> List[Dict]:
+        """Obtiene las secciones de unas condiciones generales, opcionalmente solo las de un tema"""
+        with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.execute('''
+                SELECT orden, numero, titulo, temas, texto FROM secciones_condiciones
+                WHERE tabulador_id = ?
+                ORDER BY orden
+            ''', (tabulador_id,))
+            secciones = []
+            for row in cursor.fetchall():
+                seccion = dict(row)
+                seccion['temas'] = seccion['temas'].split(',') if seccion['temas'] else []
+                if tema is None or tema in seccion['temas']:
+                    secciones.append(seccion)
+            return secciones
+    
+    def buscar_cobertura_en_cache(self, archivo_hash: str, plan_normalizado: str, procedimiento_normalizado: str) -> Optional[Dict]:
+        """
+        Busca un veredicto de cobertura previo para el mismo documento de condiciones
+        generales y la misma versión de contexto (VERSION_CONTEXTO_COBERTURA). Solo se
+        consideran documentos activos: al desactivar el documento o cargar uno nuevo
+        (otro archivo_hash) las entradas dejan de usarse.
+        """
+        if not archivo_hash or not procedimiento_normalizado:
+            return None
+        
+        with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.execute('''
+                SELECT cc.* FROM coberturas_cache cc
+                WHERE cc.archivo_hash = ?
+                    AND cc.plan_normalizado = ?
+                    AND cc.procedimiento_normalizado = ?
+                    AND cc.version_contexto = ?
+                    AND EXISTS (
+                        SELECT 1 FROM tabuladores t
+                        WHERE t.archivo_hash = cc.archivo_hash
+                            AND t.activo = 1
+                            AND t.tipo_documento = 'condiciones_generales'
+                    )
+            ''', (archivo_hash, plan_normalizado or '', procedimiento_normalizado, VERSION_CONTEXTO_COBERTURA))
+            row = cursor.fetchone()
+        
+        if not row:
+            return None
+        cobertura = dict(row)
+        cobertura['resultado'] = json.loads(cobertura['resultado'])
+        return cobertura
+    
+    def guardar_cobertura_en_cache(self, cobertura_data: Dict) -> int:
+        """Guarda (o reemplaza) el veredicto de cobertura de un procedimiento"""
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.execute('''
+                INSERT INTO coberturas_cache (
+                    archivo_hash, plan_normalizado, procedimiento_normalizado,
+                    procedimiento, resultado, fuente_tabulador_id, version_contexto
+                ) VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(archivo_hash, plan_normalizado, procedimiento_normalizado) DO UPDATE SET
+                    procedimiento = excluded.procedimiento,
+                    resultado = excluded.resultado,
+                    fuente_tabulador_id = excluded.fuente_tabulador_id,
+                    version_contexto = excluded.version_contexto,
+                    fecha_consulta = CURRENT_TIMESTAMP
+            ''', (
+                cobertura_data.get('archivo_hash'),
+                cobertura_data.get('plan_normalizado', ''),
+                cobertura_data.get('procedimiento_normalizado'),
+                cobertura_data.get('procedimiento', ''),
+                json.dumps(cobertura_data.get('resultado'), ensure_ascii=False),
+                cobertura_data.get('fuente_tabulador_id'),
+                VERSION_CONTEXTO_COBERTURA
+            ))
+            return cursor.lastrowid
+    
+    def purgar_coberturas_cache(self) -> int:
+        """Elimina los veredictos de documentos que ya no están activos. Retorna cuántos se eliminaron"""
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.execute('''
+                DELETE FROM coberturas_cache
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM tabuladores t
+                    WHERE t.archivo_hash = coberturas_cache.archivo_hash
+                        AND t.activo = 1
+                        AND t.tipo_documento = 'condiciones_generales'
+                )
+            ''')
+            return cursor.rowcount
+    
+    def obtener_procedimientos_frecuentes(self, aseguradora: str, limite: int = 20) -> List[str]:
+        """Procedimientos más consultados de una aseguradora (honorarios e informes), para precalentar cachés"""
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.execute('''
+                SELECT procedimiento, COUNT(*) AS veces FROM (
+                    SELECT procedimiento FROM consultas_honorarios WHERE aseguradora = ?
+                    UNION ALL
+                    SELECT procedimiento FROM informes_medicos WHERE aseguradora = ?
+                )
+                WHERE procedimiento IS NOT NULL AND procedimiento != ''
+                GROUP BY procedimiento
+                ORDER BY veces DESC
+                LIMIT ?
+            ''', (aseguradora, aseguradora, limite))
+            return [row[0] for row in cursor.fetchall()]
+    
+    def guardar_plan(self, plan_data: Dict, sobreescribir: bool = True) -> int:
+        """
+        Agrega o actualiza un plan del catálogo (una fila por aseguradora y plan normalizado).
+        Al actualizar, solo se sobreescriben los campos que traen valor. Los datos
+        extraídos de un documento (con fuente_tabulador_id) no sobreescriben filas
+        curadas (predefinidas o capturadas a mano, sin fuente_tabulador_id); una
+        captura a mano convierte la fila en curada.
+        """
+        aseguradora = normalizar_nombre_aseguradora(plan_data.get('aseguradora', ''))
+        plan_nombre = (plan_data.get('plan_nombre') or '').strip()
+        plan_normalizado = clave_plan(aseguradora, plan_nombre)[1]
+        
+        with sqlite3.connect(self.db_path) as conn:
+            existente = conn.execute(
+                'SELECT id, fuente_tabulador_id FROM planes_seguro WHERE aseguradora = ? AND plan_normalizado = ?',
+                (aseguradora, plan_normalizado)
+            ).fetchone()
+            
+            if existente:
+                curada = existente[1] is None
+                if sobreescribir and not (curada and plan_data.get('fuente_tabulador_id')):
+                    conn.execute('''
+                        UPDATE planes_seguro SET
+                            deducible_estimado = COALESCE(?, deducible_estimado),
+                            coaseguro_porcentaje = COALESCE(?, coaseguro_porcentaje),
+                            hospitales_red = COALESCE(NULLIF(?, ''), hospitales_red),
+                            fuente_tabulador_id = ?,
+                            updated_at = CURRENT_TIMESTAMP
+                        WHERE id = ?
+                    ''', (
+                        plan_data.get('deducible_estimado'),
+                        plan_data.get('coaseguro_porcentaje'),
+                        plan_data.get('hospitales_red'),
+                        plan_data.get('fuente_tabulador_id'),
+                        existente[0]
+                    ))
+                return existente[0]
+            
+            cursor = conn.execute('''
+                INSERT INTO planes_seguro (
+                    aseguradora, plan_nombre, plan_normalizado,
+                    deducible_estimado, coaseguro_porcentaje, hospitales_red,
+                    fuente_tabulador_id
+                ) VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                aseguradora,
+                plan_nombre,
+                plan_normalizado,
+                plan_data.get('deducible_estimado'),
+                plan_data.get('coaseguro_porcentaje'),
+                plan_data.get('hospitales_red'),
+                plan_data.get('fuente_tabulador_id')
+            ))
+            return cursor.lastrowid
+    
+    def obtener_planes(self, aseguradora: str = None) -> List[Dict]:
+        """Obtiene el catálogo de planes, filtrado opcionalmente por aseguradora"""
+        with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            query = 'SELECT * FROM planes_seguro'
+            params = []
+            
+            if aseguradora:
+                query += ' WHERE aseguradora = ?'
+                params.append(normalizar_nombre_aseguradora(aseguradora))
+            
+            query += ' ORDER BY aseguradora, plan_nombre'
+            cursor = conn.execute(query, params)
+            return [dict(row) for row in cursor.fetchall()]
+    
     def guardar_informe_medico(self, informe_data: Dict) -> int:
         """Guarda un informe médico generado"""
         with sqlite3.connect(self.db_path) as conn:
@@ -650,14 +1860,23 @@ class SeguroDB:
             ))
             return cursor.lastrowid
     
+    def obtener_informe_medico(self, informe_id: int) -> Optional[Dict]:
+        """Obtiene un informe médico por ID"""
+        with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.execute('SELECT * FROM informes_medicos WHERE id = ?', (informe_id,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+    
     def guardar_consulta_honorario(self, consulta_data: Dict) -> int:
         """Guarda una consulta de honorario realizada"""
         with sqlite3.connect(self.db_path) as conn:
             cursor = conn.execute('''
                 INSERT INTO consultas_honorarios (
                     medico_id, aseguradora, plan_nombre,
-                    procedimiento, codigo_cpt, monto_encontrado, fuente_tabulador_id
-                ) VALUES (?, ?, ?, ?, ?, ?, ?)
+                    procedimiento, codigo_cpt, monto_encontrado, fuente_tabulador_id,
+                    procedimiento_normalizado, descripcion, confianza
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''', (
                 consulta_data.get('medico_id', 'default'),
                 consulta_data.get('aseguradora', ''),
@@ -665,17 +1884,62 @@ class SeguroDB:
                 consulta_data.get('procedimiento', ''),
                 consulta_data.get('codigo_cpt', ''),
                 consulta_data.get('monto_encontrado'),
-                consulta_data.get('fuente_tabulador_id')
+                consulta_data.get('fuente_tabulador_id'),
+                consulta_data.get('procedimiento_normalizado', ''),
+                consulta_data.get('descripcion', ''),
+                consulta_data.get('confianza', '')
             ))
             return cursor.lastrowid
+    
+    def buscar_honorario_memorizado(
+        self,
+        tabulador_id: int,
+        plan_nombre: str,
+        procedimiento_normalizado: str,
+        codigo_cpt: str = None
+    ) -> Optional[Dict]:
+        """
+        Busca una respuesta previa de honorario para el mismo tabulador.
+        Coincide por procedimiento normalizado o por código CPT. Solo se
+        consideran tabuladores activos, de modo que al desactivar o reemplazar
+        el tabulador (el más reciente cambia de ID) las entradas dejan de usarse.
+        """
+        if not tabulador_id or not (procedimiento_normalizado or codigo_cpt):
+            return None
+        
+        with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.execute('''
+                SELECT ch.* FROM consultas_honorarios ch
+                JOIN tabuladores t ON t.id = ch.fuente_tabulador_id
+                WHERE ch.fuente_tabulador_id = ?
+                    AND t.activo = 1
+                    AND ch.monto_encontrado IS NOT NULL
+                    AND COALESCE(ch.plan_nombre, '') = ?
+                    AND (
+                        (ch.procedimiento_normalizado != '' AND ch.procedimiento_normalizado = ?)
+                        OR (ch.codigo_cpt != '' AND ch.codigo_cpt = ?)
+                    )
+                ORDER BY ch.fecha_consulta DESC, ch.id DESC
+                LIMIT 1
+            ''', (tabulador_id, plan_nombre or '', procedimiento_normalizado or '', codigo_cpt or ''))
+            row = cursor.fetchone()
+            return dict(row) if row else None
 
 class LegalDB:
     """Gestión de documentos legales, consentimientos, contratos y auditoría de cumplimiento"""
     
     def __init__(self, db_path: str = "consultas.db"):
         self.db_path = db_path
+        # Índice de trigramas de procedimientos de plantillas (se construye bajo demanda)
+        self._indice_plantillas = None
+        self._indice_lock = threading.Lock()
         self.init_database()
     
+    # Similitud mínima para sugerir la plantilla de otro procedimiento (el usuario elige:
+    # "histerectomia" se parece 0.64 a "Histerectomía vaginal")
+    UMBRAL_SIMILITUD_PLANTILLA = 0.6
+    
     def init_database(self):
         """Inicializa las tablas del módulo legal"""
         with sqlite3.connect(self.db_path) as conn:
@@ -815,6 +2079,16 @@ class LegalDB:
                 )
             ''')
             
+            # Marca de agua de la auditoría de cumplimiento: última consulta auditada por médico
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS marcas_auditoria (
+                    medico_id TEXT PRIMARY KEY,
+                    ultimo_consulta_id INTEGER DEFAULT 0,
+                    ultimo_updated_at TEXT DEFAULT '',
+                    ejecutada_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
             # Índices para búsquedas rápidas
             conn.execute('CREATE INDEX IF NOT EXISTS idx_doc_firmado_consulta ON documentos_firmados(consulta_id)')
             conn.execute('CREATE INDEX IF NOT EXISTS idx_doc_firmado_paciente ON documentos_firmados(paciente_id)')
@@ -825,6 +2099,7 @@ class LegalDB:
             conn.execute('CREATE INDEX IF NOT EXISTS idx_contrato_staff_estado ON contratos_staff(estado)')
             conn.execute('CREATE INDEX IF NOT EXISTS idx_alertas_estado ON alertas_legales(estado)')
             conn.execute('CREATE INDEX IF NOT EXISTS idx_alertas_severidad ON alertas_legales(severidad)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_alertas_entidad ON alertas_legales(medico_id, tipo_alerta, entidad_id)')
             
             conn.commit()
     
@@ -845,7 +2120,11 @@ class LegalDB:
                 plantilla_data.get('aprobado_por', ''),
                 plantilla_data.get('fecha_aprobacion')
             ))
-            return cursor.lastrowid
+            plantilla_id = cursor.lastrowid
+        
+        with self._indice_lock:
+            self._indice_plantillas = None
+        return plantilla_id
     
     def obtener_plantillas(self, tipo_documento: str = None, activo: bool = True) -> List[Dict]:
         """Obtiene plantillas legales, filtradas opcionalmente"""
@@ -873,8 +2152,60 @@ class LegalDB:
                 LIMIT 1
             ''', (procedimiento,))
             row = cursor.fetchone()
+            if row:
+                return dict(row)
+        
+        # Mismo procedimiento escrito distinto (acentos, mayúsculas, puntuación); con
+        # todas sus palabras: "sin reconstrucción" no elige la plantilla "con reconstrucción".
+        # Los solo parecidos no se eligen aquí: ver buscar_plantillas_similares
+        procedimiento_normalizado = normalizar_nombre(procedimiento)
+        for candidato in self.buscar_plantillas_similares(procedimiento):
+            if normalizar_nombre(candidato['procedimiento']) == procedimiento_normalizado:
+                return self.obtener_plantilla(candidato['plantilla_id'])
+        return None
+    
+    def obtener_plantilla(self, plantilla_id: int) -> Optional[Dict]:
+        """Obtiene una plantilla por ID"""
+        with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.execute('SELECT * FROM plantillas_legales WHERE id = ?', (plantilla_id,))
+            row = cursor.fetchone()
             return dict(row) if row else None
     
+    def buscar_plantillas_similares(self, procedimiento: str, limite: int = 5) -> List[Dict]:
+        """
+        Busca plantillas activas cuyo procedimiento se parezca al solicitado
+        usando un índice de trigramas
+        
+        Returns:
+            Lista ordenada: [{'plantilla_id', 'procedimiento', 'similitud'}, ...]
+        """
+        with self._indice_lock:
+            indice = self._indice_plantillas
+        
+        if indice is None:
+            indice = IndiceTrigramas()
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.execute('''
+                    SELECT id, procedimiento FROM plantillas_legales
+                    WHERE activo = 1 AND procedimiento IS NOT NULL AND procedimiento != ''
+                    ORDER BY version ASC
+                ''')
+                # Por procedimiento queda la versión más alta (se sobrescribe al recorrer)
+                ultima_version = {}
+                for plantilla_id, proc in cursor.fetchall():
+                    ultima_version[proc] = plantilla_id
+            for proc, plantilla_id in ultima_version.items():
+                indice.agregar(plantilla_id, proc)
+            
+            with self._indice_lock:
+                self._indice_plantillas = indice
+        
+        return [
+            {'plantilla_id': c['clave'], 'procedimiento': c['texto'], 'similitud': c['similitud']}
+            for c in indice.buscar(procedimiento, limite=limite, umbral=self.UMBRAL_SIMILITUD_PLANTILLA)
+        ]
+    
     def guardar_documento_firmado(self, documento_data: Dict) -> int:
         """Guarda un documento firmado"""
         with sqlite3.connect(self.db_path) as conn:
@@ -906,6 +2237,14 @@ class LegalDB:
             ))
             return cursor.lastrowid
     
+    def obtener_documento_firmado(self, documento_id: int) -> Optional[Dict]:
+        """Obtiene un documento firmado por ID"""
+        with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.execute('SELECT * FROM documentos_firmados WHERE id = ?', (documento_id,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+    
     def obtener_documentos_firmados(self, medico_id: str = 'default', consulta_id: int = None, limite: int = 50) -> List[Dict]:
         """Obtiene documentos firmados"""
         with sqlite3.connect(self.db_path) as conn:
@@ -1073,6 +2412,67 @@ class LegalDB:
             ''', (medico_id, estado, limite))
             return [dict(row) for row in cursor.fetchall()]
     
+    def obtener_entidades_con_alerta(self, tipo_alerta: str, medico_id: str = 'default',
+                                     entidad_ids: List[int] = None) -> set:
+        """
+        IDs de las entidades con una alerta activa de un tipo. Con entidad_ids solo
+        se consultan esas entidades (por idx_alertas_entidad), para deduplicar
+        alertas sin leer todas las activas.
+        """
+        query = '''
+            SELECT DISTINCT entidad_id FROM alertas_legales
+            WHERE medico_id = ? AND tipo_alerta = ? AND estado = 'activa'
+        '''
+        with sqlite3.connect(self.db_path) as conn:
+            if entidad_ids is None:
+                return {row[0] for row in conn.execute(query, (medico_id, tipo_alerta))}
+            
+            entidades = set()
+            for inicio in range(0, len(entidad_ids), 500):
+                bloque = entidad_ids[inicio:inicio + 500]
+                marcadores = ','.join('?' * len(bloque))
+                cursor = conn.execute(f'{query} AND entidad_id IN ({marcadores})', [medico_id, tipo_alerta] + bloque)
+                entidades.update(row[0] for row in cursor.fetchall())
+            return entidades
+    
+    def obtener_consultas_con_consentimiento(self, consulta_ids: List[int], medico_id: str = 'default') -> set:
+        """IDs de las consultas (de las indicadas) con consentimiento informado firmado"""
+        consultas = set()
+        with sqlite3.connect(self.db_path) as conn:
+            for inicio in range(0, len(consulta_ids), 500):
+                bloque = consulta_ids[inicio:inicio + 500]
+                marcadores = ','.join('?' * len(bloque))
+                cursor = conn.execute(f'''
+                    SELECT DISTINCT consulta_id FROM documentos_firmados
+                    WHERE consulta_id IN ({marcadores}) AND medico_id = ?
+                        AND tipo_documento = 'consentimiento_informado'
+                ''', bloque + [medico_id])
+                consultas.update(row[0] for row in cursor.fetchall())
+        return consultas
+    
+    def obtener_marca_auditoria(self, medico_id: str = 'default') -> Dict:
+        """Última consulta auditada de un médico: {'ultimo_consulta_id', 'ultimo_updated_at'}"""
+        with sqlite3.connect(self.db_path) as conn:
+            row = conn.execute(
+                'SELECT ultimo_consulta_id, ultimo_updated_at FROM marcas_auditoria WHERE medico_id = ?',
+                (medico_id,)
+            ).fetchone()
+        if not row:
+            return {'ultimo_consulta_id': 0, 'ultimo_updated_at': ''}
+        return {'ultimo_consulta_id': row[0] or 0, 'ultimo_updated_at': row[1] or ''}
+    
+    def guardar_marca_auditoria(self, medico_id: str, ultimo_consulta_id: int, ultimo_updated_at: str):
+        """Guarda la marca de agua de la auditoría (la siguiente ejecución parte de aquí)"""
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute('''
+                INSERT INTO marcas_auditoria (medico_id, ultimo_consulta_id, ultimo_updated_at, ejecutada_at)
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(medico_id) DO UPDATE SET
+                    ultimo_consulta_id = excluded.ultimo_consulta_id,
+                    ultimo_updated_at = excluded.ultimo_updated_at,
+                    ejecutada_at = excluded.ejecutada_at
+            ''', (medico_id, ultimo_consulta_id, ultimo_updated_at))
+    
     def resolver_alerta(self, alerta_id: int, resuelto_por: str, notas: str = ''):
         """Marca una alerta como resuelta"""
         with sqlite3.connect(self.db_path) as conn:
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+Exportación de transacciones del módulo del contador
+Escribe el reporte fiscal de Excel con xlsxwriter en modo constant_memory: cada
+fila se escribe en cuanto sale del cursor de la base de datos y se descarga a
+disco, así la memoria no crece con el número de transacciones (un año fiscal
+completo, sin límite de filas). Las hojas de resumen salen de agregados SQL.
+
+Las exportaciones CSV y NDJSON son generadores que entregan el archivo por
+bloques directamente desde el cursor (opcionalmente comprimido con gzip).
+"""
+
+import csv
+import json
+import zlib
+from io import StringIO
+from typing import BinaryIO, Dict, Iterable, Iterator
+
+import xlsxwriter
+
+from impuestos_provisionales import calcular_pagos_provisionales, periodo_de_filtros
+
+# Columnas de la hoja Transacciones (mismas que la plantilla de importación)
+COLUMNAS_TRANSACCIONES = [
+    'ID', 'Fecha', 'Tipo', 'RFC_Emisor', 'RFC_Receptor', 'UUID',
+    'Concepto', 'Proveedor', 'Subtotal', 'IVA', 'Total',
+    'Forma_Pago', 'Metodo_Pago', 'Clasificacion',
+    'Deducible_%', 'Cuenta_Bancaria', 'Estatus', 'Notas'
+]
+
+# Columnas de la tabla de pagos provisionales de la hoja Resumen
+COLUMNAS_PROVISIONALES = [
+    'Mes', 'Ingresos', 'Deducciones', 'Base ISR (acumulada)', 'ISR causado',
+    'ISR retenido (acum.)', 'Pagos anteriores', 'ISR a pagar', 'IVA a pagar',
+    'IVA a favor', 'Pendientes'
+]
+
+COLUMNAS_DEDUCIBLES = [
+    'Fecha', 'Concepto', 'Proveedor', 'Monto', '% Deducible', 'Monto Deducible'
+]
+
+# Columnas del CSV de transacciones
+COLUMNAS_CSV = [
+    'ID', 'Fecha', 'Tipo', 'Concepto', 'Proveedor', 'Monto',
+    'Clasificación', 'Deducible %', 'Estatus', 'Notas'
+]
+
+# Caracteres que se juntan antes de entregar un bloque del CSV/NDJSON
+TAMANO_BLOQUE_EXPORTACION = 64 * 1024
+
+def _formatos(workbook) -> Dict:
+    """Formatos de celda del reporte"""
+    return {
+        'encabezado': workbook.add_format({
+            'bold': True,
+            'bg_color': '#4472C4',
+            'font_color': '#FFFFFF',
+            'border': 1,
+            'align': 'center',
+            'valign': 'vcenter'
+        }),
+        'fecha': workbook.add_format({'num_format': 'dd/mm/yyyy'}),
+        'moneda': workbook.add_format({'num_format': '$#,##0.00'}),
+        'moneda_negrita': workbook.add_format({'num_format': '$#,##0.00', 'bold': True}),
+        'negrita': workbook.add_format({'bold': True}),
+        'porcentaje': workbook.add_format({'num_format': '0%'})
+    }
+
+def _hoja_transacciones(workbook, formatos: Dict, transacciones) -> int:
+    """Hoja 1: una fila por transacción, escrita conforme llega del cursor. Retorna el número de filas"""
+    worksheet = workbook.add_worksheet('Transacciones')
+    
+    # Ajustar ancho de columnas
+    worksheet.set_column('A:A', 8)   # ID
+    worksheet.set_column('B:B', 12)  # Fecha
+    worksheet.set_column('C:C', 10)  # Tipo
+    worksheet.set_column('D:E', 15)  # RFCs
+    worksheet.set_column('F:F', 36)  # UUID
+    worksheet.set_column('G:G', 25)  # Concepto
+    worksheet.set_column('H:H', 20)  # Proveedor
+    worksheet.set_column('I:K', 12)  # Montos
+    worksheet.set_column('L:L', 30)  # Forma_Pago
+    worksheet.set_column('M:M', 20)  # Metodo_Pago
+    worksheet.set_column('N:N', 25)  # Clasificacion
+    worksheet.set_column('O:O', 12)  # Deducible_%
+    worksheet.set_column('P:P', 15)  # Cuenta_Bancaria
+    worksheet.set_column('Q:Q', 12)  # Estatus
+    worksheet.set_column('R:R', 30)  # Notas
+    
+    worksheet.write_row(0, 0, COLUMNAS_TRANSACCIONES, formatos['encabezado'])
+    
+    total = total_subtotal = total_iva = 0.0
+    row_num = 0
+    for row_num, t in enumerate(transacciones, start=1):
+        tipo = t.get('tipo') or ''
+        monto = float(t.get('monto') or 0)
+        
+        # Subtotal e IVA del CFDI importado; sin XML se asume IVA 0% (honorarios médicos)
+        subtotal = float(t['subtotal']) if t.get('subtotal') is not None else monto
+        iva = float(t.get('iva_trasladado') or 0)
+        total += monto
+        total_subtotal += subtotal
+        total_iva += iva
+        
+        worksheet.write(row_num, 0, t.get('id', ''))
+        worksheet.write(row_num, 1, t.get('fecha') or '', formatos['fecha'])
+        worksheet.write(row_num, 2, tipo.upper())
+        worksheet.write(row_num, 3, t.get('rfc_emisor') or '')
+        worksheet.write(row_num, 4, t.get('rfc_receptor') or '')
+        worksheet.write(row_num, 5, t.get('cfdi_uuid') or '')
+        worksheet.write(row_num, 6, t.get('concepto') or '')
+        worksheet.write(row_num, 7, t.get('proveedor') or '')
+        worksheet.write(row_num, 8, subtotal, formatos['moneda'])
+        worksheet.write(row_num, 9, iva, formatos['moneda'])
+        worksheet.write(row_num, 10, monto, formatos['moneda'])
+        worksheet.write(row_num, 11, t.get('forma_pago') or '')
+        worksheet.write(row_num, 12, t.get('metodo_pago') or '')
+        worksheet.write(row_num, 13, t.get('clasificacion_contador') or t.get('clasificacion_ia') or '')
+        worksheet.write(row_num, 14, t.get('deducible_porcentaje') or 0)
+        worksheet.write(row_num, 16, (t.get('estatus_validacion') or '').upper())
+        worksheet.write(row_num, 17, t.get('notas_contador') or '')
+    
+    # Totales al final
+    total_row = row_num + 2
+    worksheet.write(total_row, 6, 'TOTALES', formatos['negrita'])
+    worksheet.write(total_row, 8, total_subtotal, formatos['moneda_negrita'])
+    worksheet.write(total_row, 9, total_iva, formatos['moneda_negrita'])
+    worksheet.write(total_row, 10, total, formatos['moneda_negrita'])
+    
+    return row_num
+
+def _hoja_resumen(workbook, formatos: Dict, agregados: Dict, provisionales: Dict):
+    """Hoja 2: totales del periodo, monto por clasificación y pagos provisionales del año"""
+    worksheet = workbook.add_worksheet('Resumen')
+    worksheet.set_column('A:A', 30)
+    worksheet.set_column('B:B', 15)
+    worksheet.set_column('C:C', 12)
+    worksheet.set_column('D:K', 15)
+    
+    worksheet.write(0, 0, 'RESUMEN FINANCIERO', formatos['negrita'])
+    
+    worksheet.write(2, 0, 'Total Ingresos:', formatos['negrita'])
+    worksheet.write(2, 1, agregados['ingresos_totales'], formatos['moneda'])
+    worksheet.write(3, 0, 'Total Gastos:', formatos['negrita'])
+    worksheet.write(3, 1, agregados['gastos_totales'], formatos['moneda'])
+    worksheet.write(4, 0, 'Utilidad (Ingresos - Gastos):', formatos['negrita'])
+    worksheet.write(4, 1, agregados['utilidad'], formatos['moneda_negrita'])
+    worksheet.write(5, 0, 'Total Deducible:', formatos['negrita'])
+    worksheet.write(5, 1, agregados['deducible_total'], formatos['moneda'])
+    
+    # Tabla por clasificación (ya ordenada por monto descendente)
+    row = 7
+    worksheet.write_row(row, 0, ['CLASIFICACIÓN', 'MONTO', '% DEL TOTAL'], formatos['encabezado'])
+    row += 1
+    
+    for fila in agregados['por_clasificacion']:
+        worksheet.write(row, 0, fila['clasificacion'])
+        worksheet.write(row, 1, fila['monto'], formatos['moneda'])
+        worksheet.write(row, 2, fila['fraccion'] or 0, formatos['porcentaje'])
+        row += 1
+    
+    worksheet.write(row, 0, 'TOTAL', formatos['negrita'])
+    worksheet.write(row, 1, agregados['ingresos_totales'] + agregados['gastos_totales'], formatos['moneda_negrita'])
+    worksheet.write(row, 2, 1.0, formatos['porcentaje'])
+    
+    # Pagos provisionales del año (todas las transacciones del médico, sin los demás filtros)
+    row += 3
+    worksheet.write(row, 0, f"PAGOS PROVISIONALES {provisionales['anio']} (ISR Art. 106 LISR / IVA)", formatos['negrita'])
+    row += 1
+    worksheet.write_row(row, 0, COLUMNAS_PROVISIONALES, formatos['encabezado'])
+    for mes in provisionales['meses']:
+        row += 1
+        worksheet.write(row, 0, mes['periodo'])
+        for columna, clave in enumerate((
+            'ingresos', 'deducciones', 'base_isr', 'isr_causado', 'isr_retenido_acumulado',
+            'pagos_provisionales_anteriores', 'isr_a_pagar', 'iva_a_pagar', 'iva_saldo_a_favor'
+        ), start=1):
+            worksheet.write(row, columna, mes[clave], formatos['moneda'])
+        worksheet.write(row, 10, mes['pendientes'])
+    
+    row += 1
+    totales = provisionales['totales']
+    worksheet.write(row, 0, 'TOTAL', formatos['negrita'])
+    worksheet.write(row, 1, totales['ingresos'], formatos['moneda_negrita'])
+    worksheet.write(row, 2, totales['deducciones'], formatos['moneda_negrita'])
+    worksheet.write(row, 7, totales['isr_a_pagar'], formatos['moneda_negrita'])
+    worksheet.write(row, 8, totales['iva_a_pagar'], formatos['moneda_negrita'])
+    worksheet.write(row, 9, totales['iva_saldo_a_favor'], formatos['moneda_negrita'])
+    worksheet.write(row, 10, totales['pendientes'], formatos['negrita'])
+
+def _hoja_deducibles(workbook, formatos: Dict, gastos_deducibles, agregados: Dict):
+    """
+    Hoja 3: gastos aprobados deducibles, escritos conforme llegan del cursor,
+    con el total y el subtotal por clasificación calculados en SQL
+    """
+    worksheet = workbook.add_worksheet('Deducibles')
+    worksheet.set_column('A:A', 12)  # Fecha
+    worksheet.set_column('B:B', 30)  # Concepto
+    worksheet.set_column('C:C', 20)  # Proveedor
+    worksheet.set_column('D:D', 15)  # Monto
+    worksheet.set_column('E:E', 15)  # % Deducible
+    worksheet.set_column('F:F', 18)  # Monto Deducible
+    
+    worksheet.write_row(0, 0, COLUMNAS_DEDUCIBLES, formatos['encabezado'])
+    
+    row_num = 0
+    for row_num, t in enumerate(gastos_deducibles, start=1):
+        worksheet.write(row_num, 0, t.get('fecha') or '', formatos['fecha'])
+        worksheet.write(row_num, 1, t.get('concepto') or '')
+        worksheet.write(row_num, 2, t.get('proveedor') or '')
+        worksheet.write(row_num, 3, t['monto'], formatos['moneda'])
+        worksheet.write(row_num, 4, t['deducible_porcentaje'] / 100, formatos['porcentaje'])
+        worksheet.write(row_num, 5, t['monto_deducible'], formatos['moneda'])
+    
+    total_row = row_num + 2
+    worksheet.write(total_row, 3, 'TOTAL DEDUCIBLE', formatos['negrita'])
+    worksheet.write(total_row, 5, agregados['deducible_total'], formatos['moneda_negrita'])
+    
+    # Subtotal deducible por clasificación
+    row = total_row + 3
+    worksheet.write_row(row, 0, ['Clasificación', 'Gastos', 'Monto Deducible'], formatos['encabezado'])
+    for fila in agregados['por_clasificacion']:
+        if fila['deducibles']:
+            row += 1
+            worksheet.write(row, 0, fila['clasificacion'])
+            worksheet.write(row, 1, fila['deducibles'])
+            worksheet.write(row, 2, fila['monto_deducible'], formatos['moneda'])
+
+def escribir_reporte_excel(salida: BinaryIO, transaccion_db, filtros: Dict) -> int:
+    """
+    Escribe el reporte fiscal (hojas Transacciones, Resumen y Deducibles) en
+    modo constant_memory. Las filas se escriben en orden y cada hoja se termina
+    antes de empezar la siguiente, como exige ese modo.
+    
+    Args:
+        salida: Archivo binario de destino (ej: tempfile.TemporaryFile())
+        transaccion_db: TransaccionDB
+        filtros: Filtros de transacciones (medico_id, tipo, estatus_validacion, fechas)
+    
+    Returns:
+        Número de transacciones exportadas
+    """
+    workbook = xlsxwriter.Workbook(salida, {'constant_memory': True})
+    formatos = _formatos(workbook)
+    
+    num_transacciones = _hoja_transacciones(workbook, formatos, transaccion_db.iterar_transacciones(filtros))
+    
+    # Totales de Resumen y Deducibles: una consulta agrupada con los mismos filtros que las filas
+    agregados = transaccion_db.obtener_agregados_reporte(filtros)
+    
+    anio, hasta_mes = periodo_de_filtros(filtros)
+    provisionales = calcular_pagos_provisionales(
+        transaccion_db.obtener_resumen_mensual(anio, filtros.get('medico_id', 'default'), hasta_mes),
+        anio,
+        hasta_mes
+    )
+    _hoja_resumen(workbook, formatos, agregados, provisionales)
+    
+    _hoja_deducibles(workbook, formatos, transaccion_db.iterar_gastos_deducibles(filtros), agregados)
+    
+    workbook.close()
+    return num_transacciones
+
+def _en_bloques(lineas: Iterable[str], tamano_bloque: int) -> Iterator[bytes]:
+    """Junta líneas en bloques de ~tamano_bloque caracteres codificados en UTF-8"""
+    buffer = []
+    acumulado = 0
+    for linea in lineas:
+        buffer.append(linea)
+        acumulado += len(linea)
+        if acumulado >= tamano_bloque:
+            yield ''.join(buffer).encode('utf-8')
+            buffer = []
+            acumulado = 0
+    if buffer:
+        yield ''.join(buffer).encode('utf-8')
+
+def _lineas_csv(transacciones: Iterable[Dict]) -> Iterator[str]:
+    """Encabezado y una línea CSV por transacción"""
+    si = StringIO()
+    writer = csv.writer(si)
+    
+    def linea(valores) -> str:
+        writer.writerow(valores)
+        texto = si.getvalue()
+        si.seek(0)
+        si.truncate()
+        return texto
+    
+    yield linea(COLUMNAS_CSV)
+    for t in transacciones:
+        yield linea([
+            t['id'], t['fecha'], t['tipo'], t['concepto'], t.get('proveedor') or '',
+            t['monto'], t.get('clasificacion_contador') or t.get('clasificacion_ia') or '',
+            t['deducible_porcentaje'], t['estatus_validacion'], t.get('notas_contador') or ''
+        ])
+
+def exportar_csv(transacciones: Iterable[Dict], tamano_bloque: int = TAMANO_BLOQUE_EXPORTACION) -> Iterator[bytes]:
+    """CSV de transacciones en bloques de bytes (para una respuesta en stream)"""
+    return _en_bloques(_lineas_csv(transacciones), tamano_bloque)
+
+def exportar_ndjson(transacciones: Iterable[Dict], tamano_bloque: int = TAMANO_BLOQUE_EXPORTACION) -> Iterator[bytes]:
+    """NDJSON (un objeto JSON por línea, todas las columnas) en bloques de bytes"""
+    lineas = (json.dumps(t, ensure_ascii=False) + '\n' for t in transacciones)
+    return _en_bloques(lineas, tamano_bloque)
+
+def comprimir_gzip(bloques: Iterable[bytes]) -> Iterator[bytes]:
+    """Comprime un stream de bloques en formato gzip sin juntarlos en memoria"""
+    compresor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for bloque in bloques:
+        comprimido = compresor.compress(bloque)
+        if comprimido:
+            yield comprimido
+    yield compresor.flush()
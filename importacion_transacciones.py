@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+"""
+Importación de transacciones desde Excel (.xlsx), CSV o CFDI (XML o ZIP de XML)
+para el módulo del contador
+Lee el archivo en modo stream (openpyxl read-only, fila por fila) y guarda las
+transacciones en lotes de tamaño fijo, de modo que la memoria no crece con el
+tamaño del archivo (descargas del SAT de 50k-200k filas).
+
+Las importaciones se ejecutan en segundo plano (ejecutar_importacion): el avance
+se guarda junto con cada lote, así una importación interrumpida continúa desde
+el último lote guardado. Los CFDI se leen con cfdi_xml y pasan por la misma
+clasificación y guardado por lotes que las filas de Excel.
+"""
+
+import csv
+from datetime import datetime
+from io import TextIOWrapper
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import openpyxl
+
+from cfdi_xml import es_archivo_cfdi, leer_xmls, parsear_cfdis, transaccion_desde_cfdi
+from clasificaciones_fiscales import obtener_porcentaje_deducible, validar_clasificacion
+from formas_pago_sat import validar_forma_pago, validar_deducibilidad_efectivo
+
+# Transacciones que se guardan por lote (una transacción de SQLite por lote)
+TAMANO_LOTE_IMPORTACION = 500
+
+# Errores de fila que se reportan (el total siempre se cuenta)
+MAX_ERRORES_REPORTADOS = 1000
+
+# Minutos sin avance tras los que una importación 'procesando' se considera interrumpida
+MINUTOS_IMPORTACION_INACTIVA = 2
+
+# Columnas que debe tener el archivo
+COLUMNAS_REQUERIDAS = ['Fecha', 'Tipo', 'Concepto', 'Total']
+
+class LectorImportacion:
+    """
+    Lector en stream de un .xlsx (openpyxl en modo de solo lectura, solo valores)
+    o .csv de transacciones. Entrega cada fila como {encabezado: valor}.
+    """
+    
+    def __init__(self, archivo, nombre_archivo: str):
+        """
+        Args:
+            archivo: Ruta o archivo binario (ej: el stream del upload; el .xlsx necesita seek)
+            nombre_archivo: Nombre original (define el formato por la extensión)
+        """
+        self.es_xlsx = nombre_archivo.lower().endswith('.xlsx')
+        self._workbook = None
+        
+        if self.es_xlsx:
+            self._workbook = openpyxl.load_workbook(archivo, read_only=True, data_only=True)
+            self._worksheet = self._workbook.active
+            primera = next(self._worksheet.iter_rows(min_row=1, max_row=1, values_only=True), ())
+            self.encabezados = [str(valor).strip() if valor is not None else '' for valor in primera]
+        else:
+            if isinstance(archivo, str):
+                archivo = open(archivo, 'rb')
+            self._csv = TextIOWrapper(archivo, encoding='utf-8-sig')
+            self._reader = csv.reader(self._csv)
+            self.encabezados = [campo.strip() for campo in next(self._reader, [])]
+    
+    def filas(self, desde_fila: int = 0) -> Iterator[Tuple[int, Dict]]:
+        """
+        Filas del archivo como (número de fila, {encabezado: valor}).
+        En .xlsx empiezan en la 3 (la 2 es el ejemplo de la plantilla); en .csv en la 2.
+        
+        Args:
+            desde_fila: Omitir las filas con número menor o igual (para continuar una importación)
+        """
+        if self.es_xlsx:
+            inicio = max(3, desde_fila + 1)
+            for fila_num, valores in enumerate(self._worksheet.iter_rows(min_row=inicio, values_only=True), start=inicio):
+                yield fila_num, dict(zip(self.encabezados, valores))
+        else:
+            for fila_num, valores in enumerate(self._reader, start=2):
+                if fila_num > desde_fila:
+                    yield fila_num, dict(zip(self.encabezados, valores))
+    
+    def estimar_total_filas(self) -> Optional[int]:
+        """
+        Filas de datos según las dimensiones del libro (.xlsx; None si el archivo
+        no las trae). En .csv no se estima (ver contar_filas_csv).
+        """
+        if self.es_xlsx and self._worksheet.max_row:
+            return max(0, self._worksheet.max_row - 2)
+        return None
+    
+    def columnas_faltantes(self) -> list:
+        """Columnas requeridas que no están en el archivo ('Monto' sirve como 'Total')"""
+        return [
+            columna for columna in COLUMNAS_REQUERIDAS
+            if columna not in self.encabezados and not (columna == 'Total' and 'Monto' in self.encabezados)
+        ]
+    
+    def cerrar(self):
+        """Cierra el archivo (en modo de solo lectura el libro lo mantiene abierto)"""
+        if self._workbook is not None:
+            self._workbook.close()
+        else:
+            self._csv.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.cerrar()
+
+def contar_filas_csv(ruta: str) -> int:
+    """Filas de datos de un .csv en disco (cuenta saltos de línea por bloques)"""
+    lineas = 0
+    ultimo = b'\n'
+    with open(ruta, 'rb') as f:
+        for bloque in iter(lambda: f.read(1024 * 1024), b''):
+            lineas += bloque.count(b'\n')
+            ultimo = bloque[-1:]
+    if ultimo != b'\n':
+        lineas += 1
+    return max(0, lineas - 1)
+
+def _texto(valor) -> str:
+    """Valor de celda como texto ('' si está vacía)"""
+    return str(valor).strip() if valor not in (None, '') else ''
+
+def convertir_fecha(valor) -> Optional[str]:
+    """Fecha de celda (date/datetime o texto AAAA-MM-DD / DD/MM/AAAA) a 'AAAA-MM-DD'"""
+    if isinstance(valor, str):
+        for formato in ('%Y-%m-%d', '%d/%m/%Y'):
+            try:
+                return datetime.strptime(valor.strip(), formato).strftime('%Y-%m-%d')
+            except ValueError:
+                continue
+        return None
+    if hasattr(valor, 'strftime'):
+        return valor.strftime('%Y-%m-%d')
+    return None
+
+def preparar_transaccion(fila: Dict) -> Tuple[Optional[Dict], Optional[str]]:
+    """
+    Valida una fila del archivo y la convierte en transacción (sin clasificar)
+    
+    Returns:
+        (transaccion_data, None) o (None, mensaje de error)
+    """
+    fecha_val = fila.get('Fecha')
+    tipo_val = _texto(fila.get('Tipo')).lower()
+    concepto_val = _texto(fila.get('Concepto'))
+    total_val = fila.get('Total') or fila.get('Monto')
+    
+    if not fecha_val:
+        return None, "Fecha inválida o vacía"
+    
+    if tipo_val not in ['ingreso', 'gasto']:
+        return None, f"Tipo inválido: {fila.get('Tipo')}. Debe ser 'Ingreso' o 'Gasto'"
+    
+    if not concepto_val:
+        return None, "Concepto vacío"
+    
+    if not total_val or float(total_val) <= 0:
+        return None, f"Monto debe ser mayor a 0. Valor: {total_val}"
+    
+    fecha = convertir_fecha(fecha_val)
+    if not fecha:
+        return None, f"Formato de fecha inválido: {fecha_val}"
+    
+    deducible_val = fila.get('Deducible_%')
+    transaccion_data = {
+        'tipo': tipo_val,
+        'fecha': fecha,
+        'monto': float(total_val),
+        'concepto': concepto_val,
+        'proveedor': _texto(fila.get('Proveedor')),
+        'cfdi_uuid': _texto(fila.get('UUID')),
+        'forma_pago': _texto(fila.get('Forma_Pago')),
+        'metodo_pago': _texto(fila.get('Metodo_Pago')),
+        'clasificacion': _texto(fila.get('Clasificacion')),
+        'deducible_porcentaje': int(float(deducible_val)) if deducible_val not in (None, '') else None,
+        'notas_contador': _texto(fila.get('Notas'))
+    }
+    
+    if transaccion_data['forma_pago'] and not validar_forma_pago(transaccion_data['forma_pago']):
+        return None, f"Forma de pago inválida: {transaccion_data['forma_pago']}"
+    
+    return transaccion_data, None
+
+def preparar_cfdi(leido: Dict, rfc_medico: str, almacen=None) -> Tuple[Optional[Dict], Optional[str]]:
+    """
+    Convierte un XML leído por parsear_cfdis en transacción (sin clasificar)
+    
+    Args:
+        leido: {'archivo', 'xml', 'cfdi', 'error'}
+        rfc_medico: RFC del médico (define si es ingreso o gasto)
+        almacen: AlmacenArchivos donde guardar el XML (cfdi_xml_path; opcional)
+    
+    Returns:
+        (transaccion_data, None) o (None, mensaje de error con el nombre del XML)
+    """
+    if leido['error']:
+        return None, f"{leido['archivo']}: {leido['error']}"
+    
+    transaccion_data, error = transaccion_desde_cfdi(leido['cfdi'], rfc_medico)
+    if error:
+        return None, f"{leido['archivo']}: {error}"
+    
+    if almacen is not None:
+        transaccion_data['cfdi_xml_path'] = almacen.guardar(leido['xml'], '.xml')['ruta']
+    return transaccion_data, None
+
+def clasificar_transacciones(lote: List[Dict], transaccion_db, medico_id: str = 'default') -> List[Dict]:
+    """
+    Completa clasificacion_ia y deducible_porcentaje de un lote: usa la clasificación
+    del archivo si es válida; las demás se clasifican juntas con clasificar_lote
+    (reglas aprendidas del médico y clasificador, una operación matricial por lote)
+    """
+    sin_clasificar = []
+    for transaccion_data in lote:
+        clasificacion = transaccion_data['clasificacion']
+        if clasificacion and validar_clasificacion(clasificacion, transaccion_data['tipo']):
+            transaccion_data['clasificacion_ia'] = clasificacion
+            if transaccion_data['deducible_porcentaje'] is None:
+                transaccion_data['deducible_porcentaje'] = obtener_porcentaje_deducible(clasificacion)
+        else:
+            sin_clasificar.append(transaccion_data)
+    
+    if sin_clasificar:
+        clasificaciones = transaccion_db.clasificar_lote([
+            (t['concepto'], t['proveedor'], t['tipo']) for t in sin_clasificar
+        ], medico_id=medico_id)
+        for transaccion_data, clasificacion_ia in zip(sin_clasificar, clasificaciones):
+            transaccion_data['clasificacion_ia'] = clasificacion_ia['clasificacion']
+            transaccion_data['deducible_porcentaje'] = clasificacion_ia['deducible_porcentaje']
+    
+    # Gastos en efectivo arriba del límite no son deducibles
+    for transaccion_data in lote:
+        if transaccion_data['tipo'] == 'gasto' and transaccion_data['forma_pago']:
+            validacion_efectivo = validar_deducibilidad_efectivo(transaccion_data['monto'], transaccion_data['forma_pago'])
+            if not validacion_efectivo['es_deducible']:
+                transaccion_data['deducible_porcentaje'] = 0
+    
+    return lote
+
+def importar_filas(filas: Iterator[Tuple[int, Dict]], transaccion_db, tamano_lote: int = TAMANO_LOTE_IMPORTACION,
+                   importacion: Dict = None,
+                   preparar: Callable[[Dict], Tuple[Optional[Dict], Optional[str]]] = preparar_transaccion,
+                   medico_id: str = 'default') -> Dict:
+    """
+    Valida, clasifica y guarda las filas en lotes de tamaño fijo
+    
+    Args:
+        filas: Iterador de (número de fila, {encabezado: valor})
+        transaccion_db: TransaccionDB
+        tamano_lote: Transacciones por lote
+        importacion: Registro de la tabla importaciones; los contadores parten de
+            su avance y se actualizan con cada lote guardado
+        preparar: Convierte una fila en (transaccion_data, error) (default: fila de Excel/CSV)
+        medico_id: Médico al que pertenecen las transacciones (sus reglas clasifican el lote)
+    
+    Returns:
+        {'procesadas', 'exitosas', 'duplicadas', 'total_errores', 'errores': [{'fila', 'error'}] (primeros MAX_ERRORES_REPORTADOS)}
+    """
+    resultado = {'procesadas': 0, 'exitosas': 0, 'duplicadas': 0, 'total_errores': 0, 'errores': []}
+    if importacion:
+        for clave in resultado:
+            resultado[clave] = importacion.get(clave) or resultado[clave]
+    ultima_fila = importacion.get('ultima_fila', 0) if importacion else 0
+    
+    def registrar_error(fila_num, mensaje):
+        resultado['total_errores'] += 1
+        if len(resultado['errores']) < MAX_ERRORES_REPORTADOS:
+            resultado['errores'].append({"fila": fila_num, "error": mensaje})
+    
+    def guardar(lote):
+        avance = None
+        if importacion:
+            avance = {
+                'id': importacion['id'],
+                'ultima_fila': ultima_fila,
+                'procesadas': resultado['procesadas'],
+                'total_errores': resultado['total_errores'],
+                'errores': resultado['errores']
+            }
+        guardado = transaccion_db.guardar_transacciones_lote(
+            clasificar_transacciones(lote, transaccion_db, medico_id=medico_id),
+            medico_id=medico_id,
+            importacion=avance
+        )
+        resultado['exitosas'] += guardado['insertadas']
+        resultado['duplicadas'] += guardado['duplicadas']
+    
+    lote = []
+    for fila_num, fila in filas:
+        ultima_fila = fila_num
+        
+        # Saltar filas vacías
+        if not any(valor not in (None, '') for valor in fila.values()):
+            continue
+        
+        resultado['procesadas'] += 1
+        try:
+            transaccion_data, error = preparar(fila)
+            if error:
+                registrar_error(fila_num, error)
+                continue
+            lote.append(transaccion_data)
+        except Exception as e:
+            registrar_error(fila_num, f"Error procesando fila: {str(e)}")
+            continue
+        
+        if len(lote) >= tamano_lote:
+            guardar(lote)
+            lote = []
+    
+    # Con importación en segundo plano se guarda el avance final aunque el lote esté vacío
+    if lote or importacion:
+        guardar(lote)
+    
+    return resultado
+
+def ejecutar_importacion(importacion_id: int, transaccion_db, ruta_archivo: Optional[str],
+                         tamano_lote: int = TAMANO_LOTE_IMPORTACION, almacen=None) -> Optional[Dict]:
+    """
+    Ejecuta (o continúa) una importación registrada en la tabla importaciones.
+    Primero la reclama con reclamar_importacion, de modo que dos procesos no
+    importen el mismo archivo; si ya la lleva otro proceso, no hace nada.
+    
+    Args:
+        importacion_id: ID en la tabla importaciones
+        transaccion_db: TransaccionDB
+        ruta_archivo: Ruta del archivo subido (None si ya no existe)
+        almacen: AlmacenArchivos donde guardar cada XML de una importación de CFDI
+    
+    Returns:
+        Resultado de importar_filas, o None si no se ejecutó o falló
+    """
+    if not transaccion_db.reclamar_importacion(importacion_id, MINUTOS_IMPORTACION_INACTIVA):
+        return None
+    
+    importacion = transaccion_db.obtener_importacion(importacion_id)
+    if not ruta_archivo:
+        transaccion_db.finalizar_importacion(importacion_id, 'error', 'El archivo de la importación ya no existe.')
+        return None
+    
+    medico_id = importacion['medico_id'] or 'default'
+    try:
+        if es_archivo_cfdi(importacion['nombre_archivo']):
+            # En CFDI la "fila" es el número del XML dentro del ZIP
+            resultado = importar_filas(
+                parsear_cfdis(leer_xmls(ruta_archivo, importacion['nombre_archivo'], desde=importacion['ultima_fila'])),
+                transaccion_db,
+                tamano_lote,
+                importacion=importacion,
+                preparar=lambda leido: preparar_cfdi(leido, importacion['rfc_medico'], almacen),
+                medico_id=medico_id
+            )
+        else:
+            with LectorImportacion(ruta_archivo, importacion['nombre_archivo']) as lector:
+                resultado = importar_filas(
+                    lector.filas(desde_fila=importacion['ultima_fila']),
+                    transaccion_db,
+                    tamano_lote,
+                    importacion=importacion,
+                    medico_id=medico_id
+                )
+    except Exception as e:
+        print(f"[ERROR] Importación {importacion_id}: {str(e)}")
+        transaccion_db.finalizar_importacion(importacion_id, 'error', str(e))
+        return None
+    
+    transaccion_db.finalizar_importacion(importacion_id, 'completado')
+    return resultado
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Pagos provisionales mensuales de ISR e IVA para médicos (personas físicas con
+actividad profesional, Art. 106 LISR). Se calculan con los totales por mes de
+resumen_mensual (TransaccionDB.obtener_resumen_mensual), sin recorrer las
+transacciones: un año completo son a lo más 12 filas por médico.
+
+ISR: a los ingresos acumulados del año se restan las deducciones acumuladas y a
+la base se aplica la tarifa mensual del Art. 96 multiplicada por el número de
+meses; se acreditan las retenciones de ISR y los pagos provisionales anteriores.
+IVA: es mensual (no acumulado). Si los ingresos del mes no trasladan IVA
+(honorarios médicos exentos) el IVA de los gastos no es acreditable y forma parte
+de la deducción; si se acredita, se deduce el gasto sin IVA.
+"""
+
+from datetime import date
+from typing import Dict, List, Tuple
+
+# Tarifa mensual del Art. 96 LISR (Anexo 8 RMF): límite inferior, cuota fija, % sobre el excedente
+TARIFA_ISR_MENSUAL = [
+    (0.01, 0.00, 1.92),
+    (746.05, 14.32, 6.40),
+    (6332.06, 371.83, 10.88),
+    (11128.02, 893.63, 16.00),
+    (12935.83, 1182.88, 17.92),
+    (15487.72, 1640.18, 21.36),
+    (31236.50, 5004.12, 23.52),
+    (49233.01, 9236.89, 30.00),
+    (93993.91, 22665.17, 32.00),
+    (125325.21, 32691.18, 34.00),
+    (375975.62, 117912.32, 35.00)
+]
+
+def calcular_isr_tarifa(base: float, meses: int = 1) -> float:
+    """
+    ISR de una base con la tarifa mensual acumulada a `meses` meses
+    (límites y cuotas fijas multiplicados por el número de meses)
+    """
+    if base <= 0:
+        return 0.0
+    
+    fila = TARIFA_ISR_MENSUAL[0]
+    for renglon in TARIFA_ISR_MENSUAL:
+        if base < renglon[0] * meses:
+            break
+        fila = renglon
+    
+    limite_inferior, cuota_fija, porcentaje = fila
+    excedente = max(0.0, base - limite_inferior * meses)
+    return cuota_fija * meses + excedente * porcentaje / 100
+
+def calcular_pagos_provisionales(resumenes: List[Dict], anio: int, hasta_mes: int = 12) -> Dict:
+    """
+    Pagos provisionales de ISR e IVA de enero a hasta_mes
+    
+    Args:
+        resumenes: Filas de resumen_mensual de un médico para el año
+        anio: Año del cálculo
+        hasta_mes: Último mes a calcular
+    
+    Returns:
+        {'anio', 'meses': [...], 'totales': {...}}; por mes: ingresos, deducciones,
+        acumulados, base, ISR causado, retenciones, pagos anteriores, ISR a pagar,
+        IVA trasladado/acreditable/retenido, IVA a pagar o saldo a favor, y
+        transacciones pendientes de validar
+    """
+    por_periodo = {r['periodo']: r for r in resumenes}
+    
+    ingresos_acumulados = 0.0
+    deducciones_acumuladas = 0.0
+    isr_retenido_acumulado = 0.0
+    pagos_anteriores = 0.0
+    meses = []
+    
+    for mes in range(1, hasta_mes + 1):
+        periodo = f'{anio}-{mes:02d}'
+        resumen = por_periodo.get(periodo, {})
+        
+        # IVA del mes
+        iva_trasladado = resumen.get('iva_trasladado') or 0.0
+        iva_retenido = resumen.get('iva_retenido') or 0.0
+        iva_acreditable = (resumen.get('iva_acreditable') or 0.0) if iva_trasladado > 0 else 0.0
+        saldo_iva = iva_trasladado - iva_retenido - iva_acreditable
+        
+        # El IVA acreditado no se deduce también para ISR
+        sufijo = '_sin_iva' if iva_trasladado > 0 else ''
+        ingresos = resumen.get('ingresos_sin_iva') or 0.0
+        deducciones = resumen.get(f'deducciones{sufijo}') or 0.0
+        deducciones_por_validar = resumen.get(f'deducciones_por_validar{sufijo}') or 0.0
+        ingresos_acumulados += ingresos
+        deducciones_acumuladas += deducciones
+        isr_retenido_acumulado += resumen.get('isr_retenido') or 0.0
+        
+        # ISR: cálculo acumulado al mes, menos retenciones y pagos provisionales anteriores
+        base = max(0.0, ingresos_acumulados - deducciones_acumuladas)
+        isr_causado = calcular_isr_tarifa(base, mes)
+        isr_a_pagar = max(0.0, isr_causado - isr_retenido_acumulado - pagos_anteriores)
+        
+        meses.append({
+            'periodo': periodo,
+            'ingresos': round(ingresos, 2),
+            'deducciones': round(deducciones, 2),
+            'deducciones_por_validar': round(deducciones_por_validar, 2),
+            'ingresos_acumulados': round(ingresos_acumulados, 2),
+            'deducciones_acumuladas': round(deducciones_acumuladas, 2),
+            'base_isr': round(base, 2),
+            'isr_causado': round(isr_causado, 2),
+            'isr_retenido_acumulado': round(isr_retenido_acumulado, 2),
+            'pagos_provisionales_anteriores': round(pagos_anteriores, 2),
+            'isr_a_pagar': round(isr_a_pagar, 2),
+            'iva_trasladado': round(iva_trasladado, 2),
+            'iva_acreditable': round(iva_acreditable, 2),
+            'iva_retenido': round(iva_retenido, 2),
+            'iva_a_pagar': round(max(0.0, saldo_iva), 2),
+            'iva_saldo_a_favor': round(max(0.0, -saldo_iva), 2),
+            'transacciones': int(resumen.get('transacciones') or 0),
+            'pendientes': int(resumen.get('pendientes') or 0)
+        })
+        pagos_anteriores += isr_a_pagar
+    
+    totales = {
+        clave: round(sum(m[clave] for m in meses), 2)
+        for clave in ('ingresos', 'deducciones', 'isr_a_pagar', 'iva_a_pagar', 'iva_saldo_a_favor')
+    }
+    totales['pendientes'] = sum(m['pendientes'] for m in meses)
+    
+    return {'anio': anio, 'meses': meses, 'totales': totales}
+
+def mes_de_corte(anio: int, hoy: date = None) -> int:
+    """Último mes a calcular de un año: diciembre en años pasados, el mes en curso en el año actual"""
+    hoy = hoy or date.today()
+    return 12 if anio < hoy.year else hoy.month
+
+def periodo_de_filtros(filtros: Dict) -> Tuple[int, int]:
+    """(año, último mes) del cálculo para los filtros de fecha de un reporte"""
+    if filtros.get('fecha_hasta'):
+        return int(filtros['fecha_hasta'][:4]), int(filtros['fecha_hasta'][5:7])
+    anio = int(filtros['fecha_desde'][:4]) if filtros.get('fecha_desde') else date.today().year
+    return anio, mes_de_corte(anio)
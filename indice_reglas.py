@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Índice en memoria de las reglas de clasificación aprendidas de un médico
+Reemplaza las consultas por transacción a reglas_clasificacion (la de similitud,
+con LIKE '%concepto%', recorría todas las reglas): coincidencia exacta por
+(concepto, proveedor) en un dict y coincidencia por subcadena con un índice
+invertido de trigramas de caracteres, más un índice de palabras para conceptos
+con las mismas palabras en otro orden.
+"""
+
+import re
+from typing import Dict, List, Optional
+
+from busqueda_procedimientos import plegar_acentos, normalizar_texto
+
+def _plegar(texto: str) -> str:
+    """Texto en minúsculas y sin acentos (comparación de subcadenas)"""
+    return plegar_acentos(texto or '')
+
+def _trigramas_subcadena(texto: str) -> set:
+    """Trigramas de caracteres sin relleno: toda subcadena los comparte con el texto que la contiene"""
+    return {texto[i:i + 3] for i in range(len(texto) - 2)}
+
+def _regex_like(patron: str):
+    """Expresión regular equivalente a un patrón LIKE de SQL (% y _), sin distinguir mayúsculas"""
+    partes = []
+    for c in patron:
+        if c == '%':
+            partes.append('.*')
+        elif c == '_':
+            partes.append('.')
+        else:
+            partes.append(re.escape(c))
+    return re.compile(''.join(partes), re.IGNORECASE | re.DOTALL)
+
+class IndiceReglas:
+    """
+    Reglas de clasificación de un médico indexadas para clasificar sin consultar
+    la base de datos. Cada regla es {'id', 'patron_concepto', 'proveedor',
+    'clasificacion', 'deducible_porcentaje', 'frecuencia_uso'}.
+    """
+    
+    def __init__(self, reglas: List[Dict] = ()):
+        self._reglas: Dict[int, Dict] = {}
+        # (patron_concepto, proveedor) -> ID de la regla más usada
+        self._exactas: Dict[tuple, int] = {}
+        # Texto plegado de cada regla y su índice de trigramas (subcadenas)
+        self._plegados: Dict[int, str] = {}
+        self._trigramas: Dict[str, set] = {}
+        # Palabras normalizadas (sin orden) -> IDs de reglas
+        self._palabras: Dict[str, set] = {}
+        # Reglas escritas con comodines de LIKE (% o _), se revisan una por una
+        self._comodines: Dict[int, object] = {}
+        
+        for regla in reglas:
+            self.registrar(regla)
+    
+    def __len__(self):
+        return len(self._reglas)
+    
+    def registrar(self, regla: Dict):
+        """Agrega una regla o actualiza una existente (misma ID)"""
+        regla_id = regla['id']
+        nueva = regla_id not in self._reglas
+        regla = dict(regla, proveedor=regla.get('proveedor') or '')
+        self._reglas[regla_id] = regla
+        
+        clave = (regla['patron_concepto'], regla['proveedor'])
+        actual = self._exactas.get(clave)
+        if actual is None or actual == regla_id or regla['frecuencia_uso'] > self._reglas[actual]['frecuencia_uso']:
+            self._exactas[clave] = regla_id
+        
+        # El patrón de una regla no cambia al actualizarla: solo se indexa la primera vez
+        if not nueva:
+            return
+        
+        plegado = _plegar(regla['patron_concepto'])
+        self._plegados[regla_id] = plegado
+        for trigrama in _trigramas_subcadena(plegado):
+            self._trigramas.setdefault(trigrama, set()).add(regla_id)
+        for palabra in set(normalizar_texto(regla['patron_concepto']).split()):
+            self._palabras.setdefault(palabra, set()).add(regla_id)
+        if '%' in regla['patron_concepto'] or '_' in regla['patron_concepto']:
+            self._comodines[regla_id] = _regex_like(regla['patron_concepto'])
+    
+    def _mas_usada(self, ids) -> Optional[Dict]:
+        """La regla con mayor frecuencia de uso (o None)"""
+        return max((self._reglas[i] for i in ids), key=lambda r: r['frecuencia_uso'], default=None)
+    
+    def _por_subcadena(self, concepto: str) -> set:
+        """IDs de reglas cuyo patrón contiene el concepto (sin distinguir mayúsculas ni acentos)"""
+        plegado = _plegar(concepto)
+        if not plegado:
+            return set()
+        
+        tri = _trigramas_subcadena(plegado)
+        if not tri:
+            # Conceptos de 1-2 caracteres: no hay trigramas que filtren
+            candidatos = self._plegados.keys()
+        else:
+            # Intersectar empezando por el trigrama menos común
+            listas = sorted((self._trigramas.get(t, set()) for t in tri), key=len)
+            candidatos = set(listas[0])
+            for lista in listas[1:]:
+                if not candidatos:
+                    break
+                candidatos &= lista
+        
+        return {i for i in candidatos if plegado in self._plegados[i]}
+    
+    def _por_palabras(self, concepto: str) -> set:
+        """IDs de reglas que contienen todas las palabras del concepto (en cualquier orden)"""
+        palabras = set(normalizar_texto(concepto).split())
+        if not palabras:
+            return set()
+        listas = sorted((self._palabras.get(p, set()) for p in palabras), key=len)
+        candidatos = set(listas[0])
+        for lista in listas[1:]:
+            candidatos &= lista
+        return candidatos
+    
+    def buscar(self, concepto: str, proveedor: str = '') -> Optional[Dict]:
+        """
+        Busca la regla para un concepto
+        
+        Returns:
+            {'regla': dict, 'metodo': 'regla_aprendida' | 'similitud'} o None
+        """
+        concepto = concepto or ''
+        regla_id = self._exactas.get((concepto, proveedor or ''))
+        if regla_id is not None:
+            return {'regla': self._reglas[regla_id], 'metodo': 'regla_aprendida'}
+        
+        if not concepto:
+            return None
+        
+        ids = self._por_subcadena(concepto)
+        # Patrones con comodines (como '? LIKE patron_concepto' en SQL)
+        ids.update(i for i, regex in self._comodines.items() if regex.fullmatch(f'%{concepto}%'))
+        if not ids:
+            ids = self._por_palabras(concepto)
+        
+        regla = self._mas_usada(ids)
+        if regla:
+            return {'regla': regla, 'metodo': 'similitud'}
+        return None
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Generación de informes médicos por lote (cierre de mes)
+Renderiza los PDFs en un pool de procesos y los entrega como un ZIP en stream,
+agregando cada informe al ZIP en cuanto termina (sin juntar todos en memoria).
+
+Uso:
+    python informes_lote.py --salida informes.zip 12:3 13:4 15
+    python informes_lote.py --salida informes.zip --archivo lote.json
+
+Cada informe es consulta_id[:credencial_seguro_id]. El archivo JSON es una lista
+de objetos con consulta_id, credencial_seguro_id y datos adicionales opcionales
+(edad, sexo, procedimiento, codigo_cpt, codigo_cie10, ...).
+"""
+
+import os
+import json
+import argparse
+import zipfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from seguro_informe import (
+    generar_informe_medico,
+    preparar_datos_informe,
+    registro_informe,
+    nombre_archivo_informe
+)
+
+# Máximo de informes por lote
+MAX_INFORMES_LOTE = 200
+
+def _renderizar_informe(trabajo: Tuple) -> Tuple[int, bytes]:
+    """Renderiza un informe en un proceso del pool. Retorna (índice, bytes del PDF)"""
+    indice, datos_consulta, datos_paciente, datos_seguro = trabajo
+    buffer = generar_informe_medico(
+        datos_consulta=datos_consulta,
+        datos_paciente=datos_paciente,
+        datos_seguro=datos_seguro,
+        tipo_aseguradora=datos_seguro.get('aseguradora', 'GENÉRICO')
+    )
+    return indice, buffer.getvalue()
+
+# Pool de procesos de renderizado (se crea la primera vez y se reutiliza entre lotes)
+_pool = None
+_pool_lock = threading.Lock()
+
+def _obtener_pool(reiniciar: bool = False) -> ProcessPoolExecutor:
+    """Obtiene el pool de renderizado, creándolo (o recreándolo si se rompió)"""
+    global _pool
+    with _pool_lock:
+        if _pool is None or reiniciar:
+            if _pool is not None:
+                _pool.shutdown(wait=False, cancel_futures=True)
+            # 'spawn' para no heredar el estado del servidor web (hilos, locks, conexiones)
+            _pool = ProcessPoolExecutor(
+                max_workers=os.cpu_count() or 1,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _pool
+
+def renderizar_informes(trabajos: List[Tuple], max_procesos: Optional[int] = None) -> Iterator[Tuple[int, Optional[bytes], Optional[str]]]:
+    """
+    Renderiza informes en el pool de procesos y los entrega conforme terminan.
+    Solo mantiene en vuelo un par de trabajos por proceso para no acumular PDFs.
+    
+    Args:
+        trabajos: Lista de (índice, datos_consulta, datos_paciente, datos_seguro)
+        max_procesos: Informes renderizándose a la vez (default: núcleos disponibles)
+    
+    Yields:
+        (índice, bytes del PDF o None, error o None)
+    """
+    max_procesos = max(1, min(max_procesos or os.cpu_count() or 1, len(trabajos) or 1))
+    
+    # Lotes pequeños: no vale la pena usar otros procesos
+    if max_procesos == 1:
+        for trabajo in trabajos:
+            try:
+                yield _renderizar_informe(trabajo) + (None,)
+            except Exception as e:
+                yield trabajo[0], None, str(e)
+        return
+    
+    pool = _obtener_pool()
+    pendientes = iter(trabajos)
+    en_vuelo = {}
+    
+    try:
+        while True:
+            while len(en_vuelo) < max_procesos * 2:
+                trabajo = next(pendientes, None)
+                if trabajo is None:
+                    break
+                try:
+                    futuro = pool.submit(_renderizar_informe, trabajo)
+                except BrokenProcessPool:
+                    pool = _obtener_pool(reiniciar=True)
+                    futuro = pool.submit(_renderizar_informe, trabajo)
+                en_vuelo[futuro] = trabajo[0]
+            
+            if not en_vuelo:
+                break
+            
+            terminados, _ = wait(en_vuelo, return_when=FIRST_COMPLETED)
+            for futuro in terminados:
+                indice = en_vuelo.pop(futuro)
+                try:
+                    yield futuro.result() + (None,)
+                except Exception as e:
+                    yield indice, None, str(e)
+    finally:
+        # Si el cliente abandona la descarga, no seguir renderizando este lote
+        for futuro in en_vuelo:
+            futuro.cancel()
+
+class _SalidaZip:
+    """Destino de escritura de zipfile que acumula los bytes hasta que se entregan"""
+    
+    def __init__(self):
+        self._partes = []
+    
+    def write(self, datos: bytes) -> int:
+        self._partes.append(bytes(datos))
+        return len(datos)
+    
+    def flush(self):
+        pass
+    
+    def vaciar(self) -> bytes:
+        datos = b''.join(self._partes)
+        self._partes = []
+        return datos
+
+def zip_en_stream(entradas: Iterable[Tuple[str, bytes]]) -> Iterator[bytes]:
+    """
+    Construye un ZIP entregando los bytes de cada archivo en cuanto se agrega.
+    zipfile escribe en modo stream (descriptores de datos) porque el destino no
+    permite seek.
+    """
+    salida = _SalidaZip()
+    with zipfile.ZipFile(salida, mode='w', compression=zipfile.ZIP_DEFLATED) as archivo_zip:
+        for nombre, datos in entradas:
+            archivo_zip.writestr(nombre, datos)
+            yield salida.vaciar()
+    yield salida.vaciar()
+
+def generar_lote_zip(solicitudes: List[Dict], db, seguro_db, max_procesos: Optional[int] = None, almacen=None) -> Iterator[bytes]:
+    """
+    Genera los informes del lote y entrega el ZIP en stream. Cada informe generado
+    se registra con guardar_informe_medico; al final se agrega resumen.json con el
+    archivo, informe_id o error de cada solicitud.
+    
+    Args:
+        solicitudes: Lista de dicts con consulta_id, credencial_seguro_id y datos adicionales
+        db: ConsultaDB
+        seguro_db: SeguroDB
+        max_procesos: Procesos del pool de renderizado
+        almacen: AlmacenArchivos donde guardar cada PDF (opcional)
+    """
+    resumen = []
+    trabajos = []
+    registros = {}
+    
+    # Leer datos en el proceso principal (los procesos del pool solo renderizan)
+    for indice, solicitud in enumerate(solicitudes):
+        consulta_id = solicitud.get('consulta_id')
+        credencial_seguro_id = solicitud.get('credencial_seguro_id')
+        resumen.append({'consulta_id': consulta_id, 'credencial_seguro_id': credencial_seguro_id})
+        
+        consulta = db.obtener_consulta(consulta_id) if consulta_id else None
+        if not consulta:
+            resumen[indice]['error'] = 'Consulta no encontrada.'
+            continue
+        
+        credencial = seguro_db.obtener_credencial(credencial_seguro_id) if credencial_seguro_id else None
+        datos_consulta, datos_paciente, datos_seguro = preparar_datos_informe(consulta, credencial, solicitud)
+        
+        trabajos.append((indice, datos_consulta, datos_paciente, datos_seguro))
+        registros[indice] = (
+            registro_informe(consulta_id, credencial_seguro_id, datos_consulta, datos_paciente, datos_seguro),
+            f"{indice + 1:03d}_{nombre_archivo_informe(datos_paciente)}"
+        )
+    
+    def entradas():
+        for indice, pdf_bytes, error in renderizar_informes(trabajos, max_procesos):
+            if error:
+                resumen[indice]['error'] = error
+                continue
+            
+            informe_data, nombre = registros[indice]
+            if almacen is not None:
+                informe_data['informe_pdf_path'] = almacen.guardar(pdf_bytes, '.pdf')['ruta']
+            resumen[indice]['archivo'] = nombre
+            resumen[indice]['informe_id'] = seguro_db.guardar_informe_medico(informe_data)
+            yield nombre, pdf_bytes
+        
+        yield 'resumen.json', json.dumps(resumen, ensure_ascii=False, indent=2).encode('utf-8')
+    
+    return zip_en_stream(entradas())
+
+def _parsear_par(texto: str) -> Dict:
+    """'12:3' -> {'consulta_id': 12, 'credencial_seguro_id': 3}"""
+    consulta_id, _, credencial_id = texto.partition(':')
+    return {
+        'consulta_id': int(consulta_id),
+        'credencial_seguro_id': int(credencial_id) if credencial_id else None
+    }
+
+def main():
+    from database import ConsultaDB, SeguroDB
+    from almacen_archivos import AlmacenArchivos, ALMACEN_ARCHIVOS_DIR
+    
+    parser = argparse.ArgumentParser(description='Genera informes médicos por lote en un ZIP')
+    parser.add_argument('informes', nargs='*', help='consulta_id[:credencial_seguro_id]')
+    parser.add_argument('--archivo', help='JSON con la lista de informes')
+    parser.add_argument('--salida', default=f"informes_{datetime.now().strftime('%Y%m%d')}.zip", help='Ruta del ZIP')
+    parser.add_argument('--procesos', type=int, default=None, help='Procesos de renderizado (default: núcleos)')
+    parser.add_argument('--db', default='consultas.db', help='Ruta de la base de datos')
+    parser.add_argument('--almacen', default=ALMACEN_ARCHIVOS_DIR, help='Directorio del almacén de PDFs')
+    args = parser.parse_args()
+    
+    solicitudes = [_parsear_par(par) for par in args.informes]
+    if args.archivo:
+        with open(args.archivo, encoding='utf-8') as f:
+            solicitudes += json.load(f)
+    
+    if not solicitudes:
+        parser.error('Indica al menos un informe o un archivo --archivo.')
+    
+    inicio = datetime.now()
+    print(f"[INFO] Generando {len(solicitudes)} informes en {args.salida}...")
+    
+    with open(args.salida, 'wb') as salida:
+        for parte in generar_lote_zip(solicitudes, ConsultaDB(args.db), SeguroDB(args.db), args.procesos, AlmacenArchivos(args.almacen)):
+            salida.write(parte)
+    
+    segundos = (datetime.now() - inicio).total_seconds()
+    print(f"[OK] Lote terminado en {segundos:.1f} s ({len(solicitudes) / max(segundos, 0.001):.1f} informes/s)")
+
+if __name__ == '__main__':
+    main()
@@ -2,13 +2,15 @@
 import os
 import sys
 import json
-import sqlite3
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from flask import Flask, render_template, request, jsonify, make_response
+from flask import Flask, render_template, request, jsonify, make_response, Response, send_file
 from io import BytesIO
 import requests
 import xlsxwriter
-import openpyxl
 from database import ConsultaDB, TransaccionDB, SeguroDB, LegalDB
 from clasificaciones_fiscales import (
     obtener_clasificaciones_por_tipo,
@@ -22,10 +24,50 @@ from formas_pago_sat import (
     es_efectivo,
     validar_deducibilidad_efectivo
 )
-from seguro_ocr import extraer_datos_credencial_imagen, consultar_info_plan
-from seguro_rag import buscar_honorario_en_tabulador, consultar_cobertura_procedimiento
-from seguro_informe import generar_informe_medico, generar_informe_generico
-from seguro_pdf import procesar_tabulador_pdf
+from seguro_ocr import (
+    extraer_datos_credencial_imagen,
+    consultar_info_plan,
+    calcular_hash_imagen,
+    recargar_catalogo_planes,
+    clave_plan
+)
+from seguro_rag import (
+    buscar_honorario_en_tabulador,
+    buscar_honorarios_en_tabulador_lote,
+    consultar_cobertura_procedimiento,
+    normalizar_procedimiento,
+    monto_numerico,
+    resultado_desde_historial,
+    resultado_desde_partida,
+    contexto_desde_candidatos
+)
+from busqueda_procedimientos import buscar_partidas_tabulador
+from seguro_informe import (
+    generar_informe_medico,
+    generar_informe_generico,
+    preparar_datos_informe,
+    registro_informe,
+    nombre_archivo_informe
+)
+from seguro_pdf import procesar_tabulador_pdf, segmentar_condiciones
+from informes_lote import generar_lote_zip, MAX_INFORMES_LOTE
+from almacen_archivos import AlmacenArchivos
+from importacion_transacciones import (
+    LectorImportacion,
+    contar_filas_csv,
+    convertir_fecha,
+    ejecutar_importacion,
+    MINUTOS_IMPORTACION_INACTIVA
+)
+from cfdi_xml import contar_xmls, es_archivo_cfdi, validar_rfc
+from impuestos_provisionales import calcular_pagos_provisionales, mes_de_corte
+from auditoria_nocturna import auditar_consentimientos
+from exportacion_transacciones import (
+    escribir_reporte_excel,
+    exportar_csv,
+    exportar_ndjson,
+    comprimir_gzip
+)
 from dotenv import load_dotenv
 
 # Cargar variables de entorno
@@ -36,6 +78,14 @@ SESSION_SECRET = os.environ.get('SESSION_SECRET', 'dev_secret_key_123')
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
 GROQ_API_KEY = os.environ.get('GROQ_API_KEY')
 
+# OCR de credenciales en segundo plano (cargas de varias imágenes)
+OCR_MAX_WORKERS = int(os.environ.get('OCR_MAX_WORKERS', '4'))
+MAX_CREDENCIALES_LOTE = 50
+MAX_COLA_OCR = 200
+
+# Validaciones por llamada a /api/transacciones/validar_lote
+MAX_VALIDACIONES_LOTE = 1000
+
 if not GEMINI_API_KEY:
     print("ADVERTENCIA: GEMINI_API_KEY no está configurado.")
     print("La funcionalidad de IA no funcionará sin esta clave.")
@@ -168,11 +218,13 @@ def call_gemini_api(prompt, api_key, force_json=False):
         traceback.print_exc()
         return None
 
-# Inicializar base de datos
-db = ConsultaDB()
-transaccion_db = TransaccionDB()
-seguro_db = SeguroDB()
-legal_db = LegalDB()
+# Bases de datos y almacén en disco de PDFs generados y firmas: se abren en
+# iniciar_servicios() (al final del módulo), no en cada importación de main.py
+db = None
+transaccion_db = None
+seguro_db = None
+legal_db = None
+almacen = None
 
 NORMAS_CONTABLES_BASE = """
 Base de conocimiento sobre normativas fiscales y legales para médicos en México:
@@ -744,9 +796,8 @@ def vista_contador():
 def vista_debug_soap():
     return render_template('debug_soap.html')
 
-@app.route('/api/transacciones', methods=['GET'])
-def obtener_transacciones_api():
-    """API para obtener transacciones con filtros"""
+def _filtros_transacciones():
+    """Filtros de transacciones de los query params (los de /api/transacciones)"""
     filtros = {
         'medico_id': request.args.get('medico_id', 'default'),
         'tipo': request.args.get('tipo'),
@@ -757,7 +808,12 @@ def obtener_transacciones_api():
     }
     
     # Remover filtros vacíos
-    filtros = {k: v for k, v in filtros.items() if v}
+    return {k: v for k, v in filtros.items() if v}
+
+@app.route('/api/transacciones', methods=['GET'])
+def obtener_transacciones_api():
+    """API para obtener transacciones con filtros"""
+    filtros = _filtros_transacciones()
     
     limite = int(request.args.get('limite', 100))
     transacciones = transaccion_db.obtener_transacciones(filtros, limite)
@@ -777,6 +833,11 @@ def crear_transaccion_api():
     forma_pago = request.json.get('forma_pago', '')
     monto = float(request.json.get('monto', 0))
     
+    # La fecha define el mes del resumen mensual: se guarda como AAAA-MM-DD
+    fecha = convertir_fecha(request.json.get('fecha'))
+    if not fecha:
+        return jsonify({"error": "Fecha inválida o vacía (usa AAAA-MM-DD o DD/MM/AAAA)"}), 400
+    
     # Validar forma de pago
     warnings = []
     if forma_pago and not validar_forma_pago(forma_pago):
@@ -802,7 +863,7 @@ def crear_transaccion_api():
             clasificacion_ia['deducible_porcentaje'] = 0
     else:
         # Clasificar automáticamente con IA
-        clasificacion_ia = transaccion_db.clasificar_con_ia(concepto, proveedor)
+        clasificacion_ia = transaccion_db.clasificar_con_ia(concepto, proveedor, tipo=tipo)
         # Si la clasificación sugerida no es válida, usar una por defecto
         if not validar_clasificacion(clasificacion_ia.get('clasificacion', ''), tipo):
             clasificaciones = obtener_lista_clasificaciones_por_tipo(tipo)
@@ -815,6 +876,7 @@ def crear_transaccion_api():
     
     transaccion_data = {
         **request.json,
+        'fecha': fecha,
         'clasificacion_ia': clasificacion_ia['clasificacion'],
         'deducible_porcentaje': clasificacion_ia['deducible_porcentaje']
     }
@@ -832,18 +894,10 @@ def crear_transaccion_api():
     
     return jsonify(response), 201
 
-@app.route('/api/transacciones/<int:transaccion_id>/validar', methods=['POST'])
-def validar_transaccion_api(transaccion_id):
-    """API para validar una transacción (aprobar/rechazar/ajustar)"""
-    if not request.json:
-        return jsonify({"error": "No se recibió datos JSON"}), 400
-    
-    clasificacion = request.json.get('clasificacion', '')
-    deducible_manual = request.json.get('deducible_porcentaje')
-    
-    # Obtener el tipo de transacción para validar la clasificación
-    transaccion = transaccion_db.obtener_transacciones({'id': transaccion_id}, limite=1)
-    tipo = transaccion[0].get('tipo', 'gasto') if transaccion else 'gasto'
+def _datos_validacion(datos, tipo):
+    """Validación de una transacción a partir del JSON (porcentaje según la clasificación o el manual)"""
+    clasificacion = datos.get('clasificacion', '')
+    deducible_manual = datos.get('deducible_porcentaje')
     
     # Validar clasificación y obtener porcentaje si es válida
     if clasificacion and validar_clasificacion(clasificacion, tipo):
@@ -854,21 +908,70 @@ def validar_transaccion_api(transaccion_id):
     else:
         porcentaje = deducible_manual if deducible_manual is not None else 0
     
-    validacion_data = {
-        'estatus': request.json.get('estatus', 'aprobado'),
+    return {
+        'estatus': datos.get('estatus', 'aprobado'),
         'clasificacion': clasificacion,
         'deducible_porcentaje': porcentaje,
-        'notas': request.json.get('notas', ''),
-        'validado_por': request.json.get('validado_por', 'contador')
+        'notas': datos.get('notas', ''),
+        'validado_por': datos.get('validado_por', 'contador')
     }
+
+@app.route('/api/transacciones/<int:transaccion_id>/validar', methods=['POST'])
+def validar_transaccion_api(transaccion_id):
+    """API para validar una transacción (aprobar/rechazar/ajustar)"""
+    if not request.json:
+        return jsonify({"error": "No se recibió datos JSON"}), 400
+    
+    # Obtener el tipo de transacción para validar la clasificación
+    tipo = transaccion_db.obtener_tipos_transacciones([transaccion_id]).get(transaccion_id, 'gasto')
     
-    success = transaccion_db.validar_transaccion(transaccion_id, validacion_data)
+    success = transaccion_db.validar_transaccion(transaccion_id, _datos_validacion(request.json, tipo))
     
     if success:
         return jsonify({"message": "Transacción validada correctamente"})
     else:
         return jsonify({"error": "No se pudo validar la transacción"}), 400
 
+@app.route('/api/transacciones/validar_lote', methods=['POST'])
+def validar_transacciones_lote_api():
+    """
+    API para validar muchas transacciones en una sola llamada (cierre de mes).
+    Body: {validaciones: [{id, estatus, clasificacion, deducible_porcentaje, notas}], validado_por, medico_id}
+    """
+    if not request.json:
+        return jsonify({"error": "No se recibió datos JSON"}), 400
+    
+    items = request.json.get('validaciones') or []
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "Se requiere la lista 'validaciones'"}), 400
+    if len(items) > MAX_VALIDACIONES_LOTE:
+        return jsonify({"error": f"Máximo {MAX_VALIDACIONES_LOTE} validaciones por llamada"}), 400
+    
+    try:
+        ids = [int(item['id']) for item in items]
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"error": "Cada validación requiere un 'id' numérico"}), 400
+    
+    # Tipos de todas las transacciones en una consulta (para validar cada clasificación)
+    tipos = transaccion_db.obtener_tipos_transacciones(ids)
+    no_encontradas = [transaccion_id for transaccion_id in ids if transaccion_id not in tipos]
+    
+    validado_por = request.json.get('validado_por', 'contador')
+    validaciones = [
+        {**_datos_validacion({'validado_por': validado_por, **item}, tipos[transaccion_id]), 'id': transaccion_id}
+        for transaccion_id, item in zip(ids, items) if transaccion_id in tipos
+    ]
+    
+    resultado = transaccion_db.validar_transacciones_lote(validaciones, request.json.get('medico_id', 'default'))
+    
+    return jsonify({
+        "success": True,
+        "actualizadas": resultado['actualizadas'],
+        "reglas_aprendidas": resultado['reglas_aprendidas'],
+        "pendientes_validacion": resultado['pendientes_validacion'],
+        "no_encontradas": no_encontradas
+    })
+
 @app.route('/api/clasificaciones', methods=['GET'])
 def obtener_clasificaciones_api():
     """API para obtener clasificaciones fiscales disponibles"""
@@ -897,7 +1000,7 @@ def clasificar_gasto_api():
     monto = request.json.get('monto', 0)
     
     # Primero intentar con reglas aprendidas
-    clasificacion_reglas = transaccion_db.clasificar_con_ia(concepto, proveedor)
+    clasificacion_reglas = transaccion_db.clasificar_con_ia(concepto, proveedor, tipo='gasto')
     
     # Si la confianza es baja, usar Gemini para clasificación inteligente
     if clasificacion_reglas['confianza'] == 'baja' and GEMINI_API_KEY:
@@ -958,6 +1061,53 @@ def estadisticas_financieras_api():
     stats = transaccion_db.obtener_estadisticas_financieras(medico_id, fecha_desde, fecha_hasta)
     return jsonify(stats)
 
+def _periodo_impuestos():
+    """(año, mes) de los query params anio y mes; por omisión el año en curso hasta el mes actual"""
+    anio = request.args.get('anio', datetime.now().year, type=int)
+    mes = request.args.get('mes', type=int) or mes_de_corte(anio)
+    if not 1 <= mes <= 12:
+        return None
+    return anio, mes
+
+@app.route('/api/contador/impuestos')
+def impuestos_provisionales_api():
+    """
+    API para los pagos provisionales de ISR e IVA de un médico, mes por mes, de
+    enero al mes indicado. Se calculan con el resumen mensual precalculado.
+    """
+    periodo = _periodo_impuestos()
+    if not periodo:
+        return jsonify({"error": "Mes inválido (1-12)"}), 400
+    anio, mes = periodo
+    medico_id = request.args.get('medico_id', 'default')
+    
+    resumenes = transaccion_db.obtener_resumen_mensual(anio, medico_id, mes)
+    resultado = calcular_pagos_provisionales(resumenes, anio, mes)
+    resultado['medico_id'] = medico_id
+    return jsonify(resultado)
+
+@app.route('/api/contador/impuestos/medicos')
+def impuestos_provisionales_medicos_api():
+    """
+    API para el pago provisional de un mes de todos los médicos (cierre mensual
+    del contador): una sola consulta al resumen mensual para todos
+    """
+    periodo = _periodo_impuestos()
+    if not periodo:
+        return jsonify({"error": "Mes inválido (1-12)"}), 400
+    anio, mes = periodo
+    
+    por_medico = {}
+    for resumen in transaccion_db.obtener_resumen_mensual(anio, None, mes):
+        por_medico.setdefault(resumen['medico_id'], []).append(resumen)
+    
+    medicos = []
+    for medico_id, resumenes in por_medico.items():
+        calculo = calcular_pagos_provisionales(resumenes, anio, mes)
+        medicos.append({'medico_id': medico_id, **calculo['meses'][-1]})
+    
+    return jsonify({"periodo": f"{anio}-{mes:02d}", "medicos": medicos})
+
 @app.route('/api/contador/template-excel')
 def template_excel_api():
     """API para descargar template Excel para importar transacciones"""
@@ -1047,9 +1197,65 @@ def template_excel_api():
     
     return response
 
+# Importaciones de Excel/CSV y CFDI en segundo plano: un solo hilo, una importación a la vez
+# (SQLite admite un escritor; varias a la vez solo competirían por el lock)
+_pool_importaciones = ThreadPoolExecutor(max_workers=1, thread_name_prefix='importacion')
+
+def _encolar_importacion(importacion_id):
+    """Encola una importación; ejecutar_importacion la reclama antes de empezar"""
+    def ejecutar():
+        importacion = transaccion_db.obtener_importacion(importacion_id)
+        if importacion:
+            ejecutar_importacion(
+                importacion_id,
+                transaccion_db,
+                almacen.ruta_absoluta(importacion['archivo_path']),
+                almacen=almacen
+            )
+    _pool_importaciones.submit(ejecutar)
+
+def _avance_importacion(importacion):
+    """Agrega porcentaje, velocidad, ETA y mensaje al registro de una importación"""
+    total = importacion.get('total_filas')
+    procesadas = importacion['procesadas'] or 0
+    importacion['porcentaje'] = None
+    importacion['filas_por_segundo'] = None
+    importacion['eta_segundos'] = None
+    
+    if importacion['estado'] == 'completado':
+        importacion['porcentaje'] = 100
+    elif total:
+        importacion['porcentaje'] = min(99, int(procesadas * 100 / total))
+    
+    # Velocidad desde que esta ejecución empezó (una importación reanudada no cuenta lo anterior)
+    if importacion['estado'] == 'procesando' and importacion.get('fecha_inicio'):
+        formato = '%Y-%m-%d %H:%M:%S'
+        segundos = (
+            datetime.strptime(importacion['fecha_actualizacion'], formato)
+            - datetime.strptime(importacion['fecha_inicio'], formato)
+        ).total_seconds()
+        avance = procesadas - (importacion.get('procesadas_al_iniciar') or 0)
+        if segundos > 0 and avance > 0:
+            velocidad = avance / segundos
+            importacion['filas_por_segundo'] = round(velocidad, 1)
+            if total:
+                importacion['eta_segundos'] = int(max(0, total - procesadas) / velocidad)
+    
+    mensaje = f"{importacion['exitosas']} transacciones importadas"
+    if importacion['duplicadas']:
+        mensaje += f", {importacion['duplicadas']} duplicadas"
+    if importacion['total_errores']:
+        mensaje += f", {importacion['total_errores']} errores"
+    importacion['mensaje'] = mensaje
+    return importacion
+
 @app.route('/api/contador/importar-excel', methods=['POST'])
 def importar_excel_api():
-    """API para importar transacciones desde un archivo Excel"""
+    """
+    API para importar transacciones desde un archivo Excel o CSV.
+    Guarda el archivo, valida las columnas y encola la importación; el avance
+    se consulta en /api/contador/importaciones/<id>.
+    """
     if 'archivo' not in request.files:
         return jsonify({"error": "No se recibió archivo"}), 400
     
@@ -1061,535 +1267,193 @@ def importar_excel_api():
     if not (archivo.filename.endswith('.xlsx') or archivo.filename.endswith('.csv')):
         return jsonify({"error": "Formato no soportado. Solo .xlsx y .csv"}), 400
     
-    exitosas = 0
-    duplicadas = 0
-    errores = []
+    medico_id = request.form.get('medico_id', 'default')
     
     try:
-        if archivo.filename.endswith('.xlsx'):
-            # Leer Excel
-            workbook = openpyxl.load_workbook(archivo)
-            worksheet = workbook.active
-            
-            # Leer headers (primera fila)
-            headers = []
-            for cell in worksheet[1]:
-                headers.append(cell.value.strip() if cell.value else '')
-            
-            # Validar que tenga las columnas necesarias
-            columnas_requeridas = ['Fecha', 'Tipo', 'Concepto', 'Total']
-            columnas_faltantes = [col for col in columnas_requeridas if col not in headers]
+        # Guardar el archivo en disco (por bloques) para importarlo en segundo plano
+        extension = os.path.splitext(archivo.filename)[1].lower()
+        guardado = almacen.guardar_stream(archivo.stream, extension)
+        ruta_archivo = almacen.ruta_absoluta(guardado['ruta'])
+        
+        # Validar que tenga las columnas necesarias (solo lee el encabezado)
+        with LectorImportacion(ruta_archivo, archivo.filename) as lector:
+            columnas_faltantes = lector.columnas_faltantes()
             if columnas_faltantes:
                 return jsonify({
                     "error": f"Columnas faltantes: {', '.join(columnas_faltantes)}",
-                    "columnas_encontradas": headers
+                    "columnas_encontradas": lector.encabezados
                 }), 400
-            
-            # Mapeo de índices de columnas
-            idx_fecha = headers.index('Fecha')
-            idx_tipo = headers.index('Tipo')
-            idx_concepto = headers.index('Concepto')
-            idx_total = headers.index('Total')
-            idx_rfc_emisor = headers.index('RFC_Emisor') if 'RFC_Emisor' in headers else None
-            idx_rfc_receptor = headers.index('RFC_Receptor') if 'RFC_Receptor' in headers else None
-            idx_uuid = headers.index('UUID') if 'UUID' in headers else None
-            idx_subtotal = headers.index('Subtotal') if 'Subtotal' in headers else None
-            idx_iva = headers.index('IVA') if 'IVA' in headers else None
-            idx_forma_pago = headers.index('Forma_Pago') if 'Forma_Pago' in headers else None
-            idx_metodo_pago = headers.index('Metodo_Pago') if 'Metodo_Pago' in headers else None
-            idx_clasificacion = headers.index('Clasificacion') if 'Clasificacion' in headers else None
-            idx_deducible = headers.index('Deducible_%') if 'Deducible_%' in headers else None
-            idx_cuenta = headers.index('Cuenta_Bancaria') if 'Cuenta_Bancaria' in headers else None
-            idx_notas = headers.index('Notas') if 'Notas' in headers else None
-            idx_proveedor = headers.index('Proveedor') if 'Proveedor' in headers else None
-            
-            # Procesar filas (empezar desde la fila 2, saltando headers y ejemplo)
-            for fila_num, row in enumerate(worksheet.iter_rows(min_row=3, values_only=False), start=3):
-                # Saltar filas vacías
-                if not any(cell.value for cell in row):
-                    continue
-                
-                try:
-                    # Extraer valores
-                    fecha_val = row[idx_fecha].value
-                    tipo_val = row[idx_tipo].value
-                    concepto_val = row[idx_concepto].value
-                    total_val = row[idx_total].value
-                    
-                    # Validaciones básicas
-                    if not fecha_val:
-                        errores.append({"fila": fila_num, "error": "Fecha inválida o vacía"})
-                        continue
-                    
-                    if not tipo_val or str(tipo_val).lower() not in ['ingreso', 'gasto']:
-                        errores.append({"fila": fila_num, "error": f"Tipo inválido: {tipo_val}. Debe ser 'Ingreso' o 'Gasto'"})
-                        continue
-                    
-                    if not concepto_val:
-                        errores.append({"fila": fila_num, "error": "Concepto vacío"})
-                        continue
-                    
-                    if not total_val or float(total_val) <= 0:
-                        errores.append({"fila": fila_num, "error": f"Monto debe ser mayor a 0. Valor: {total_val}"})
-                        continue
-                    
-                    # Convertir fecha
-                    if isinstance(fecha_val, str):
-                        try:
-                            fecha = datetime.strptime(fecha_val, '%Y-%m-%d').date()
-                        except:
-                            try:
-                                fecha = datetime.strptime(fecha_val, '%d/%m/%Y').date()
-                            except:
-                                errores.append({"fila": fila_num, "error": f"Formato de fecha inválido: {fecha_val}"})
-                                continue
-                    else:
-                        fecha = fecha_val.date() if hasattr(fecha_val, 'date') else fecha_val
-                    
-                    # Preparar datos de transacción
-                    transaccion_data = {
-                        'tipo': str(tipo_val).lower(),
-                        'fecha': fecha.strftime('%Y-%m-%d'),
-                        'monto': float(total_val),
-                        'concepto': str(concepto_val),
-                        'proveedor': str(row[idx_proveedor].value) if idx_proveedor and row[idx_proveedor].value else '',
-                        'cfdi_uuid': str(row[idx_uuid].value) if idx_uuid and row[idx_uuid].value else '',
-                        'forma_pago': str(row[idx_forma_pago].value) if idx_forma_pago and row[idx_forma_pago].value else '',
-                        'metodo_pago': str(row[idx_metodo_pago].value) if idx_metodo_pago and row[idx_metodo_pago].value else '',
-                        'clasificacion': str(row[idx_clasificacion].value) if idx_clasificacion and row[idx_clasificacion].value else '',
-                        'deducible_porcentaje': int(row[idx_deducible].value) if idx_deducible and row[idx_deducible].value else None,
-                        'notas_contador': str(row[idx_notas].value) if idx_notas and row[idx_notas].value else ''
-                    }
-                    
-                    # Validar UUID único si existe
-                    if transaccion_data['cfdi_uuid']:
-                        uuid_existente = transaccion_db.obtener_transacciones({'cfdi_uuid': transaccion_data['cfdi_uuid']}, limite=1)
-                        if uuid_existente:
-                            duplicadas += 1
-                            continue
-                    
-                    # Validar forma de pago si existe
-                    if transaccion_data['forma_pago'] and not validar_forma_pago(transaccion_data['forma_pago']):
-                        errores.append({"fila": fila_num, "error": f"Forma de pago inválida: {transaccion_data['forma_pago']}"})
-                        continue
-                    
-                    # Validar clasificación si existe
-                    if transaccion_data['clasificacion']:
-                        if not validar_clasificacion(transaccion_data['clasificacion'], transaccion_data['tipo']):
-                            # Si la clasificación no es válida, intentar clasificar con IA
-                            clasificacion_ia = transaccion_db.clasificar_con_ia(transaccion_data['concepto'], transaccion_data['proveedor'])
-                            transaccion_data['clasificacion_ia'] = clasificacion_ia['clasificacion']
-                            transaccion_data['deducible_porcentaje'] = clasificacion_ia['deducible_porcentaje']
-                        else:
-                            transaccion_data['clasificacion_ia'] = transaccion_data['clasificacion']
-                            if transaccion_data['deducible_porcentaje'] is None:
-                                transaccion_data['deducible_porcentaje'] = obtener_porcentaje_deducible(transaccion_data['clasificacion'])
-                    else:
-                        # Clasificar automáticamente
-                        clasificacion_ia = transaccion_db.clasificar_con_ia(transaccion_data['concepto'], transaccion_data['proveedor'])
-                        transaccion_data['clasificacion_ia'] = clasificacion_ia['clasificacion']
-                        transaccion_data['deducible_porcentaje'] = clasificacion_ia['deducible_porcentaje']
-                    
-                    # Validar deducibilidad de efectivo
-                    if transaccion_data['tipo'] == 'gasto' and transaccion_data['forma_pago']:
-                        validacion_efectivo = validar_deducibilidad_efectivo(transaccion_data['monto'], transaccion_data['forma_pago'])
-                        if not validacion_efectivo['es_deducible']:
-                            transaccion_data['deducible_porcentaje'] = 0
-                    
-                    # Guardar transacción
-                    transaccion_id = transaccion_db.guardar_transaccion(transaccion_data)
-                    exitosas += 1
-                    
-                except Exception as e:
-                    errores.append({"fila": fila_num, "error": f"Error procesando fila: {str(e)}"})
-                    continue
-        
-        elif archivo.filename.endswith('.csv'):
-            # Leer CSV
-            import csv
-            from io import TextIOWrapper
-            
-            csv_file = TextIOWrapper(archivo.stream, encoding='utf-8')
-            reader = csv.DictReader(csv_file)
-            
-            for fila_num, row in enumerate(reader, start=2):
-                try:
-                    # Validaciones básicas
-                    if not row.get('Fecha'):
-                        errores.append({"fila": fila_num, "error": "Fecha inválida o vacía"})
-                        continue
-                    
-                    tipo_val = row.get('Tipo', '').lower()
-                    if tipo_val not in ['ingreso', 'gasto']:
-                        errores.append({"fila": fila_num, "error": f"Tipo inválido: {row.get('Tipo')}"})
-                        continue
-                    
-                    if not row.get('Concepto'):
-                        errores.append({"fila": fila_num, "error": "Concepto vacío"})
-                        continue
-                    
-                    monto = float(row.get('Total', 0) or row.get('Monto', 0))
-                    if monto <= 0:
-                        errores.append({"fila": fila_num, "error": f"Monto debe ser mayor a 0"})
-                        continue
-                    
-                    # Convertir fecha
-                    fecha_str = row['Fecha']
-                    try:
-                        fecha = datetime.strptime(fecha_str, '%Y-%m-%d').date()
-                    except:
-                        try:
-                            fecha = datetime.strptime(fecha_str, '%d/%m/%Y').date()
-                        except:
-                            errores.append({"fila": fila_num, "error": f"Formato de fecha inválido: {fecha_str}"})
-                            continue
-                    
-                    # Preparar datos
-                    transaccion_data = {
-                        'tipo': tipo_val,
-                        'fecha': fecha.strftime('%Y-%m-%d'),
-                        'monto': monto,
-                        'concepto': row.get('Concepto', ''),
-                        'proveedor': row.get('Proveedor', ''),
-                        'cfdi_uuid': row.get('UUID', ''),
-                        'forma_pago': row.get('Forma_Pago', ''),
-                        'metodo_pago': row.get('Metodo_Pago', ''),
-                        'clasificacion': row.get('Clasificacion', ''),
-                        'deducible_porcentaje': int(row['Deducible_%']) if row.get('Deducible_%') else None,
-                        'notas_contador': row.get('Notas', '')
-                    }
-                    
-                    # Validar UUID único
-                    if transaccion_data['cfdi_uuid']:
-                        uuid_existente = transaccion_db.obtener_transacciones({'cfdi_uuid': transaccion_data['cfdi_uuid']}, limite=1)
-                        if uuid_existente:
-                            duplicadas += 1
-                            continue
-                    
-                    # Validar y clasificar
-                    if transaccion_data['clasificacion'] and validar_clasificacion(transaccion_data['clasificacion'], tipo_val):
-                        transaccion_data['clasificacion_ia'] = transaccion_data['clasificacion']
-                        if transaccion_data['deducible_porcentaje'] is None:
-                            transaccion_data['deducible_porcentaje'] = obtener_porcentaje_deducible(transaccion_data['clasificacion'])
-                    else:
-                        clasificacion_ia = transaccion_db.clasificar_con_ia(transaccion_data['concepto'], transaccion_data['proveedor'])
-                        transaccion_data['clasificacion_ia'] = clasificacion_ia['clasificacion']
-                        transaccion_data['deducible_porcentaje'] = clasificacion_ia['deducible_porcentaje']
-                    
-                    # Validar efectivo
-                    if transaccion_data['tipo'] == 'gasto' and transaccion_data['forma_pago']:
-                        validacion_efectivo = validar_deducibilidad_efectivo(transaccion_data['monto'], transaccion_data['forma_pago'])
-                        if not validacion_efectivo['es_deducible']:
-                            transaccion_data['deducible_porcentaje'] = 0
-                    
-                    transaccion_id = transaccion_db.guardar_transaccion(transaccion_data)
-                    exitosas += 1
-                    
-                except Exception as e:
-                    errores.append({"fila": fila_num, "error": f"Error procesando fila: {str(e)}"})
-                    continue
+            total_filas = lector.estimar_total_filas() if lector.es_xlsx else contar_filas_csv(ruta_archivo)
+        
+        importacion_id = transaccion_db.crear_importacion({
+            'medico_id': medico_id,
+            'nombre_archivo': archivo.filename,
+            'archivo_path': guardado['ruta'],
+            'total_filas': total_filas
+        })
     
     except Exception as e:
         return jsonify({"error": f"Error al procesar archivo: {str(e)}"}), 500
     
-    mensaje = f"{exitosas} transacciones importadas"
-    if duplicadas > 0:
-        mensaje += f", {duplicadas} duplicadas"
-    if errores:
-        mensaje += f", {len(errores)} errores"
+    _encolar_importacion(importacion_id)
     
     return jsonify({
-        "exitosas": exitosas,
-        "duplicadas": duplicadas,
-        "errores": errores,
-        "mensaje": mensaje
-    })
-
-@app.route('/api/contador/exportar-excel')
-def exportar_excel_completo_api():
-    """API para exportar reporte completo a Excel con 3 hojas"""
-    # Obtener filtros
-    filtros = {
-        'medico_id': request.args.get('medico_id', 'default'),
-        'tipo': request.args.get('tipo'),
-        'estatus_validacion': request.args.get('estatus'),
-        'fecha_desde': request.args.get('fecha_desde'),
-        'fecha_hasta': request.args.get('fecha_hasta')
-    }
-    filtros = {k: v for k, v in filtros.items() if v}
-    
-    # Obtener transacciones
-    transacciones = transaccion_db.obtener_transacciones(filtros, limite=10000)
-    
-    # Obtener estadísticas
-    stats = transaccion_db.obtener_estadisticas_financieras(
-        filtros.get('medico_id', 'default'),
-        filtros.get('fecha_desde'),
-        filtros.get('fecha_hasta')
-    )
-    
-    # Crear archivo en memoria
-    output = BytesIO()
-    workbook = xlsxwriter.Workbook(output, {'in_memory': True})
+        "success": True,
+        "importacion_id": importacion_id,
+        "estado": "pendiente",
+        "total_filas": total_filas
+    }), 202
+
+@app.route('/api/contador/importar-cfdi', methods=['POST'])
+def importar_cfdi_api():
+    """
+    API para importar CFDI: un XML (3.3 o 4.0) o un ZIP con los XML del periodo.
+    Con el RFC del médico cada CFDI se registra como ingreso (emitido) o gasto
+    (recibido). Se importa en segundo plano como los archivos de Excel; el
+    avance se consulta en /api/contador/importaciones/<id>.
+    """
+    if 'archivo' not in request.files:
+        return jsonify({"error": "No se recibió archivo"}), 400
     
-    # Estilos
-    header_format = workbook.add_format({
-        'bold': True,
-        'bg_color': '#4472C4',
-        'font_color': '#FFFFFF',
-        'border': 1,
-        'align': 'center',
-        'valign': 'vcenter'
-    })
+    archivo = request.files['archivo']
+    if archivo.filename == '':
+        return jsonify({"error": "Archivo vacío"}), 400
     
-    date_format = workbook.add_format({'num_format': 'dd/mm/yyyy'})
-    currency_format = workbook.add_format({'num_format': '$#,##0.00'})
-    currency_bold_format = workbook.add_format({
-        'num_format': '$#,##0.00',
-        'bold': True
-    })
-    bold_format = workbook.add_format({'bold': True})
-    percent_format = workbook.add_format({'num_format': '0%'})
-    
-    # ============================================
-    # HOJA 1: TRANSACCIONES
-    # ============================================
-    worksheet1 = workbook.add_worksheet('Transacciones')
-    
-    headers1 = [
-        'ID', 'Fecha', 'Tipo', 'RFC_Emisor', 'RFC_Receptor', 'UUID',
-        'Concepto', 'Proveedor', 'Subtotal', 'IVA', 'Total',
-        'Forma_Pago', 'Metodo_Pago', 'Clasificacion',
-        'Deducible_%', 'Cuenta_Bancaria', 'Estatus', 'Notas'
-    ]
+    if not es_archivo_cfdi(archivo.filename):
+        return jsonify({"error": "Formato no soportado. Solo .xml y .zip"}), 400
     
-    # Escribir headers
-    for col, header in enumerate(headers1):
-        worksheet1.write(0, col, header, header_format)
+    rfc = request.form.get('rfc', '').strip().upper()
+    if not validar_rfc(rfc):
+        return jsonify({"error": "RFC del médico inválido o faltante"}), 400
     
-    # Escribir datos
-    total_ingresos = 0
-    total_gastos = 0
+    medico_id = request.form.get('medico_id', 'default')
     
-    for row_num, t in enumerate(transacciones, start=1):
-        tipo = t.get('tipo', '')
-        monto = float(t.get('monto', 0))
+    try:
+        extension = os.path.splitext(archivo.filename)[1].lower()
+        guardado = almacen.guardar_stream(archivo.stream, extension)
+        total_xmls = contar_xmls(almacen.ruta_absoluta(guardado['ruta']), archivo.filename)
+        if not total_xmls:
+            return jsonify({"error": "El ZIP no contiene archivos XML"}), 400
         
-        if tipo == 'ingreso':
-            total_ingresos += monto
-        else:
-            total_gastos += monto
-        
-        # Calcular subtotal e IVA (asumiendo IVA 0% para honorarios médicos)
-        subtotal = monto
-        iva = 0.0
-        
-        worksheet1.write(row_num, 0, t.get('id', ''))
-        worksheet1.write(row_num, 1, t.get('fecha', ''), date_format)
-        worksheet1.write(row_num, 2, tipo.upper() if tipo else '')
-        worksheet1.write(row_num, 3, '')  # RFC_Emisor
-        worksheet1.write(row_num, 4, '')  # RFC_Receptor
-        worksheet1.write(row_num, 5, t.get('cfdi_uuid', ''))
-        worksheet1.write(row_num, 6, t.get('concepto', ''))
-        worksheet1.write(row_num, 7, t.get('proveedor', ''))
-        worksheet1.write(row_num, 8, subtotal, currency_format)
-        worksheet1.write(row_num, 9, iva, currency_format)
-        worksheet1.write(row_num, 10, monto, currency_format)
-        worksheet1.write(row_num, 11, t.get('forma_pago', ''))
-        worksheet1.write(row_num, 12, t.get('metodo_pago', ''))
-        worksheet1.write(row_num, 13, t.get('clasificacion_contador') or t.get('clasificacion_ia', ''))
-        worksheet1.write(row_num, 14, t.get('deducible_porcentaje', 0))
-        worksheet1.write(row_num, 15, '')  # Cuenta_Bancaria
-        worksheet1.write(row_num, 16, t.get('estatus_validacion', '').upper())
-        worksheet1.write(row_num, 17, t.get('notas_contador', ''))
-    
-    # Totales al final
-    total_row = len(transacciones) + 2
-    worksheet1.write(total_row, 6, 'TOTALES', bold_format)
-    worksheet1.write(total_row, 8, total_ingresos + total_gastos, currency_bold_format)
-    worksheet1.write(total_row, 9, 0, currency_bold_format)
-    worksheet1.write(total_row, 10, total_ingresos + total_gastos, currency_bold_format)
-    
-    # Ajustar ancho de columnas
-    worksheet1.set_column('A:A', 8)   # ID
-    worksheet1.set_column('B:B', 12)  # Fecha
-    worksheet1.set_column('C:C', 10)  # Tipo
-    worksheet1.set_column('D:E', 15)  # RFCs
-    worksheet1.set_column('F:F', 36)  # UUID
-    worksheet1.set_column('G:G', 25)  # Concepto
-    worksheet1.set_column('H:H', 20)  # Proveedor
-    worksheet1.set_column('I:K', 12)  # Montos
-    worksheet1.set_column('L:L', 30)  # Forma_Pago
-    worksheet1.set_column('M:M', 20)  # Metodo_Pago
-    worksheet1.set_column('N:N', 25)  # Clasificacion
-    worksheet1.set_column('O:O', 12)   # Deducible_%
-    worksheet1.set_column('P:P', 15)  # Cuenta_Bancaria
-    worksheet1.set_column('Q:Q', 12)   # Estatus
-    worksheet1.set_column('R:R', 30)  # Notas
-    
-    # ============================================
-    # HOJA 2: RESUMEN
-    # ============================================
-    worksheet2 = workbook.add_worksheet('Resumen')
-    
-    # Título
-    worksheet2.write(0, 0, 'RESUMEN FINANCIERO', bold_format)
-    worksheet2.write(1, 0, '')
-    
-    # Totales principales
-    row = 2
-    worksheet2.write(row, 0, 'Total Ingresos:', bold_format)
-    worksheet2.write(row, 1, stats.get('ingresos_totales', 0), currency_format)
-    row += 1
-    
-    worksheet2.write(row, 0, 'Total Gastos:', bold_format)
-    worksheet2.write(row, 1, stats.get('gastos_totales', 0), currency_format)
-    row += 1
-    
-    worksheet2.write(row, 0, 'Utilidad (Ingresos - Gastos):', bold_format)
-    worksheet2.write(row, 1, stats.get('utilidad', 0), currency_bold_format)
-    row += 2
-    
-    # Tabla por clasificación
-    worksheet2.write(row, 0, 'CLASIFICACIÓN', header_format)
-    worksheet2.write(row, 1, 'MONTO', header_format)
-    worksheet2.write(row, 2, '% DEL TOTAL', header_format)
-    row += 1
-    
-    # Agrupar por clasificación
-    clasificaciones_dict = {}
-    total_clasificaciones = 0
-    
-    for t in transacciones:
-        clasif = t.get('clasificacion_contador') or t.get('clasificacion_ia', 'Sin clasificar')
-        monto = float(t.get('monto', 0))
-        if clasif not in clasificaciones_dict:
-            clasificaciones_dict[clasif] = 0
-        clasificaciones_dict[clasif] += monto
-        total_clasificaciones += monto
-    
-    # Ordenar por monto descendente
-    clasificaciones_sorted = sorted(clasificaciones_dict.items(), key=lambda x: x[1], reverse=True)
-    
-    for clasif, monto in clasificaciones_sorted:
-        porcentaje = (monto / total_clasificaciones * 100) if total_clasificaciones > 0 else 0
-        worksheet2.write(row, 0, clasif)
-        worksheet2.write(row, 1, monto, currency_format)
-        worksheet2.write(row, 2, porcentaje / 100, percent_format)
-        row += 1
-    
-    # Total de clasificaciones
-    worksheet2.write(row, 0, 'TOTAL', bold_format)
-    worksheet2.write(row, 1, total_clasificaciones, currency_bold_format)
-    worksheet2.write(row, 2, 1.0, percent_format)
-    
-    # Ajustar ancho de columnas
-    worksheet2.set_column('A:A', 30)
-    worksheet2.set_column('B:B', 15)
-    worksheet2.set_column('C:C', 12)
-    
-    # ============================================
-    # HOJA 3: DEDUCIBLES
-    # ============================================
-    worksheet3 = workbook.add_worksheet('Deducibles')
+        importacion_id = transaccion_db.crear_importacion({
+            'medico_id': medico_id,
+            'nombre_archivo': archivo.filename,
+            'archivo_path': guardado['ruta'],
+            'total_filas': total_xmls,
+            'rfc_medico': rfc
+        })
     
-    headers3 = [
-        'Fecha', 'Concepto', 'Proveedor', 'Monto', '% Deducible', 'Monto Deducible'
-    ]
+    except zipfile.BadZipFile:
+        return jsonify({"error": "El archivo ZIP está dañado"}), 400
+    except Exception as e:
+        return jsonify({"error": f"Error al procesar archivo: {str(e)}"}), 500
     
-    # Escribir headers
-    for col, header in enumerate(headers3):
-        worksheet3.write(0, col, header, header_format)
-    
-    # Filtrar solo gastos deducibles aprobados
-    gastos_deducibles = [
-        t for t in transacciones
-        if t.get('tipo') == 'gasto' 
-        and t.get('estatus_validacion') == 'aprobado'
-        and t.get('deducible_porcentaje', 0) > 0
-    ]
+    _encolar_importacion(importacion_id)
     
-    total_deducible = 0
+    return jsonify({
+        "success": True,
+        "importacion_id": importacion_id,
+        "estado": "pendiente",
+        "total_filas": total_xmls
+    }), 202
+
+@app.route('/api/contador/importaciones')
+def listar_importaciones_api():
+    """API para listar las importaciones recientes con su avance"""
+    medico_id = request.args.get('medico_id', 'default')
+    limite = min(request.args.get('limite', 20, type=int), 100)
     
-    # Escribir datos
-    for row_num, t in enumerate(gastos_deducibles, start=1):
-        monto = float(t.get('monto', 0))
-        porcentaje = float(t.get('deducible_porcentaje', 0))
-        monto_deducible = monto * (porcentaje / 100.0)
-        total_deducible += monto_deducible
-        
-        worksheet3.write(row_num, 0, t.get('fecha', ''), date_format)
-        worksheet3.write(row_num, 1, t.get('concepto', ''))
-        worksheet3.write(row_num, 2, t.get('proveedor', ''))
-        worksheet3.write(row_num, 3, monto, currency_format)
-        worksheet3.write(row_num, 4, porcentaje / 100, percent_format)
-        worksheet3.write(row_num, 5, monto_deducible, currency_format)
+    importaciones = [_avance_importacion(i) for i in transaccion_db.obtener_importaciones(medico_id, limite)]
+    return jsonify({"importaciones": importaciones})
+
+@app.route('/api/contador/importaciones/<int:importacion_id>')
+def obtener_importacion_api(importacion_id):
+    """API para consultar el avance de una importación (procesadas, exitosas, duplicadas, errores, ETA)"""
+    importacion = transaccion_db.obtener_importacion(importacion_id)
+    if not importacion:
+        return jsonify({"error": "Importación no encontrada"}), 404
     
-    # Total deducible al final
-    total_row3 = len(gastos_deducibles) + 2
-    worksheet3.write(total_row3, 3, 'TOTAL DEDUCIBLE', bold_format)
-    worksheet3.write(total_row3, 5, total_deducible, currency_bold_format)
+    importacion = _avance_importacion(importacion)
+    importacion['terminado'] = importacion['estado'] in ('completado', 'error')
+    return jsonify(importacion)
+
+@app.route('/api/contador/importaciones/<int:importacion_id>/reanudar', methods=['POST'])
+def reanudar_importacion_api(importacion_id):
+    """API para reintentar una importación con error o interrumpida desde su último lote guardado"""
+    importacion = transaccion_db.obtener_importacion(importacion_id)
+    if not importacion:
+        return jsonify({"error": "Importación no encontrada"}), 404
     
-    # Ajustar ancho de columnas
-    worksheet3.set_column('A:A', 12)  # Fecha
-    worksheet3.set_column('B:B', 30)  # Concepto
-    worksheet3.set_column('C:C', 20)  # Proveedor
-    worksheet3.set_column('D:D', 15)  # Monto
-    worksheet3.set_column('E:E', 15)  # % Deducible
-    worksheet3.set_column('F:F', 18)  # Monto Deducible
+    if importacion['estado'] == 'completado':
+        return jsonify({"error": "La importación ya terminó"}), 400
     
-    workbook.close()
-    output.seek(0)
+    _encolar_importacion(importacion_id)
+    return jsonify({
+        "success": True,
+        "importacion_id": importacion_id,
+        "desde_fila": importacion['ultima_fila']
+    }), 202
+
+@app.route('/api/contador/exportar-excel')
+def exportar_excel_completo_api():
+    """
+    API para exportar reporte completo a Excel con 3 hojas (sin límite de filas).
+    El libro se escribe a un archivo temporal en modo constant_memory y se envía en stream.
+    """
+    # Los mismos filtros que /api/transacciones (las tres hojas los respetan)
+    filtros = _filtros_transacciones()
+    
+    # El archivo temporal se borra al cerrarse (send_file lo cierra al terminar la respuesta)
+    salida = tempfile.TemporaryFile()
+    try:
+        escribir_reporte_excel(salida, transaccion_db, filtros)
+        salida.seek(0)
+    except Exception as e:
+        salida.close()
+        return jsonify({"error": f"Error al generar el reporte: {str(e)}"}), 500
     
     # Nombre del archivo
     mes_ano = datetime.now().strftime('%m_%Y')
     medico_nombre = filtros.get('medico_id', 'Doctor')
     filename = f'Reporte_Fiscal_{medico_nombre}_{mes_ano}.xlsx'
     
-    response = make_response(output.getvalue())
-    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
-    response.headers["Content-type"] = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-    
-    return response
+    return send_file(
+        salida,
+        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        as_attachment=True,
+        download_name=filename
+    )
 
 @app.route('/api/exportar_transacciones')
 def exportar_transacciones_api():
-    """API para exportar transacciones a CSV (legacy)"""
-    import csv
-    from io import StringIO
-    
-    filtros = {
-        'medico_id': request.args.get('medico_id', 'default'),
-        'tipo': request.args.get('tipo'),
-        'estatus_validacion': request.args.get('estatus'),
-        'fecha_desde': request.args.get('fecha_desde'),
-        'fecha_hasta': request.args.get('fecha_hasta')
-    }
-    filtros = {k: v for k, v in filtros.items() if v}
-    
-    transacciones = transaccion_db.obtener_transacciones(filtros, limite=10000)
-    
-    # Crear CSV
-    si = StringIO()
-    writer = csv.writer(si)
-    
-    # Encabezados
-    writer.writerow(['ID', 'Fecha', 'Tipo', 'Concepto', 'Proveedor', 'Monto', 
-                     'Clasificación', 'Deducible %', 'Estatus', 'Notas'])
-    
-    # Datos
-    for t in transacciones:
-        writer.writerow([
-            t['id'], t['fecha'], t['tipo'], t['concepto'], t.get('proveedor', ''),
-            t['monto'], t.get('clasificacion_contador') or t.get('clasificacion_ia', ''),
-            t['deducible_porcentaje'], t['estatus_validacion'], t.get('notas_contador', '')
-        ])
+    """
+    API para exportar transacciones a CSV o NDJSON en stream, sin límite de filas.
+    Query params: los filtros de /api/transacciones, formato (csv|ndjson) y gzip (1 para comprimir).
+    """
+    filtros = _filtros_transacciones()
+    formato = request.args.get('formato', 'csv').lower()
+    if formato not in ('csv', 'ndjson'):
+        return jsonify({"error": "Formato no soportado. Usa csv o ndjson"}), 400
+    comprimir = request.args.get('gzip', '').lower() in ('1', 'true', 'si')
+    
+    # Las filas salen del cursor conforme se envían (la memoria no crece con el número de transacciones)
+    transacciones = transaccion_db.iterar_transacciones(filtros)
+    if formato == 'ndjson':
+        bloques = exportar_ndjson(transacciones)
+        mimetype = 'application/x-ndjson'
+    else:
+        bloques = exportar_csv(transacciones)
+        mimetype = 'text/csv'
     
-    output = make_response(si.getvalue())
-    output.headers["Content-Disposition"] = "attachment; filename=transacciones.csv"
-    output.headers["Content-type"] = "text/csv"
+    filename = f'transacciones.{formato}'
+    if comprimir:
+        bloques = comprimir_gzip(bloques)
+        mimetype = 'application/gzip'
+        filename += '.gz'
     
-    return output
+    response = Response(bloques, mimetype=mimetype)
+    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    return response
 
 # ============================================
 # MÓDULO DE SEGUROS - ENDPOINTS
@@ -1614,55 +1478,9 @@ def procesar_credencial_api():
         return jsonify({"error": "Archivo de imagen vacío."}), 400
     
     try:
-        # Leer imagen
-        imagen_bytes = imagen_file.read()
-        
-        # Extraer datos usando OCR con Gemini Vision
-        datos_extractos = extraer_datos_credencial_imagen(imagen_bytes, GEMINI_API_KEY)
-        
-        if not datos_extractos or not datos_extractos.get('aseguradora'):
-            return jsonify({
-                "error": "No se pudo extraer información de la credencial. Por favor, asegúrate de que la imagen sea clara.",
-                "datos_parciales": datos_extractos
-            }), 400
-        
-        # Obtener información del plan (deducible, coaseguro, hospitales)
-        aseguradora = datos_extractos.get('aseguradora', '')
-        plan_nombre = datos_extractos.get('plan_nombre', '')
-        
-        info_plan = consultar_info_plan(aseguradora, plan_nombre)
-        
-        # Preparar datos para guardar
-        credencial_data = {
-            'medico_id': 'default',
-            'paciente_nombre': datos_extractos.get('paciente_nombre', ''),
-            'aseguradora': aseguradora,
-            'numero_poliza': datos_extractos.get('numero_poliza', ''),
-            'plan_nombre': plan_nombre,
-            'nivel_hospitalario': datos_extractos.get('nivel_hospitalario', ''),
-            'deducible_estimado': info_plan.get('deducible_estimado'),
-            'coaseguro_porcentaje': info_plan.get('coaseguro_porcentaje'),
-            'hospitales_red': info_plan.get('hospitales_red', ''),
-            'datos_extractos': json.dumps(datos_extractos, ensure_ascii=False)
-        }
-        
-        # Guardar credencial
-        credencial_id = seguro_db.guardar_credencial(credencial_data)
-        
-        return jsonify({
-            "success": True,
-            "credencial_id": credencial_id,
-            "datos": {
-                "aseguradora": aseguradora,
-                "numero_poliza": datos_extractos.get('numero_poliza', ''),
-                "plan_nombre": plan_nombre,
-                "deducible_estimado": info_plan.get('deducible_estimado'),
-                "coaseguro_porcentaje": info_plan.get('coaseguro_porcentaje'),
-                "hospitales_red": info_plan.get('hospitales_red', ''),
-                "nivel_hospitalario": datos_extractos.get('nivel_hospitalario', ''),
-                "paciente_nombre": datos_extractos.get('paciente_nombre', '')
-            }
-        })
+        forzar_ocr = request.form.get('forzar_ocr', '').lower() in ('1', 'true', 'si')
+        respuesta, status = _procesar_imagen_credencial(imagen_file.read(), forzar_ocr)
+        return jsonify(respuesta), status
         
     except Exception as e:
         import traceback
@@ -1673,6 +1491,174 @@ def procesar_credencial_api():
             "debug": {"traceback": error_details[:500]}
         }), 500
 
+def _datos_credencial(credencial):
+    """Datos de respuesta de una credencial (guardada o por guardar)"""
+    return {
+        "aseguradora": credencial.get('aseguradora', ''),
+        "numero_poliza": credencial.get('numero_poliza', ''),
+        "plan_nombre": credencial.get('plan_nombre', ''),
+        "deducible_estimado": credencial.get('deducible_estimado'),
+        "coaseguro_porcentaje": credencial.get('coaseguro_porcentaje'),
+        "hospitales_red": credencial.get('hospitales_red', ''),
+        "nivel_hospitalario": credencial.get('nivel_hospitalario', ''),
+        "paciente_nombre": credencial.get('paciente_nombre', '')
+    }
+
+def _procesar_imagen_credencial(imagen_bytes, forzar_ocr=False):
+    """
+    Procesa la imagen de una credencial: reutiliza el OCR de una foto idéntica
+    o extrae los datos con Gemini Vision, y guarda la credencial.
+    
+    Returns:
+        (respuesta, status HTTP)
+    """
+    # Credencial ya fotografiada en otra visita: reutilizar el OCR previo
+    imagen_hash = calcular_hash_imagen(imagen_bytes)
+    if not forzar_ocr:
+        credencial_previa = seguro_db.buscar_credencial_por_hash(imagen_hash)
+        if credencial_previa:
+            return {
+                "success": True,
+                "credencial_id": credencial_previa['id'],
+                "desde_cache": True,
+                "datos": _datos_credencial(credencial_previa)
+            }, 200
+    
+    # Extraer datos usando OCR con Gemini Vision
+    metricas_ocr = {}
+    datos_extractos = extraer_datos_credencial_imagen(imagen_bytes, GEMINI_API_KEY, metricas=metricas_ocr)
+    print(f"[INFO] OCR credencial: {metricas_ocr.get('bytes_original')} -> {metricas_ocr.get('bytes_enviados')} bytes "
+          f"(-{metricas_ocr.get('reduccion_porcentaje')}%), {metricas_ocr.get('ocr_ms')} ms")
+    
+    if not datos_extractos or not datos_extractos.get('aseguradora'):
+        return {
+            "error": "No se pudo extraer información de la credencial. Por favor, asegúrate de que la imagen sea clara.",
+            "datos_parciales": datos_extractos,
+            "metricas_ocr": metricas_ocr
+        }, 400
+    
+    # Obtener información del plan (deducible, coaseguro, hospitales)
+    aseguradora = datos_extractos.get('aseguradora', '')
+    plan_nombre = datos_extractos.get('plan_nombre', '')
+    
+    info_plan = consultar_info_plan(aseguradora, plan_nombre)
+    
+    # Preparar datos para guardar
+    credencial_data = {
+        'medico_id': 'default',
+        'paciente_nombre': datos_extractos.get('paciente_nombre', ''),
+        'aseguradora': aseguradora,
+        'numero_poliza': datos_extractos.get('numero_poliza', ''),
+        'plan_nombre': plan_nombre,
+        'nivel_hospitalario': datos_extractos.get('nivel_hospitalario', ''),
+        'deducible_estimado': info_plan.get('deducible_estimado'),
+        'coaseguro_porcentaje': info_plan.get('coaseguro_porcentaje'),
+        'hospitales_red': info_plan.get('hospitales_red', ''),
+        'datos_extractos': json.dumps(datos_extractos, ensure_ascii=False),
+        'ocr_bytes_original': metricas_ocr.get('bytes_original'),
+        'ocr_bytes_enviados': metricas_ocr.get('bytes_enviados'),
+        'ocr_ms': metricas_ocr.get('ocr_ms'),
+        'imagen_hash': imagen_hash
+    }
+    
+    # Guardar credencial
+    credencial_id = seguro_db.guardar_credencial(credencial_data)
+    
+    return {
+        "success": True,
+        "credencial_id": credencial_id,
+        "datos": _datos_credencial(credencial_data),
+        "metricas_ocr": metricas_ocr
+    }, 200
+
+# Pool de OCR de credenciales: las llamadas a Gemini esperan red, así que se usan hilos
+_pool_ocr = ThreadPoolExecutor(max_workers=OCR_MAX_WORKERS, thread_name_prefix='ocr_credencial')
+_ocr_en_cola = 0
+_ocr_cola_lock = threading.Lock()
+
+def _procesar_item_lote_credenciales(item_id, imagen_bytes, forzar_ocr):
+    """Procesa una imagen de una carga de credenciales en un hilo del pool de OCR"""
+    global _ocr_en_cola
+    try:
+        seguro_db.actualizar_item_lote_credenciales(item_id, 'procesando')
+        respuesta, status = _procesar_imagen_credencial(imagen_bytes, forzar_ocr)
+        if status == 200:
+            seguro_db.actualizar_item_lote_credenciales(
+                item_id, 'completado', credencial_id=respuesta['credencial_id'], resultado=respuesta
+            )
+        else:
+            seguro_db.actualizar_item_lote_credenciales(item_id, 'error', resultado=respuesta, error=respuesta.get('error'))
+    except Exception as e:
+        print(f"[ERROR] OCR credencial (item {item_id}): {e}")
+        seguro_db.actualizar_item_lote_credenciales(item_id, 'error', error=str(e))
+    finally:
+        with _ocr_cola_lock:
+            _ocr_en_cola -= 1
+
+def _tabulador_vigente(aseguradora):
+    """Retorna (tabulador_id, contenido_texto) del tabulador activo más reciente de la aseguradora"""
+    tabulador = seguro_db.obtener_tabulador_vigente(aseguradora)
+    if not tabulador:
+        return None, None
+    return tabulador.get('id'), tabulador.get('contenido_texto', '')
+
+def _resolver_honorario_local(aseguradora, plan_nombre, procedimiento, codigo_cpt, tabulador_id, contenido_tabulador):
+    """
+    Intenta resolver un honorario sin llamar a la IA: primero con el historial de
+    consultas_honorarios y después con una partida del tabulador con el mismo código
+    CPT o el mismo nombre normalizado.
+    
+    Returns:
+        (resultado o None, candidatos del tabulador)
+    """
+    consulta_previa = seguro_db.buscar_honorario_memorizado(
+        tabulador_id=tabulador_id,
+        plan_nombre=plan_nombre,
+        procedimiento_normalizado=normalizar_procedimiento(procedimiento),
+        codigo_cpt=codigo_cpt
+    )
+    if consulta_previa:
+        return resultado_desde_historial(consulta_previa, aseguradora, plan_nombre), []
+    
+    # Buscar renglones candidatos en el índice de trigramas del tabulador
+    candidatos = []
+    if tabulador_id and contenido_tabulador:
+        candidatos = buscar_partidas_tabulador(tabulador_id, contenido_tabulador, procedimiento, codigo_cpt)
+    
+    # Solo el mismo código CPT o el mismo nombre se responde sin IA; los parecidos
+    # (ej: bilateral / unilateral) van como candidatos para que la IA decida
+    exacta = next((c for c in candidatos if c.get('exacta') and c.get('monto')), None)
+    if exacta:
+        return resultado_desde_partida(exacta, aseguradora, plan_nombre), candidatos
+    
+    return None, candidatos
+
+def _resumen_candidatos(candidatos):
+    """Formato de respuesta de los renglones candidatos del tabulador"""
+    return [
+        {'descripcion': c['descripcion'], 'codigo_cpt': c['codigo'], 'monto': c['monto'], 'similitud': c['similitud']}
+        for c in candidatos
+    ]
+
+def _guardar_honorario_encontrado(aseguradora, plan_nombre, procedimiento, codigo_cpt, tabulador_id, resultado):
+    """Guarda en consultas_honorarios un honorario nuevo encontrado (no los reutilizados)"""
+    if not resultado.get('monto') or resultado.get('desde_historial'):
+        return
+    
+    consulta_data = {
+        'medico_id': 'default',
+        'aseguradora': aseguradora,
+        'plan_nombre': plan_nombre,
+        'procedimiento': procedimiento,
+        'codigo_cpt': resultado.get('codigo_cpt') or codigo_cpt,
+        'monto_encontrado': resultado.get('monto'),
+        'fuente_tabulador_id': tabulador_id,
+        'procedimiento_normalizado': normalizar_procedimiento(procedimiento),
+        'descripcion': resultado.get('descripcion', ''),
+        'confianza': resultado.get('confianza', '')
+    }
+    seguro_db.guardar_consulta_honorario(consulta_data)
+
 @app.route('/api/seguros/buscar_honorario', methods=['POST'])
 def buscar_honorario_api():
     """API para buscar honorario de un procedimiento en tabulador usando RAG"""
@@ -1689,43 +1675,32 @@ def buscar_honorario_api():
     
     try:
         # Buscar tabulador activo de la aseguradora
-        tabuladores = seguro_db.obtener_tabuladores(aseguradora=aseguradora, activo=True)
-        
-        contenido_tabulador = None
-        tabulador_id = None
-        
-        if tabuladores:
-            # Usar el tabulador más reciente
-            tabulador = tabuladores[0]
-            contenido_tabulador = tabulador.get('contenido_texto', '')
-            tabulador_id = tabulador.get('id')
-        
-        # Buscar honorario usando RAG
-        resultado = buscar_honorario_en_tabulador(
-            aseguradora=aseguradora,
-            plan_nombre=plan_nombre,
-            procedimiento=procedimiento,
-            codigo_cpt=codigo_cpt,
-            tabulador_id=tabulador_id,
-            contenido_tabulador=contenido_tabulador,
-            api_key=GEMINI_API_KEY
+        tabulador_id, contenido_tabulador = _tabulador_vigente(aseguradora)
+        
+        # Historial de consultas e índice de trigramas antes de llamar a la IA
+        resultado, candidatos = _resolver_honorario_local(
+            aseguradora, plan_nombre, procedimiento, codigo_cpt, tabulador_id, contenido_tabulador
         )
         
+        if resultado is None:
+            # Buscar honorario usando RAG (con los candidatos al inicio del contexto)
+            resultado = buscar_honorario_en_tabulador(
+                aseguradora=aseguradora,
+                plan_nombre=plan_nombre,
+                procedimiento=procedimiento,
+                codigo_cpt=codigo_cpt,
+                tabulador_id=tabulador_id,
+                contenido_tabulador=contexto_desde_candidatos(candidatos, contenido_tabulador),
+                api_key=GEMINI_API_KEY
+            )
+        
         if resultado.get('error'):
             return jsonify(resultado), 500
         
+        resultado['candidatos'] = _resumen_candidatos(candidatos)
+        
         # Guardar consulta
-        if resultado.get('monto'):
-            consulta_data = {
-                'medico_id': 'default',
-                'aseguradora': aseguradora,
-                'plan_nombre': plan_nombre,
-                'procedimiento': procedimiento,
-                'codigo_cpt': resultado.get('codigo_cpt') or codigo_cpt,
-                'monto_encontrado': resultado.get('monto'),
-                'fuente_tabulador_id': tabulador_id
-            }
-            seguro_db.guardar_consulta_honorario(consulta_data)
+        _guardar_honorario_encontrado(aseguradora, plan_nombre, procedimiento, codigo_cpt, tabulador_id, resultado)
         
         return jsonify({
             "success": True,
@@ -1741,6 +1716,100 @@ def buscar_honorario_api():
             "debug": {"traceback": error_details[:500]}
         }), 500
 
+@app.route('/api/seguros/buscar_honorarios_lote', methods=['POST'])
+def buscar_honorarios_lote_api():
+    """API para buscar honorarios de varios procedimientos de un mismo caso (una sola llamada a la IA)"""
+    if not request.json:
+        return jsonify({"error": "No se recibió datos JSON."}), 400
+    
+    aseguradora = request.json.get('aseguradora', '')
+    plan_nombre = request.json.get('plan_nombre', '')
+    procedimientos = request.json.get('procedimientos', [])
+    
+    if not aseguradora or not procedimientos or not isinstance(procedimientos, list):
+        return jsonify({"error": "Aseguradora y lista de procedimientos son requeridos."}), 400
+    
+    if len(procedimientos) > 50:
+        return jsonify({"error": "Máximo 50 procedimientos por solicitud."}), 400
+    
+    # Aceptar strings o dicts {'procedimiento', 'codigo_cpt'}
+    procedimientos = [
+        p if isinstance(p, dict) else {'procedimiento': str(p)}
+        for p in procedimientos
+    ]
+    
+    try:
+        # Una sola lectura del tabulador para todo el lote
+        tabulador_id, contenido_tabulador = _tabulador_vigente(aseguradora)
+        
+        resultados = [None] * len(procedimientos)
+        candidatos_por_item = [[] for _ in procedimientos]
+        pendientes = []
+        
+        for i, p in enumerate(procedimientos):
+            procedimiento = p.get('procedimiento', '')
+            if not procedimiento:
+                resultados[i] = {'error': 'Procedimiento vacío', 'monto': None}
+                continue
+            
+            resultado, candidatos = _resolver_honorario_local(
+                aseguradora, plan_nombre, procedimiento, p.get('codigo_cpt', ''), tabulador_id, contenido_tabulador
+            )
+            candidatos_por_item[i] = candidatos
+            if resultado is None:
+                pendientes.append(i)
+            else:
+                resultados[i] = resultado
+        
+        # Una sola llamada a la IA para todos los procedimientos no resueltos
+        if pendientes:
+            candidatos_pendientes = []
+            for i in pendientes:
+                for c in candidatos_por_item[i]:
+                    if c not in candidatos_pendientes:
+                        candidatos_pendientes.append(c)
+            
+            resultados_ia = buscar_honorarios_en_tabulador_lote(
+                aseguradora=aseguradora,
+                plan_nombre=plan_nombre,
+                procedimientos=[procedimientos[i] for i in pendientes],
+                contenido_tabulador=contexto_desde_candidatos(candidatos_pendientes, contenido_tabulador),
+                api_key=GEMINI_API_KEY
+            )
+            for i, resultado in zip(pendientes, resultados_ia):
+                resultados[i] = resultado
+        
+        respuesta = []
+        for i, p in enumerate(procedimientos):
+            resultado = resultados[i]
+            if not resultado.get('error'):
+                resultado['candidatos'] = _resumen_candidatos(candidatos_por_item[i])
+                _guardar_honorario_encontrado(
+                    aseguradora, plan_nombre, p.get('procedimiento', ''), p.get('codigo_cpt', ''), tabulador_id, resultado
+                )
+            respuesta.append({
+                'procedimiento': p.get('procedimiento', ''),
+                'codigo_cpt': p.get('codigo_cpt', ''),
+                'resultado': resultado
+            })
+        
+        return jsonify({
+            "success": True,
+            "total": len(respuesta),
+            "resueltos_sin_ia": len(procedimientos) - len(pendientes),
+            "total_honorarios": sum(monto_numerico(r['resultado'].get('monto')) or 0 for r in respuesta),
+            "resultados": respuesta
+        })
+    
+    except Exception as e:
+        import traceback
+        error_details = traceback.format_exc()
+        print(f"[ERROR] Exception buscando honorarios por lote: {error_details}")
+        return jsonify({
+            "error": "Error al buscar honorarios: " + str(e),
+            "debug": {"traceback": error_details[:500]}
+        }), 500
+
 @app.route('/api/seguros/consultar_cobertura', methods=['POST'])
 def consultar_cobertura_api():
     """API para consultar si un procedimiento está cubierto por el seguro"""
@@ -1755,25 +1824,7 @@ def consultar_cobertura_api():
         return jsonify({"error": "Aseguradora y procedimiento son requeridos."}), 400
     
     try:
-        # Buscar condiciones generales
-        tabuladores = seguro_db.obtener_tabuladores(aseguradora=aseguradora, activo=True)
-        
-        contenido_condiciones = None
-        
-        # Buscar documento de condiciones generales
-        for tab in tabuladores:
-            if tab.get('tipo_documento') == 'condiciones_generales':
-                contenido_condiciones = tab.get('contenido_texto', '')
-                break
-        
-        # Consultar cobertura
-        resultado = consultar_cobertura_procedimiento(
-            aseguradora=aseguradora,
-            plan_nombre=plan_nombre,
-            procedimiento=procedimiento,
-            contenido_condiciones=contenido_condiciones,
-            api_key=GEMINI_API_KEY
-        )
+        resultado = _consultar_cobertura_con_cache(aseguradora, plan_nombre, procedimiento)
         
         if resultado.get('error'):
             return jsonify(resultado), 500
@@ -1792,6 +1843,110 @@ def consultar_cobertura_api():
             "debug": {"traceback": error_details[:500]}
         }), 500
 
+def _secciones_condiciones(condiciones):
+    """
+    Secciones indexadas de un documento de condiciones generales. Los documentos
+    cargados antes de indexar secciones se segmentan la primera vez que se usan.
+    """
+    secciones = seguro_db.obtener_secciones_condiciones(condiciones['id'])
+    if not secciones:
+        contenido = (seguro_db.obtener_tabulador(condiciones['id']) or {}).get('contenido_texto', '')
+        secciones = segmentar_condiciones(contenido)
+        seguro_db.guardar_secciones_condiciones(condiciones['id'], secciones)
+    return secciones
+
+def _consultar_cobertura_con_cache(aseguradora, plan_nombre, procedimiento, condiciones=None, secciones=None):
+    """
+    Consulta la cobertura de un procedimiento reutilizando el veredicto previo para
+    el mismo documento de condiciones generales (archivo_hash), plan y procedimiento
+    normalizados. Solo se llama a la IA (y se leen las secciones del documento) si no hay.
+    """
+    if condiciones is None:
+        condiciones = seguro_db.obtener_condiciones_vigentes(aseguradora)
+    
+    archivo_hash = condiciones.get('archivo_hash') if condiciones else None
+    plan_normalizado = clave_plan(aseguradora, plan_nombre)[1]
+    procedimiento_normalizado = normalizar_procedimiento(procedimiento)
+    
+    cobertura_previa = seguro_db.buscar_cobertura_en_cache(archivo_hash, plan_normalizado, procedimiento_normalizado)
+    if cobertura_previa:
+        return {**cobertura_previa['resultado'], 'desde_cache': True}
+    
+    if condiciones and secciones is None:
+        secciones = _secciones_condiciones(condiciones)
+    
+    resultado = consultar_cobertura_procedimiento(
+        aseguradora=aseguradora,
+        plan_nombre=plan_nombre,
+        procedimiento=procedimiento,
+        api_key=GEMINI_API_KEY,
+        secciones=secciones
+    )
+    
+    # Sin documento de condiciones la respuesta es genérica: no se guarda
+    if archivo_hash and procedimiento_normalizado and not resultado.get('error'):
+        seguro_db.guardar_cobertura_en_cache({
+            'archivo_hash': archivo_hash,
+            'plan_normalizado': plan_normalizado,
+            'procedimiento_normalizado': procedimiento_normalizado,
+            'procedimiento': procedimiento,
+            'resultado': resultado,
+            'fuente_tabulador_id': condiciones['id']
+        })
+    return resultado
+
+@app.route('/api/seguros/precalentar_coberturas', methods=['POST'])
+def precalentar_coberturas_api():
+    """API para precalcular la cobertura de los procedimientos más frecuentes de una aseguradora"""
+    if not request.json:
+        return jsonify({"error": "No se recibió datos JSON."}), 400
+    
+    aseguradora = request.json.get('aseguradora', '')
+    plan_nombre = request.json.get('plan_nombre', '')
+    limite = min(int(request.json.get('limite') or 20), 50)
+    
+    if not aseguradora:
+        return jsonify({"error": "Aseguradora es requerida."}), 400
+    
+    procedimientos = request.json.get('procedimientos') or seguro_db.obtener_procedimientos_frecuentes(aseguradora, limite)
+    
+    condiciones = seguro_db.obtener_condiciones_vigentes(aseguradora)
+    if not condiciones:
+        return jsonify({"error": "No hay condiciones generales activas de esta aseguradora."}), 404
+    
+    try:
+        # Leer las secciones del documento una sola vez para todo el precalentado
+        secciones = _secciones_condiciones(condiciones)
+        
+        resumen = {'en_cache': 0, 'calculados': 0, 'errores': 0}
+        for procedimiento in procedimientos[:limite]:
+            resultado = _consultar_cobertura_con_cache(
+                aseguradora, plan_nombre, procedimiento,
+                condiciones=condiciones, secciones=secciones
+            )
+            if resultado.get('error'):
+                resumen['errores'] += 1
+            elif resultado.get('desde_cache'):
+                resumen['en_cache'] += 1
+            else:
+                resumen['calculados'] += 1
+        
+        return jsonify({
+            "success": True,
+            "tabulador_id": condiciones['id'],
+            "procedimientos": procedimientos[:limite],
+            **resumen
+        })
+    
+    except Exception as e:
+        import traceback
+        error_details = traceback.format_exc()
+        print(f"[ERROR] Exception precalentando coberturas: {error_details}")
+        return jsonify({
+            "error": "Error al precalentar coberturas: " + str(e),
+            "debug": {"traceback": error_details[:500]}
+        }), 500
+
 @app.route('/api/seguros/generar_informe', methods=['POST'])
 def generar_informe_api():
     """API para generar informe médico en PDF automáticamente"""
@@ -1811,46 +1966,9 @@ def generar_informe_api():
             return jsonify({"error": "Consulta no encontrada."}), 404
         
         # Obtener datos de la credencial de seguro
-        datos_seguro = {}
-        if credencial_seguro_id:
-            credencial = seguro_db.obtener_credencial(credencial_seguro_id)
-            if credencial:
-                datos_seguro = {
-                    'aseguradora': credencial.get('aseguradora', ''),
-                    'numero_poliza': credencial.get('numero_poliza', ''),
-                    'plan_nombre': credencial.get('plan_nombre', '')
-                }
+        credencial = seguro_db.obtener_credencial(credencial_seguro_id) if credencial_seguro_id else None
         
-        # Si no hay credencial, usar datos del request
-        if not datos_seguro.get('aseguradora'):
-            datos_seguro = {
-                'aseguradora': request.json.get('aseguradora', 'GENÉRICO'),
-                'numero_poliza': request.json.get('numero_poliza', ''),
-                'plan_nombre': request.json.get('plan_nombre', '')
-            }
-        
-        # Preparar datos del paciente
-        datos_paciente = {
-            'nombre': consulta.get('paciente_nombre', '') or request.json.get('paciente_nombre', 'Paciente'),
-            'edad': request.json.get('edad', ''),
-            'fecha_nacimiento': request.json.get('fecha_nacimiento', ''),
-            'sexo': request.json.get('sexo', '')
-        }
-        
-        # Preparar datos de la consulta
-        datos_consulta = {
-            'fecha_consulta': consulta.get('fecha_consulta', ''),
-            'diagnostico': consulta.get('diagnostico', ''),
-            'codigo_cie10': request.json.get('codigo_cie10', ''),
-            'procedimiento': request.json.get('procedimiento', ''),
-            'codigo_cpt': request.json.get('codigo_cpt', ''),
-            'tratamiento': consulta.get('tratamiento', ''),
-            'soap_subjetivo': consulta.get('soap_subjetivo', ''),
-            'soap_objetivo': consulta.get('soap_objetivo', ''),
-            'soap_analisis': consulta.get('soap_analisis', ''),
-            'soap_plan': consulta.get('soap_plan', ''),
-            'resumen_clinico': request.json.get('resumen_clinico', '')
-        }
+        datos_consulta, datos_paciente, datos_seguro = preparar_datos_informe(consulta, credencial, request.json)
         
         # Generar PDF
         tipo_aseguradora = datos_seguro.get('aseguradora', 'GENÉRICO')
@@ -1861,29 +1979,20 @@ def generar_informe_api():
             tipo_aseguradora=tipo_aseguradora
         )
         
-        # Guardar informe en BD
-        informe_data = {
-            'consulta_id': consulta_id,
-            'credencial_seguro_id': credencial_seguro_id,
-            'aseguradora': datos_seguro.get('aseguradora', ''),
-            'paciente_nombre': datos_paciente.get('nombre', ''),
-            'numero_poliza': datos_seguro.get('numero_poliza', ''),
-            'diagnostico': datos_consulta.get('diagnostico', ''),
-            'procedimiento': datos_consulta.get('procedimiento', ''),
-            'codigo_cpt': datos_consulta.get('codigo_cpt', ''),
-            'codigo_cie10': datos_consulta.get('codigo_cie10', ''),
-            'informe_pdf_path': ''  # En producción, guardar en disco
-        }
+        # Guardar PDF en el almacén e informe en BD
+        archivo = almacen.guardar(pdf_buffer.getvalue(), '.pdf')
+        informe_data = registro_informe(consulta_id, credencial_seguro_id, datos_consulta, datos_paciente, datos_seguro)
+        informe_data['informe_pdf_path'] = archivo['ruta']
         informe_id = seguro_db.guardar_informe_medico(informe_data)
         
         # Retornar PDF como descarga
         response = make_response(pdf_buffer.getvalue())
-        paciente_nombre_clean = datos_paciente.get('nombre', 'Paciente').replace(' ', '_')
-        fecha = datetime.now().strftime('%Y%m%d')
-        filename = f"Informe_Medico_{paciente_nombre_clean}_{fecha}.pdf"
+        filename = nombre_archivo_informe(datos_paciente)
         
         response.headers["Content-Disposition"] = f"attachment; filename={filename}"
         response.headers["Content-type"] = "application/pdf"
+        response.headers["X-Informe-Id"] = str(informe_id)
+        response.set_etag(archivo['hash'])
         
         return response
         
@@ -1913,6 +2022,116 @@ def obtener_credencial_api(credencial_id):
         return jsonify({"error": "Credencial no encontrada"}), 404
     return jsonify(credencial)
 
+@app.route('/api/seguros/procesar_credenciales_lote', methods=['POST'])
+def procesar_credenciales_lote_api():
+    """API para subir varias credenciales a la vez; el OCR corre en segundo plano"""
+    global _ocr_en_cola
+    imagenes = [imagen for imagen in request.files.getlist('imagenes') if imagen.filename]
+    
+    if not imagenes:
+        return jsonify({"error": "No se recibieron imágenes de credenciales."}), 400
+    
+    if len(imagenes) > MAX_CREDENCIALES_LOTE:
+        return jsonify({"error": f"Máximo {MAX_CREDENCIALES_LOTE} credenciales por carga."}), 400
+    
+    # Cola acotada: si el OCR va muy atrasado, pedir que se reintente en vez de acumular imágenes en memoria
+    with _ocr_cola_lock:
+        if _ocr_en_cola + len(imagenes) > MAX_COLA_OCR:
+            return jsonify({"error": "Hay demasiadas credenciales en proceso. Intenta de nuevo en unos minutos."}), 429
+        _ocr_en_cola += len(imagenes)
+    
+    forzar_ocr = request.form.get('forzar_ocr', '').lower() in ('1', 'true', 'si')
+    lote = None
+    encoladas = 0
+    try:
+        lote = seguro_db.crear_lote_credenciales([imagen.filename for imagen in imagenes])
+        for item_id, imagen in zip(lote['item_ids'], imagenes):
+            _pool_ocr.submit(_procesar_item_lote_credenciales, item_id, imagen.read(), forzar_ocr)
+            encoladas += 1
+    except Exception as e:
+        # Las ya encoladas descuentan su lugar en la cola al terminar
+        with _ocr_cola_lock:
+            _ocr_en_cola -= len(imagenes) - encoladas
+        if lote:
+            for item_id in lote['item_ids'][encoladas:]:
+                seguro_db.actualizar_item_lote_credenciales(item_id, 'error', error=f"No se pudo encolar: {e}")
+        print(f"[ERROR] Exception encolando credenciales: {e}")
+        return jsonify({"error": "Error al encolar credenciales: " + str(e)}), 500
+    
+    return jsonify({
+        "success": True,
+        "lote_id": lote['lote_id'],
+        "total": len(imagenes)
+    }), 202
+
+@app.route('/api/seguros/lote_credenciales/<int:lote_id>', methods=['GET'])
+def obtener_lote_credenciales_api(lote_id):
+    """API para consultar el avance de una carga de credenciales (resultados parciales)"""
+    lote = seguro_db.obtener_lote_credenciales(lote_id)
+    if not lote:
+        return jsonify({"error": "Carga de credenciales no encontrada"}), 404
+    
+    conteos = {'pendiente': 0, 'procesando': 0, 'completado': 0, 'error': 0}
+    for item in lote['items']:
+        conteos[item['estado']] += 1
+    
+    lote['conteos'] = conteos
+    lote['terminado'] = conteos['pendiente'] == 0 and conteos['procesando'] == 0
+    return jsonify(lote)
+
+def _enviar_archivo_almacen(ruta: str, nombre_descarga: str, como_adjunto: bool = True):
+    """Envía un archivo del almacén (sendfile del sistema, ETag = hash SHA-256, responde 304 si no cambió)"""
+    ruta_absoluta = almacen.ruta_absoluta(ruta)
+    if not ruta_absoluta:
+        return jsonify({"error": "Archivo no disponible"}), 404
+    
+    response = send_file(
+        ruta_absoluta,
+        mimetype=almacen.tipo_mime(ruta),
+        as_attachment=como_adjunto,
+        download_name=nombre_descarga,
+        etag=almacen.hash_de_ruta(ruta),
+        conditional=True,
+        max_age=31536000
+    )
+    # El contenido de una ruta nunca cambia (la ruta es su hash)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
+@app.route('/api/seguros/informe/<int:informe_id>/pdf', methods=['GET'])
+def descargar_informe_api(informe_id):
+    """API para volver a descargar el PDF de un informe médico generado"""
+    informe = seguro_db.obtener_informe_medico(informe_id)
+    if not informe:
+        return jsonify({"error": "Informe no encontrado"}), 404
+    
+    filename = nombre_archivo_informe({'nombre': informe.get('paciente_nombre') or 'Paciente'})
+    return _enviar_archivo_almacen(informe.get('informe_pdf_path'), filename)
+
+@app.route('/api/seguros/generar_informes_lote', methods=['POST'])
+def generar_informes_lote_api():
+    """API para generar varios informes médicos y descargarlos en un ZIP (en stream)"""
+    if not request.json:
+        return jsonify({"error": "No se recibió datos JSON."}), 400
+    
+    informes = request.json.get('informes', [])
+    
+    if not informes or not isinstance(informes, list):
+        return jsonify({"error": "Lista de informes requerida."}), 400
+    
+    if len(informes) > MAX_INFORMES_LOTE:
+        return jsonify({"error": f"Máximo {MAX_INFORMES_LOTE} informes por lote."}), 400
+    
+    if not all(isinstance(informe, dict) and informe.get('consulta_id') for informe in informes):
+        return jsonify({"error": "Cada informe requiere consulta_id."}), 400
+    
+    fecha = datetime.now().strftime('%Y%m%d')
+    response = Response(generar_lote_zip(informes, db, seguro_db, almacen=almacen), mimetype='application/zip')
+    response.headers["Content-Disposition"] = f"attachment; filename=Informes_Medicos_{fecha}.zip"
+    return response
+
 @app.route('/api/seguros/cargar_tabulador', methods=['POST'])
 def cargar_tabulador_api():
     """API para cargar y procesar un PDF de tabulador"""
@@ -1948,19 +2167,16 @@ def cargar_tabulador_api():
             return jsonify({"error": resultado['error']}), 400
         
         # Verificar si ya existe (por hash)
-        tabuladores_existentes = seguro_db.obtener_tabuladores()
-        hash_pdf = resultado.get('hash')
-        
-        for tab_existente in tabuladores_existentes:
-            if tab_existente.get('archivo_hash') == hash_pdf:
-                return jsonify({
-                    "error": "Este tabulador ya fue cargado anteriormente.",
-                    "tabulador_existente": {
-                        "id": tab_existente.get('id'),
-                        "aseguradora": tab_existente.get('aseguradora'),
-                        "fecha_carga": tab_existente.get('fecha_carga')
-                    }
-                }), 409
+        tab_existente = seguro_db.buscar_tabulador_por_hash(resultado.get('hash'))
+        if tab_existente:
+            return jsonify({
+                "error": "Este tabulador ya fue cargado anteriormente.",
+                "tabulador_existente": {
+                    "id": tab_existente.get('id'),
+                    "aseguradora": tab_existente.get('aseguradora'),
+                    "fecha_carga": tab_existente.get('fecha_carga')
+                }
+            }), 409
         
         # Usar datos detectados o manuales
         aseguradora = aseguradora_manual or resultado.get('aseguradora') or 'Desconocida'
@@ -1994,6 +2210,26 @@ def cargar_tabulador_api():
         
         tabulador_id = seguro_db.guardar_tabulador(tabulador_data)
         
+        # Indexar cláusulas de las condiciones generales para las consultas de cobertura
+        secciones = resultado.get('secciones') or []
+        if tipo_documento == 'condiciones_generales':
+            if not secciones:
+                secciones = segmentar_condiciones(resultado.get('texto', ''))
+            seguro_db.guardar_secciones_condiciones(tabulador_id, secciones)
+        
+        # Alimentar el catálogo de planes solo desde condiciones generales de un plan
+        # identificado: de un tabulador o sin plan, los valores sueltos del texto
+        # terminarían en el plan por defecto de la aseguradora
+        datos_plan = resultado.get('datos_plan') or {}
+        if datos_plan and tipo_documento == 'condiciones_generales' and plan:
+            seguro_db.guardar_plan({
+                'aseguradora': aseguradora,
+                'plan_nombre': plan,
+                'fuente_tabulador_id': tabulador_id,
+                **datos_plan
+            })
+            recargar_catalogo_planes(seguro_db.obtener_planes())
+        
         return jsonify({
             "success": True,
             "tabulador_id": tabulador_id,
@@ -2003,6 +2239,8 @@ def cargar_tabulador_api():
                 "plan_nombre": plan,
                 "tipo_documento": tipo_documento,
                 "fecha_vigencia": fecha_vigencia,
+                "datos_plan": datos_plan,
+                "num_secciones": len(secciones) if tipo_documento == 'condiciones_generales' else 0,
                 "num_paginas": resultado.get('num_paginas', 0),
                 "texto_preview": resultado.get('texto', '')[:500] + '...' if len(resultado.get('texto', '')) > 500 else resultado.get('texto', '')
             }
@@ -2017,6 +2255,47 @@ def cargar_tabulador_api():
             "debug": {"traceback": error_details[:500]}
         }), 500
 
+@app.route('/api/seguros/planes', methods=['GET'])
+def obtener_planes_api():
+    """API para obtener el catálogo de planes"""
+    try:
+        aseguradora = request.args.get('aseguradora', '').strip() or None
+        planes = seguro_db.obtener_planes(aseguradora=aseguradora)
+        return jsonify({
+            "success": True,
+            "planes": planes
+        })
+    except Exception as e:
+        return jsonify({"error": f"Error al obtener planes: {str(e)}"}), 500
+
+@app.route('/api/seguros/planes', methods=['POST'])
+def guardar_plan_api():
+    """API para agregar o actualizar un plan del catálogo"""
+    if not request.json:
+        return jsonify({"error": "No se recibió datos JSON."}), 400
+    
+    if not request.json.get('aseguradora'):
+        return jsonify({"error": "La aseguradora es requerida."}), 400
+    
+    try:
+        plan_data = {
+            'aseguradora': request.json.get('aseguradora'),
+            'plan_nombre': request.json.get('plan_nombre', ''),
+            'deducible_estimado': request.json.get('deducible_estimado'),
+            'coaseguro_porcentaje': request.json.get('coaseguro_porcentaje'),
+            'hospitales_red': request.json.get('hospitales_red')
+        }
+        plan_id = seguro_db.guardar_plan(plan_data)
+        recargar_catalogo_planes(seguro_db.obtener_planes())
+        
+        return jsonify({
+            "success": True,
+            "plan_id": plan_id,
+            "info_plan": consultar_info_plan(plan_data['aseguradora'], plan_data['plan_nombre'])
+        })
+    except Exception as e:
+        return jsonify({"error": f"Error al guardar plan: {str(e)}"}), 500
+
 @app.route('/api/seguros/tabuladores', methods=['GET'])
 def obtener_tabuladores_api():
     """API para obtener lista de tabuladores cargados"""
@@ -2040,29 +2319,39 @@ def obtener_tabuladores_api():
 
 @app.route('/api/seguros/tabulador/<int:tabulador_id>', methods=['GET'])
 def obtener_tabulador_api(tabulador_id):
-    """API para obtener un tabulador específico (con texto completo)"""
-    tabuladores = seguro_db.obtener_tabuladores()
-    tabulador = next((t for t in tabuladores if t.get('id') == tabulador_id), None)
+    """API para obtener un tabulador específico (con texto completo por defecto)"""
+    incluir_texto = request.args.get('incluir_texto', 'true').lower() == 'true'
+    
+    if incluir_texto:
+        tabulador = seguro_db.obtener_tabulador(tabulador_id)
+    else:
+        # Solo metadatos, servidos desde la caché en proceso
+        tabulador = seguro_db.obtener_tabulador_metadata(tabulador_id)
     
     if not tabulador:
         return jsonify({"error": "Tabulador no encontrado"}), 404
     
     return jsonify(tabulador)
 
+@app.route('/api/seguros/tabulador/<int:tabulador_id>/secciones', methods=['GET'])
+def obtener_secciones_tabulador_api(tabulador_id):
+    """API para obtener las cláusulas indexadas de unas condiciones generales (opcional: ?tema=exclusiones)"""
+    tabulador = seguro_db.obtener_tabulador_metadata(tabulador_id)
+    if not tabulador or tabulador.get('tipo_documento') != 'condiciones_generales':
+        return jsonify({"error": "Condiciones generales no encontradas"}), 404
+    
+    tema = request.args.get('tema')
+    if not seguro_db.obtener_secciones_condiciones(tabulador_id):
+        _secciones_condiciones(tabulador)
+    return jsonify(seguro_db.obtener_secciones_condiciones(tabulador_id, tema=tema))
+
 @app.route('/api/seguros/tabulador/<int:tabulador_id>', methods=['DELETE'])
 def eliminar_tabulador_api(tabulador_id):
     """API para desactivar un tabulador (soft delete)"""
-    with sqlite3.connect(seguro_db.db_path) as conn:
-        cursor = conn.execute('''
-            UPDATE tabuladores 
-            SET activo = 0, updated_at = CURRENT_TIMESTAMP
-            WHERE id = ?
-        ''', (tabulador_id,))
-        
-        if cursor.rowcount > 0:
-            return jsonify({"success": True, "message": "Tabulador desactivado correctamente"})
-        else:
-            return jsonify({"error": "Tabulador no encontrado"}), 404
+    if seguro_db.desactivar_tabulador(tabulador_id):
+        return jsonify({"success": True, "message": "Tabulador desactivado correctamente"})
+    else:
+        return jsonify({"error": "Tabulador no encontrado"}), 404
 
 # ============================================
 # MÓDULO ASISTENTE LEGAL - ENDPOINTS
@@ -2093,15 +2382,33 @@ def generar_consentimiento_api():
     paciente_nombre = request.json.get('paciente_nombre', '')
     consulta_id = request.json.get('consulta_id')
     medico_nombre = request.json.get('medico_nombre', 'Dr. Médico')
+    plantilla_id = request.json.get('plantilla_id')
     
     if not procedimiento:
         return jsonify({"error": "Procedimiento es requerido."}), 400
     
     try:
-        # Buscar plantilla para el procedimiento
-        plantilla = legal_db.obtener_plantilla_por_procedimiento(procedimiento)
+        if plantilla_id:
+            # Plantilla elegida por el usuario entre las candidatas
+            plantilla = legal_db.obtener_plantilla(plantilla_id)
+            if not plantilla:
+                return jsonify({"error": "Plantilla no encontrada."}), 404
+        else:
+            # Buscar plantilla para el procedimiento
+            plantilla = legal_db.obtener_plantilla_por_procedimiento(procedimiento)
         
         if not plantilla:
+            # Procedimientos parecidos pero no iguales (ej: histerectomía abdominal o vaginal):
+            # el usuario elige la plantilla, un consentimiento equivocado es peor que ninguno
+            candidatas = legal_db.buscar_plantillas_similares(procedimiento)
+            if candidatas:
+                return jsonify({
+                    "success": False,
+                    "requiere_seleccion": True,
+                    "plantillas_candidatas": candidatas,
+                    "error": f"No hay plantilla exacta para '{procedimiento}'. Elige una de las plantillas parecidas."
+                }), 409
+            
             # Si no hay plantilla específica, buscar una genérica
             plantillas = legal_db.obtener_plantillas(tipo_documento='consentimiento_informado')
             if plantillas:
@@ -2170,6 +2477,22 @@ def firmar_documento_api():
     try:
         # Obtener datos de la firma
         firma_imagen = request.json.get('firma_imagen')  # Base64
+        firma_imagen_path = ''
+        if firma_imagen:
+            import base64
+            import binascii
+            
+            # Aceptar tanto base64 puro como data URL (data:image/png;base64,...)
+            encabezado, separador, contenido = firma_imagen.partition(',')
+            if not separador:
+                encabezado, contenido = '', firma_imagen
+            extension = '.jpg' if 'jpeg' in encabezado or 'jpg' in encabezado else '.png'
+            try:
+                firma_bytes = base64.b64decode(contenido, validate=True)
+            except (binascii.Error, ValueError):
+                return jsonify({"error": "Imagen de firma inválida (se esperaba base64)."}), 400
+            firma_imagen_path = almacen.guardar(firma_bytes, extension)['ruta']
+        
         documento_data = {
             'medico_id': request.json.get('medico_id', 'default'),
             'paciente_id': request.json.get('paciente_id'),
@@ -2180,7 +2503,7 @@ def firmar_documento_api():
             'procedimiento': request.json.get('procedimiento', ''),
             'contenido_documento': request.json.get('contenido_documento', ''),
             'firma_digital': request.json.get('firma_digital', ''),
-            'firma_imagen_path': '',  # En producción, guardar imagen en disco
+            'firma_imagen_path': firma_imagen_path,
             'fecha_firma': datetime.now().strftime('%Y-%m-%d'),
             'hora_firma': datetime.now().strftime('%H:%M:%S'),
             'latitud': request.json.get('latitud'),
@@ -2220,62 +2543,45 @@ def firmar_documento_api():
             "debug": {"traceback": error_details[:500]}
         }), 500
 
+@app.route('/api/legal/documento_firmado/<int:documento_id>/firma', methods=['GET'])
+def descargar_firma_documento_api(documento_id):
+    """API para descargar la imagen de firma de un documento firmado"""
+    documento = legal_db.obtener_documento_firmado(documento_id)
+    if not documento:
+        return jsonify({"error": "Documento no encontrado"}), 404
+    
+    ruta = documento.get('firma_imagen_path') or ''
+    response = _enviar_archivo_almacen(ruta, f"Firma_Documento_{documento_id}{os.path.splitext(ruta)[1]}", como_adjunto=False)
+    
+    # Registrar en auditoría solo las descargas efectivas (no los 304 ni los 404)
+    if isinstance(response, Response) and response.status_code == 200:
+        legal_db.registrar_acceso_auditoria({
+            'medico_id': documento.get('medico_id'),
+            'usuario': request.args.get('usuario', 'medico'),
+            'tipo_acceso': 'descarga',
+            'entidad': 'documento_firmado',
+            'entidad_id': documento_id,
+            'ip_address': request.remote_addr,
+            'user_agent': request.headers.get('User-Agent', ''),
+            'detalles': 'Descarga de imagen de firma'
+        })
+    
+    return response
+
 @app.route('/api/legal/auditoria_cumplimiento', methods=['POST'])
 def auditoria_cumplimiento_api():
     """API para ejecutar auditoría de cumplimiento (cruza consultas vs documentos)"""
     medico_id = request.json.get('medico_id', 'default') if request.json else 'default'
+    completa = bool(request.json.get('completa')) if request.json else False
     
     try:
-        # Obtener consultas recientes (últimos 30 días)
-        consultas = db.obtener_consultas(medico_id=medico_id, limite=1000)
-        
-        # Obtener documentos firmados
-        documentos = legal_db.obtener_documentos_firmados(medico_id=medico_id, limite=1000)
-        
-        # Crear mapa de consultas con consentimiento
-        consultas_con_consentimiento = set()
-        for doc in documentos:
-            if doc.get('consulta_id') and doc.get('tipo_documento') == 'consentimiento_informado':
-                consultas_con_consentimiento.add(doc['consulta_id'])
-        
-        # Identificar consultas sin consentimiento
-        alertas_creadas = 0
-        procedimientos_requieren_consentimiento = ['cirugía', 'biopsia', 'endoscopia', 'colonoscopia', 'operación', 'intervención']
-        
-        for consulta in consultas:
-            consulta_id = consulta.get('id')
-            diagnostico = consulta.get('diagnostico', '').lower()
-            tratamiento = consulta.get('tratamiento', '').lower()
-            transcripcion = consulta.get('transcripcion', '').lower()
-            
-            # Verificar si requiere consentimiento
-            requiere_consentimiento = any(proc in diagnostico or proc in tratamiento or proc in transcripcion 
-                                         for proc in procedimientos_requieren_consentimiento)
-            
-            if requiere_consentimiento and consulta_id not in consultas_con_consentimiento:
-                # Verificar si ya existe una alerta para esta consulta
-                alertas_existentes = legal_db.obtener_alertas_legales(medico_id=medico_id, limite=1000)
-                ya_existe = any(a.get('entidad_id') == consulta_id and a.get('estado') == 'activa' 
-                               for a in alertas_existentes)
-                
-                if not ya_existe:
-                    legal_db.crear_alerta_legal({
-                        'medico_id': medico_id,
-                        'tipo_alerta': 'consentimiento_faltante',
-                        'severidad': 'alta',
-                        'titulo': f'Consentimiento faltante para consulta #{consulta_id}',
-                        'descripcion': f'La consulta del {consulta.get("fecha_consulta", "")} requiere consentimiento informado pero no se encontró documento firmado.',
-                        'entidad_tipo': 'consulta',
-                        'entidad_id': consulta_id
-                    })
-                    alertas_creadas += 1
+        # Solo consultas nuevas o modificadas desde la última auditoría (marca de agua compartida con auditoria_nocturna.py)
+        resultado = auditar_consentimientos(db, legal_db, medico_id=medico_id, completa=completa)
         
         return jsonify({
             "success": True,
-            "alertas_creadas": alertas_creadas,
-            "total_consultas_revisadas": len(consultas),
-            "consultas_con_consentimiento": len(consultas_con_consentimiento),
-            "message": f"Auditoría completada. Se crearon {alertas_creadas} alertas."
+            **resultado,
+            "message": f"Auditoría completada. Se crearon {resultado['alertas_creadas']} alertas."
         })
         
     except Exception as e:
@@ -2485,7 +2791,44 @@ def estadisticas_cumplimiento_api():
     stats = legal_db.obtener_estadisticas_cumplimiento(medico_id=medico_id)
     return jsonify(stats)
 
+def iniciar_servicios():
+    """
+    Abre las bases de datos (crea tablas y aplica migraciones), el almacén de
+    archivos y el catálogo de planes, reanuda las importaciones pendientes o
+    interrumpidas (ej: el servidor se reinició a media importación) y cierra las
+    cargas de credenciales que quedaron a medias
+    """
+    global db, transaccion_db, seguro_db, legal_db, almacen
+    db = ConsultaDB()
+    transaccion_db = TransaccionDB()
+    seguro_db = SeguroDB()
+    legal_db = LegalDB()
+    almacen = AlmacenArchivos()
+    
+    # Catálogo de planes en memoria (se recarga al cargar documentos o editar planes)
+    recargar_catalogo_planes(seguro_db.obtener_planes())
+    
+    # Al arrancar ninguna importación 'procesando' sigue en curso (el servidor es un solo proceso)
+    transaccion_db.liberar_importaciones_interrumpidas()
+    for importacion_id in transaccion_db.obtener_importaciones_por_reanudar(MINUTOS_IMPORTACION_INACTIVA):
+        _encolar_importacion(importacion_id)
+    
+    # Las imágenes de cargas de credenciales en cola se perdieron con el proceso anterior
+    seguro_db.cerrar_lotes_credenciales_interrumpidos()
+
+DEBUG = os.environ.get('FLASK_ENV') != 'production'
+
+# En modo debug `python main.py` corre además el vigilante del recargador de Flask
+# (WERKZEUG_RUN_MAIN sin definir), que no atiende peticiones ni debe reanudar importaciones
+_vigilante_recarga = __name__ == '__main__' and DEBUG and not os.environ.get('WERKZEUG_RUN_MAIN')
+
+# Los procesos 'spawn' de los pools de informes_lote y cfdi_xml importan este archivo
+# como __mp_main__: ahí no se abren bases de datos, no se migra y no se reclaman
+# importaciones (solo renderizan PDFs o leen XML). Al ejecutar `python main.py` o al
+# importarlo desde un servidor WSGI sí se inician los servicios.
+if __name__ != '__mp_main__' and not _vigilante_recarga:
+    iniciar_servicios()
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5555))
-    debug = os.environ.get('FLASK_ENV') != 'production'
-    app.run(host='0.0.0.0', port=port, debug=debug)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=port, debug=DEBUG)
\ No newline at end of file
@@ -166,6 +166,8 @@ def seed_transacciones():
         
         conn.commit()
     
+    # Las reglas se insertaron con SQL directo: descartar el índice en memoria
+    db.recargar_reglas()
     print("✅ Reglas de clasificación creadas")
     
     # Validar algunas transacciones automáticamente
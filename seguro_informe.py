@@ -5,8 +5,11 @@ Llena formularios PDF oficiales de las aseguradoras con datos de la consulta
 """
 
 import os
+import copy
+import threading
+from collections import OrderedDict
 from io import BytesIO
-from typing import Dict, Optional
+from typing import Dict, Optional, Tuple
 from reportlab.lib.pagesizes import letter, A4
 from reportlab.lib import colors
 from reportlab.lib.units import inch
@@ -17,6 +20,138 @@ from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 from datetime import datetime
 
+# Encabezados de sección del informe
+SECCIONES_INFORME = (
+    'DATOS DEL PACIENTE', 'DATOS DEL SEGURO', 'INFORMACIÓN CLÍNICA',
+    'RESUMEN CLÍNICO', 'TRATAMIENTO'
+)
+
+# Plantillas de informe en memoria (el tipo de aseguradora viene de la petición)
+MAX_PLANTILLAS_INFORME = 16
+
+# Contenido fijo del bloque de firma
+FIRMA_INFORME = [
+    ['', ''],
+    ['_________________________', ''],
+    ['Nombre y Firma del Médico', 'Fecha: ___________________']
+]
+
+class PlantillaInforme:
+    """
+    Estilos y flowables fijos del informe de una aseguradora (título, encabezados
+    de sección, firma y estilos de tabla). Se construye una vez por proceso y cada
+    informe solo agrega los datos variables.
+    """
+    
+    def __init__(self, tipo_aseguradora: str):
+        self.tipo_aseguradora = tipo_aseguradora
+        
+        # Estilos
+        styles = getSampleStyleSheet()
+        
+        self.titulo_style = ParagraphStyle(
+            'CustomTitle',
+            parent=styles['Heading1'],
+            fontSize=16,
+            textColor=colors.HexColor('#1a5490'),
+            spaceAfter=30,
+            alignment=TA_CENTER,
+            fontName='Helvetica-Bold'
+        )
+        
+        self.fecha_style = ParagraphStyle(
+            'Fecha',
+            parent=styles['Normal'],
+            fontSize=10,
+            alignment=TA_RIGHT
+        )
+        
+        self.seccion_style = ParagraphStyle(
+            'PacienteTitle',
+            parent=styles['Heading2'],
+            fontSize=12,
+            textColor=colors.HexColor('#333333'),
+            spaceAfter=10,
+            fontName='Helvetica-Bold'
+        )
+        
+        self.resumen_style = ParagraphStyle(
+            'Resumen',
+            parent=styles['Normal'],
+            fontSize=10,
+            alignment=TA_LEFT,
+            leftIndent=0.2*inch,
+            spaceAfter=15
+        )
+        
+        self.tratamiento_style = ParagraphStyle(
+            'Tratamiento',
+            parent=styles['Normal'],
+            fontSize=10,
+            alignment=TA_LEFT,
+            leftIndent=0.2*inch
+        )
+        
+        # Estilo de las tablas de datos (etiqueta | valor)
+        self.tabla_datos_style = TableStyle([
+            ('BACKGROUND', (0, 0), (0, -1), colors.HexColor('#f0f0f0')),
+            ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
+            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+            ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
+            ('FONTNAME', (1, 0), (1, -1), 'Helvetica'),
+            ('FONTSIZE', (0, 0), (-1, -1), 10),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
+            ('TOPPADDING', (0, 0), (-1, -1), 8),
+            ('GRID', (0, 0), (-1, -1), 1, colors.grey)
+        ])
+        
+        # Flowables fijos (se entregan copias: el layout de cada informe no toca el original)
+        self._titulo = Paragraph(f"INFORME MÉDICO - {tipo_aseguradora}", self.titulo_style)
+        self._secciones = {nombre: Paragraph(nombre, self.seccion_style) for nombre in SECCIONES_INFORME}
+        
+        self._firma = Table(FIRMA_INFORME, colWidths=[3*inch, 3*inch])
+        self._firma.setStyle(TableStyle([
+            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+            ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
+            ('FONTSIZE', (0, 0), (-1, -1), 10),
+            ('TOPPADDING', (0, 0), (-1, -1), 10),
+        ]))
+    
+    def titulo(self) -> Paragraph:
+        return copy.copy(self._titulo)
+    
+    def seccion(self, nombre: str) -> Paragraph:
+        return copy.copy(self._secciones[nombre])
+    
+    def firma(self) -> Table:
+        return copy.copy(self._firma)
+    
+    def tabla_datos(self, filas: list) -> Table:
+        """Tabla etiqueta | valor con el estilo del informe"""
+        tabla = Table(filas, colWidths=[2.5*inch, 4*inch])
+        tabla.setStyle(self.tabla_datos_style)
+        return tabla
+
+# Plantillas por tipo de aseguradora (caché LRU por proceso)
+_plantillas_informe: "OrderedDict[str, PlantillaInforme]" = OrderedDict()
+_plantillas_lock = threading.Lock()
+
+def obtener_plantilla_informe(tipo_aseguradora: str) -> PlantillaInforme:
+    """
+    Obtiene la plantilla de informe de la aseguradora, construyéndola la primera
+    vez y manteniéndola en una caché LRU de MAX_PLANTILLAS_INFORME plantillas
+    """
+    with _plantillas_lock:
+        plantilla = _plantillas_informe.get(tipo_aseguradora)
+        if plantilla is None:
+            plantilla = PlantillaInforme(tipo_aseguradora)
+            _plantillas_informe[tipo_aseguradora] = plantilla
+            while len(_plantillas_informe) > MAX_PLANTILLAS_INFORME:
+                _plantillas_informe.popitem(last=False)
+        else:
+            _plantillas_informe.move_to_end(tipo_aseguradora)
+        return plantilla
+
 def generar_informe_medico(
     datos_consulta: Dict,
     datos_paciente: Dict,
@@ -35,6 +170,16 @@ def generar_informe_medico(
     Returns:
         BytesIO con el PDF generado
     """
+    plantilla = obtener_plantilla_informe(tipo_aseguradora)
+    return construir_informe(plantilla, datos_consulta, datos_paciente, datos_seguro)
+
+def construir_informe(
+    plantilla: PlantillaInforme,
+    datos_consulta: Dict,
+    datos_paciente: Dict,
+    datos_seguro: Dict
+) -> BytesIO:
+    """Construye el PDF del informe con una plantilla ya preparada"""
     
     buffer = BytesIO()
     
@@ -51,45 +196,17 @@ def generar_informe_medico(
     # Contenedor para elementos del PDF
     story = []
     
-    # Estilos
-    styles = getSampleStyleSheet()
-    
     # Título
-    titulo_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Heading1'],
-        fontSize=16,
-        textColor=colors.HexColor('#1a5490'),
-        spaceAfter=30,
-        alignment=TA_CENTER,
-        fontName='Helvetica-Bold'
-    )
-    
-    story.append(Paragraph(f"INFORME MÉDICO - {tipo_aseguradora}", titulo_style))
+    story.append(plantilla.titulo())
     story.append(Spacer(1, 0.2*inch))
     
     # Fecha
     fecha_actual = datetime.now().strftime("%d de %B de %Y")
-    fecha_style = ParagraphStyle(
-        'Fecha',
-        parent=styles['Normal'],
-        fontSize=10,
-        alignment=TA_RIGHT
-    )
-    story.append(Paragraph(f"Fecha: {fecha_actual}", fecha_style))
+    story.append(Paragraph(f"Fecha: {fecha_actual}", plantilla.fecha_style))
     story.append(Spacer(1, 0.3*inch))
     
     # Datos del Paciente
-    paciente_title = ParagraphStyle(
-        'PacienteTitle',
-        parent=styles['Heading2'],
-        fontSize=12,
-        textColor=colors.HexColor('#333333'),
-        spaceAfter=10,
-        fontName='Helvetica-Bold'
-    )
-    
-    story.append(Paragraph("DATOS DEL PACIENTE", paciente_title))
+    story.append(plantilla.seccion("DATOS DEL PACIENTE"))
     
     datos_paciente_table = [
         ['Nombre del Paciente:', datos_paciente.get('nombre', 'N/A')],
@@ -98,24 +215,11 @@ def generar_informe_medico(
         ['Sexo:', datos_paciente.get('sexo', 'N/A')],
     ]
     
-    paciente_table = Table(datos_paciente_table, colWidths=[2.5*inch, 4*inch])
-    paciente_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (0, -1), colors.HexColor('#f0f0f0')),
-        ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
-        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-        ('FONTNAME', (1, 0), (1, -1), 'Helvetica'),
-        ('FONTSIZE', (0, 0), (-1, -1), 10),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
-        ('TOPPADDING', (0, 0), (-1, -1), 8),
-        ('GRID', (0, 0), (-1, -1), 1, colors.grey)
-    ]))
-    
-    story.append(paciente_table)
+    story.append(plantilla.tabla_datos(datos_paciente_table))
     story.append(Spacer(1, 0.3*inch))
     
     # Datos del Seguro
-    story.append(Paragraph("DATOS DEL SEGURO", paciente_title))
+    story.append(plantilla.seccion("DATOS DEL SEGURO"))
     
     datos_seguro_table = [
         ['Aseguradora:', datos_seguro.get('aseguradora', 'N/A')],
@@ -123,24 +227,11 @@ def generar_informe_medico(
         ['Plan:', datos_seguro.get('plan_nombre', 'N/A')],
     ]
     
-    seguro_table = Table(datos_seguro_table, colWidths=[2.5*inch, 4*inch])
-    seguro_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (0, -1), colors.HexColor('#f0f0f0')),
-        ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
-        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-        ('FONTNAME', (1, 0), (1, -1), 'Helvetica'),
-        ('FONTSIZE', (0, 0), (-1, -1), 10),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
-        ('TOPPADDING', (0, 0), (-1, -1), 8),
-        ('GRID', (0, 0), (-1, -1), 1, colors.grey)
-    ]))
-    
-    story.append(seguro_table)
+    story.append(plantilla.tabla_datos(datos_seguro_table))
     story.append(Spacer(1, 0.3*inch))
     
     # Información Clínica
-    story.append(Paragraph("INFORMACIÓN CLÍNICA", paciente_title))
+    story.append(plantilla.seccion("INFORMACIÓN CLÍNICA"))
     
     datos_clinicos_table = [
         ['Fecha de Consulta:', datos_consulta.get('fecha_consulta', fecha_actual)],
@@ -153,25 +244,12 @@ def generar_informe_medico(
         if datos_consulta.get('codigo_cpt'):
             datos_clinicos_table.append(['Código CPT:', datos_consulta.get('codigo_cpt', 'N/A')])
     
-    clinicos_table = Table(datos_clinicos_table, colWidths=[2.5*inch, 4*inch])
-    clinicos_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (0, -1), colors.HexColor('#f0f0f0')),
-        ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
-        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-        ('FONTNAME', (1, 0), (1, -1), 'Helvetica'),
-        ('FONTSIZE', (0, 0), (-1, -1), 10),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
-        ('TOPPADDING', (0, 0), (-1, -1), 8),
-        ('GRID', (0, 0), (-1, -1), 1, colors.grey)
-    ]))
-    
-    story.append(clinicos_table)
+    story.append(plantilla.tabla_datos(datos_clinicos_table))
     story.append(Spacer(1, 0.3*inch))
     
     # Resumen Clínico
     if datos_consulta.get('resumen_clinico') or datos_consulta.get('soap_subjetivo'):
-        story.append(Paragraph("RESUMEN CLÍNICO", paciente_title))
+        story.append(plantilla.seccion("RESUMEN CLÍNICO"))
         
         resumen_texto = datos_consulta.get('resumen_clinico', '')
         if not resumen_texto:
@@ -187,51 +265,18 @@ def generar_informe_medico(
                 resumen_parts.append(f"<b>Plan:</b> {datos_consulta['soap_plan']}")
             resumen_texto = '<br/><br/>'.join(resumen_parts)
         
-        resumen_style = ParagraphStyle(
-            'Resumen',
-            parent=styles['Normal'],
-            fontSize=10,
-            alignment=TA_LEFT,
-            leftIndent=0.2*inch,
-            spaceAfter=15
-        )
-        
-        story.append(Paragraph(resumen_texto, resumen_style))
+        story.append(Paragraph(resumen_texto, plantilla.resumen_style))
         story.append(Spacer(1, 0.3*inch))
     
     # Tratamiento
     if datos_consulta.get('tratamiento'):
-        story.append(Paragraph("TRATAMIENTO", paciente_title))
-        
-        tratamiento_style = ParagraphStyle(
-            'Tratamiento',
-            parent=styles['Normal'],
-            fontSize=10,
-            alignment=TA_LEFT,
-            leftIndent=0.2*inch
-        )
-        
-        story.append(Paragraph(datos_consulta.get('tratamiento', ''), tratamiento_style))
+        story.append(plantilla.seccion("TRATAMIENTO"))
+        story.append(Paragraph(datos_consulta.get('tratamiento', ''), plantilla.tratamiento_style))
         story.append(Spacer(1, 0.3*inch))
     
     # Firma
     story.append(Spacer(1, 0.5*inch))
-    
-    firma_table = [
-        ['', ''],
-        ['_________________________', ''],
-        ['Nombre y Firma del Médico', 'Fecha: ___________________']
-    ]
-    
-    firma_table_style = Table(firma_table, colWidths=[3*inch, 3*inch])
-    firma_table_style.setStyle(TableStyle([
-        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-        ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
-        ('FONTSIZE', (0, 0), (-1, -1), 10),
-        ('TOPPADDING', (0, 0), (-1, -1), 10),
-    ]))
-    
-    story.append(firma_table_style)
+    story.append(plantilla.firma())
     
     # Construir PDF
     doc.build(story)
@@ -249,3 +294,79 @@ def generar_informe_generico(
     """
     return generar_informe_medico(datos_consulta, datos_paciente, datos_seguro, tipo_aseguradora='GENÉRICO')
 
+def preparar_datos_informe(consulta: Dict, credencial: Optional[Dict], extra: Dict) -> Tuple[Dict, Dict, Dict]:
+    """
+    Arma los datos del informe a partir de la consulta, la credencial de seguro
+    (opcional) y los datos adicionales capturados (edad, procedimiento, CPT, etc.)
+    
+    Returns:
+        (datos_consulta, datos_paciente, datos_seguro)
+    """
+    # Obtener datos de la credencial de seguro
+    datos_seguro = {}
+    if credencial:
+        datos_seguro = {
+            'aseguradora': credencial.get('aseguradora', ''),
+            'numero_poliza': credencial.get('numero_poliza', ''),
+            'plan_nombre': credencial.get('plan_nombre', '')
+        }
+    
+    # Si no hay credencial, usar datos adicionales
+    if not datos_seguro.get('aseguradora'):
+        datos_seguro = {
+            'aseguradora': extra.get('aseguradora', 'GENÉRICO'),
+            'numero_poliza': extra.get('numero_poliza', ''),
+            'plan_nombre': extra.get('plan_nombre', '')
+        }
+    
+    # Preparar datos del paciente
+    datos_paciente = {
+        'nombre': consulta.get('paciente_nombre', '') or extra.get('paciente_nombre', 'Paciente'),
+        'edad': extra.get('edad', ''),
+        'fecha_nacimiento': extra.get('fecha_nacimiento', ''),
+        'sexo': extra.get('sexo', '')
+    }
+    
+    # Preparar datos de la consulta
+    datos_consulta = {
+        'fecha_consulta': consulta.get('fecha_consulta', ''),
+        'diagnostico': consulta.get('diagnostico', ''),
+        'codigo_cie10': extra.get('codigo_cie10', ''),
+        'procedimiento': extra.get('procedimiento', ''),
+        'codigo_cpt': extra.get('codigo_cpt', ''),
+        'tratamiento': consulta.get('tratamiento', ''),
+        'soap_subjetivo': consulta.get('soap_subjetivo', ''),
+        'soap_objetivo': consulta.get('soap_objetivo', ''),
+        'soap_analisis': consulta.get('soap_analisis', ''),
+        'soap_plan': consulta.get('soap_plan', ''),
+        'resumen_clinico': extra.get('resumen_clinico', '')
+    }
+    
+    return datos_consulta, datos_paciente, datos_seguro
+
+def registro_informe(
+    consulta_id: int,
+    credencial_seguro_id: Optional[int],
+    datos_consulta: Dict,
+    datos_paciente: Dict,
+    datos_seguro: Dict
+) -> Dict:
+    """Datos para guardar el informe con SeguroDB.guardar_informe_medico"""
+    return {
+        'consulta_id': consulta_id,
+        'credencial_seguro_id': credencial_seguro_id,
+        'aseguradora': datos_seguro.get('aseguradora', ''),
+        'paciente_nombre': datos_paciente.get('nombre', ''),
+        'numero_poliza': datos_seguro.get('numero_poliza', ''),
+        'diagnostico': datos_consulta.get('diagnostico', ''),
+        'procedimiento': datos_consulta.get('procedimiento', ''),
+        'codigo_cpt': datos_consulta.get('codigo_cpt', ''),
+        'codigo_cie10': datos_consulta.get('codigo_cie10', ''),
+        'informe_pdf_path': ''  # En producción, guardar en disco
+    }
+
+def nombre_archivo_informe(datos_paciente: Dict) -> str:
+    """Nombre de descarga del informe: Informe_Medico_<paciente>_<fecha>.pdf"""
+    paciente_nombre_clean = datos_paciente.get('nombre', 'Paciente').replace(' ', '_')
+    fecha = datetime.now().strftime('%Y%m%d')
+    return f"Informe_Medico_{paciente_nombre_clean}_{fecha}.pdf"
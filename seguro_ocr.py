@@ -5,19 +5,136 @@ Usa Gemini Vision API para extraer información de imágenes de credenciales
 """
 
 import os
+import time
+import hashlib
 import base64
 import requests
-from typing import Dict, Optional
-from PIL import Image
+from types import MappingProxyType
+from typing import Dict, List, Optional, Tuple
+from PIL import Image, ImageChops, ImageFilter, ImageOps
 import io
+from busqueda_procedimientos import EscanerPalabrasClave, normalizar_texto
 
-def extraer_datos_credencial_imagen(imagen_bytes: bytes, api_key: str) -> Dict:
+# Lado mayor (px) de la imagen enviada al modelo; suficiente para leer el texto de la credencial
+LADO_MAXIMO_CREDENCIAL = 1600
+
+# Calidad JPEG de la imagen recomprimida
+CALIDAD_JPEG_CREDENCIAL = 85
+
+# Diferencia mínima de gris contra el fondo para considerar un pixel parte de la credencial
+UMBRAL_FONDO_RECORTE = 40
+
+def _recortar_a_credencial(imagen: Image.Image) -> Image.Image:
+    """
+    Recorta la foto a los bordes de la credencial, separándola del fondo
+    (mesa, mostrador) por contraste contra el color de los bordes de la foto.
+    Si no se detecta un contorno claro, regresa la imagen sin recortar.
+    """
+    # Detectar sobre una miniatura para que sea rápido
+    escala = max(imagen.size) / 256
+    miniatura = imagen.convert('L').resize(
+        (max(1, int(imagen.width / escala)), max(1, int(imagen.height / escala)))
+    )
+    
+    # Color de fondo: mediana de los pixeles del borde de la foto
+    ancho, alto = miniatura.size
+    pixeles = miniatura.load()
+    borde = [pixeles[x, 0] for x in range(ancho)] + [pixeles[x, alto - 1] for x in range(ancho)]
+    borde += [pixeles[0, y] for y in range(alto)] + [pixeles[ancho - 1, y] for y in range(alto)]
+    fondo = sorted(borde)[len(borde) // 2]
+    
+    diferencia = ImageChops.difference(miniatura, Image.new('L', miniatura.size, fondo))
+    mascara = diferencia.point(lambda v: 255 if v > UMBRAL_FONDO_RECORTE else 0).filter(ImageFilter.MedianFilter(5))
+    caja = mascara.getbbox()
+    if not caja:
+        return imagen
+    
+    # Descartar detecciones demasiado pequeñas (ruido) o que ocupan toda la foto
+    area = (caja[2] - caja[0]) * (caja[3] - caja[1])
+    if area < 0.25 * ancho * alto or area > 0.95 * ancho * alto:
+        return imagen
+    
+    # Escalar la caja al tamaño original con un pequeño margen
+    margen = 2
+    caja = (
+        max(0, int((caja[0] - margen) * escala)),
+        max(0, int((caja[1] - margen) * escala)),
+        min(imagen.width, int((caja[2] + margen) * escala)),
+        min(imagen.height, int((caja[3] + margen) * escala))
+    )
+    return imagen.crop(caja)
+
+def calcular_hash_imagen(imagen_bytes: bytes) -> str:
+    """
+    SHA-256 de los bytes de la foto de una credencial. Solo se reutiliza el OCR
+    de una foto idéntica byte a byte: un hash perceptual de la credencial completa
+    codifica sobre todo el diseño de la aseguradora, y dos pacientes con la misma
+    credencial quedan a pocos bits de distancia.
+    """
+    return hashlib.sha256(imagen_bytes).hexdigest()
+
+def preprocesar_imagen_credencial(imagen_bytes: bytes) -> Tuple[bytes, str, Dict]:
+    """
+    Prepara la foto de una credencial antes de enviarla al modelo de visión:
+    aplica la orientación EXIF, recorta a la credencial, reduce la resolución,
+    convierte a escala de grises y recomprime en JPEG.
+    
+    Args:
+        imagen_bytes: Bytes originales de la foto
+    
+    Returns:
+        (bytes a enviar, tipo MIME, métricas)
+        Si la imagen no se puede procesar o el resultado no es más pequeño,
+        se envían los bytes originales.
+    """
+    metricas = {
+        'bytes_original': len(imagen_bytes),
+        'bytes_enviados': len(imagen_bytes),
+        'reduccion_porcentaje': 0.0,
+        'preprocesada': False
+    }
+    
+    try:
+        imagen = Image.open(io.BytesIO(imagen_bytes))
+        mime_original = f"image/{imagen.format.lower()}" if imagen.format else "image/jpeg"
+    except Exception:
+        return imagen_bytes, "image/jpeg", metricas
+    
+    try:
+        metricas['dimensiones_original'] = list(imagen.size)
+        
+        imagen = ImageOps.exif_transpose(imagen)
+        imagen = _recortar_a_credencial(imagen)
+        imagen = imagen.convert('L')
+        imagen.thumbnail((LADO_MAXIMO_CREDENCIAL, LADO_MAXIMO_CREDENCIAL), Image.LANCZOS)
+        
+        salida = io.BytesIO()
+        imagen.save(salida, format='JPEG', quality=CALIDAD_JPEG_CREDENCIAL, optimize=True)
+        procesada = salida.getvalue()
+    except Exception as e:
+        print(f"[WARNING] No se pudo preprocesar la credencial: {e}")
+        return imagen_bytes, mime_original, metricas
+    
+    if len(procesada) >= len(imagen_bytes):
+        return imagen_bytes, mime_original, metricas
+    
+    metricas.update({
+        'bytes_enviados': len(procesada),
+        'reduccion_porcentaje': round(100 * (1 - len(procesada) / len(imagen_bytes)), 1),
+        'dimensiones_enviadas': list(imagen.size),
+        'preprocesada': True
+    })
+    return procesada, "image/jpeg", metricas
+
+def extraer_datos_credencial_imagen(imagen_bytes: bytes, api_key: str, metricas: Optional[Dict] = None) -> Dict:
     """
     Extrae datos de una credencial de seguro usando Gemini Vision API
     
     Args:
         imagen_bytes: Bytes de la imagen de la credencial
         api_key: Clave API de Gemini
+        metricas: Dict opcional donde se registran los bytes ahorrados
+            por el preprocesamiento y la latencia del OCR (ocr_ms)
     
     Returns:
         Dict con los datos extraídos:
@@ -32,16 +149,14 @@ def extraer_datos_credencial_imagen(imagen_bytes: bytes, api_key: str) -> Dict:
         }
     """
     
+    # Reducir la foto antes de enviarla (orientación, recorte, resolución, grises)
+    imagen_bytes, mime_type, metricas_imagen = preprocesar_imagen_credencial(imagen_bytes)
+    if metricas is not None:
+        metricas.update(metricas_imagen)
+    
     # Convertir imagen a base64
     imagen_base64 = base64.b64encode(imagen_bytes).decode('utf-8')
     
-    # Detectar tipo MIME
-    try:
-        imagen_pil = Image.open(io.BytesIO(imagen_bytes))
-        mime_type = f"image/{imagen_pil.format.lower()}" if imagen_pil.format else "image/jpeg"
-    except:
-        mime_type = "image/jpeg"
-    
     prompt = """Analiza esta credencial de seguro médico mexicano y extrae la siguiente información en formato JSON:
 
 1. aseguradora: Nombre de la compañía aseguradora (ej: GNP, AXA, Seguros Monterrey, MetLife, Banorte)
@@ -95,7 +210,10 @@ Formato de respuesta:
     }
     
     try:
+        inicio = time.perf_counter()
         response = requests.post(url, headers=headers, json=data, timeout=30)
+        if metricas is not None:
+            metricas['ocr_ms'] = round((time.perf_counter() - inicio) * 1000)
         
         if response.status_code == 200:
             result = response.json()
@@ -130,117 +248,122 @@ Formato de respuesta:
         traceback.print_exc()
         return {}
 
+# Variantes de nombres de aseguradoras y su nombre estándar (en orden de prioridad)
+VARIANTES_ASEGURADORA = {
+    'gnp': 'GNP',
+    'axa': 'AXA',
+    'metlife': 'MetLife',
+    'met life': 'MetLife',
+    'monterrey': 'Seguros Monterrey',
+    'seguros monterrey': 'Seguros Monterrey',
+    'seguro monterrey': 'Seguros Monterrey',
+    'banorte': 'Banorte',
+    'seguros banorte': 'Banorte',
+    'qualitas': 'Qualitas',
+    'plan seguros': 'Plan Seguros',
+    'plan seguros de méxico': 'Plan Seguros',
+    'mapfre': 'Mapfre',
+    'zurich': 'Zurich'
+}
+
+_escaner_aseguradoras = EscanerPalabrasClave([
+    ('aseguradora', estandar, variante) for variante, estandar in VARIANTES_ASEGURADORA.items()
+])
+
 def normalizar_nombre_aseguradora(nombre: str) -> str:
     """
     Normaliza el nombre de una aseguradora a nombres estándar
     """
-    nombre_lower = nombre.lower().strip()
-    
-    # Mapeo de variantes a nombres estándar
-    mapeo = {
-        'gnp': 'GNP',
-        'axa': 'AXA',
-        'metlife': 'MetLife',
-        'met life': 'MetLife',
-        'monterrey': 'Seguros Monterrey',
-        'seguros monterrey': 'Seguros Monterrey',
-        'seguro monterrey': 'Seguros Monterrey',
-        'banorte': 'Banorte',
-        'seguros banorte': 'Banorte',
-        'qualitas': 'Qualitas',
-        'plan seguros': 'Plan Seguros',
-        'plan seguros de méxico': 'Plan Seguros',
-        'mapfre': 'Mapfre',
-        'zurich': 'Zurich'
-    }
-    
-    # Buscar coincidencia exacta o parcial
-    for variante, estandar in mapeo.items():
-        if variante in nombre_lower:
+    # Buscar coincidencia exacta o parcial (una sola pasada sobre el nombre)
+    encontradas = _escaner_aseguradoras.escanear(nombre)['senales'].get('aseguradora', {})
+    for estandar in VARIANTES_ASEGURADORA.values():
+        if estandar in encontradas:
             return estandar
     
     # Si no hay match, capitalizar primera letra de cada palabra
     return nombre.title()
 
+# Planes conocidos con los que se inicializa el catálogo (tabla planes_seguro).
+# plan_nombre vacío = valores por defecto de la aseguradora
+PLANES_PREDEFINIDOS = [
+    {'aseguradora': 'GNP', 'plan_nombre': 'Línea Azul', 'deducible_estimado': 25000, 'coaseguro_porcentaje': 10,
+     'hospitales_red': 'Hospital Ángeles, Médica Sur, Hospital ABC'},
+    {'aseguradora': 'GNP', 'plan_nombre': 'Línea Azul Premium', 'deducible_estimado': 15000, 'coaseguro_porcentaje': 10,
+     'hospitales_red': 'Hospital Ángeles, Médica Sur, Hospital ABC, Star Médica'},
+    {'aseguradora': 'GNP', 'plan_nombre': '', 'deducible_estimado': 30000, 'coaseguro_porcentaje': 10,
+     'hospitales_red': 'Hospital Ángeles, Médica Sur'},
+    {'aseguradora': 'AXA', 'plan_nombre': '', 'deducible_estimado': 20000, 'coaseguro_porcentaje': 10,
+     'hospitales_red': 'Hospital Ángeles, Médica Sur'},
+    {'aseguradora': 'Seguros Monterrey', 'plan_nombre': 'Plan Alfa', 'deducible_estimado': 25000, 'coaseguro_porcentaje': 10,
+     'hospitales_red': 'Hospital Ángeles, Médica Sur, Hospital Christus Muguerza'},
+    {'aseguradora': 'Seguros Monterrey', 'plan_nombre': '', 'deducible_estimado': 30000, 'coaseguro_porcentaje': 10,
+     'hospitales_red': 'Hospital Ángeles, Médica Sur'},
+    {'aseguradora': 'MetLife', 'plan_nombre': '', 'deducible_estimado': 25000, 'coaseguro_porcentaje': 15,
+     'hospitales_red': 'Hospital Ángeles, Médica Sur'},
+    {'aseguradora': 'Banorte', 'plan_nombre': '', 'deducible_estimado': 30000, 'coaseguro_porcentaje': 10,
+     'hospitales_red': 'Hospital Ángeles, Médica Sur'}
+]
+
+# Valores cuando no se conoce la aseguradora ni el plan
+PLAN_GENERICO = MappingProxyType({
+    'deducible_estimado': 30000,
+    'coaseguro_porcentaje': 10,
+    'hospitales_red': 'Hospital Ángeles, Médica Sur'
+})
+
+CAMPOS_PLAN = ('deducible_estimado', 'coaseguro_porcentaje', 'hospitales_red')
+
+def clave_plan(aseguradora: str, plan_nombre: str) -> Tuple[str, str]:
+    """Llave normalizada (aseguradora, plan) del catálogo de planes"""
+    aseguradora = normalizar_nombre_aseguradora(aseguradora) if aseguradora else ''
+    return normalizar_texto(aseguradora), normalizar_texto(plan_nombre or '')
+
+def construir_catalogo_planes(planes: List[Dict]) -> MappingProxyType:
+    """
+    Construye el índice inmutable del catálogo de planes con llaves normalizadas.
+    Los campos que un plan no tiene se completan con los valores por defecto
+    de su aseguradora y después con PLAN_GENERICO.
+    """
+    planes_por_clave = {}
+    for plan in planes:
+        planes_por_clave[clave_plan(plan.get('aseguradora', ''), plan.get('plan_nombre', ''))] = plan
+    
+    catalogo = {}
+    for (aseguradora, plan_normalizado), plan in planes_por_clave.items():
+        default_aseguradora = planes_por_clave.get((aseguradora, ''), {})
+        info = {}
+        for campo in CAMPOS_PLAN:
+            valor = plan.get(campo)
+            if valor in (None, ''):
+                valor = default_aseguradora.get(campo)
+            if valor in (None, ''):
+                valor = PLAN_GENERICO[campo]
+            info[campo] = valor
+        catalogo[(aseguradora, plan_normalizado)] = MappingProxyType(info)
+    
+    return MappingProxyType(catalogo)
+
+# Índice vigente; se reemplaza completo (nunca se modifica) al recargar
+_catalogo_planes = construir_catalogo_planes(PLANES_PREDEFINIDOS)
+
+def recargar_catalogo_planes(planes: List[Dict]) -> int:
+    """
+    Reemplaza el catálogo en memoria por uno construido con los planes dados
+    (normalmente SeguroDB.obtener_planes()). Retorna el número de planes.
+    """
+    global _catalogo_planes
+    catalogo = construir_catalogo_planes(planes)
+    _catalogo_planes = catalogo
+    return len(catalogo)
+
 def consultar_info_plan(aseguradora: str, plan_nombre: str) -> Dict:
     """
     Consulta información estimada de un plan de seguro (deducible, coaseguro, hospitales)
-    Basado en conocimiento pre-cargado de tabuladores
-    
-    Esta función puede ser mejorada cuando se carguen tabuladores reales
-    """
-    
-    # Datos de ejemplo/predefinidos para las principales aseguradoras
-    # En producción, esto vendría de la base de datos de tabuladores
-    planes_estimados = {
-        'GNP': {
-            'Línea Azul': {
-                'deducible_estimado': 25000,
-                'coaseguro_porcentaje': 10,
-                'hospitales_red': 'Hospital Ángeles, Médica Sur, Hospital ABC'
-            },
-            'Línea Azul Premium': {
-                'deducible_estimado': 15000,
-                'coaseguro_porcentaje': 10,
-                'hospitales_red': 'Hospital Ángeles, Médica Sur, Hospital ABC, Star Médica'
-            },
-            'default': {
-                'deducible_estimado': 30000,
-                'coaseguro_porcentaje': 10,
-                'hospitales_red': 'Hospital Ángeles, Médica Sur'
-            }
-        },
-        'AXA': {
-            'default': {
-                'deducible_estimado': 20000,
-                'coaseguro_porcentaje': 10,
-                'hospitales_red': 'Hospital Ángeles, Médica Sur'
-            }
-        },
-        'Seguros Monterrey': {
-            'Plan Alfa': {
-                'deducible_estimado': 25000,
-                'coaseguro_porcentaje': 10,
-                'hospitales_red': 'Hospital Ángeles, Médica Sur, Hospital Christus Muguerza'
-            },
-            'default': {
-                'deducible_estimado': 30000,
-                'coaseguro_porcentaje': 10,
-                'hospitales_red': 'Hospital Ángeles, Médica Sur'
-            }
-        },
-        'MetLife': {
-            'default': {
-                'deducible_estimado': 25000,
-                'coaseguro_porcentaje': 15,
-                'hospitales_red': 'Hospital Ángeles, Médica Sur'
-            }
-        },
-        'Banorte': {
-            'default': {
-                'deducible_estimado': 30000,
-                'coaseguro_porcentaje': 10,
-                'hospitales_red': 'Hospital Ángeles, Médica Sur'
-            }
-        }
-    }
+    en el catálogo de planes. Si el plan no está, usa los valores por defecto
+    de la aseguradora y, si tampoco está, los genéricos.
+    """
+    catalogo = _catalogo_planes
+    llave_aseguradora, llave_plan = clave_plan(aseguradora, plan_nombre)
     
-    # Buscar información del plan
-    if aseguradora in planes_estimados:
-        planes_aseguradora = planes_estimados[aseguradora]
-        
-        # Buscar plan específico
-        if plan_nombre and plan_nombre in planes_aseguradora:
-            return planes_aseguradora[plan_nombre]
-        
-        # Usar default de la aseguradora
-        if 'default' in planes_aseguradora:
-            return planes_aseguradora['default']
-    
-    # Default genérico
-    return {
-        'deducible_estimado': 30000,
-        'coaseguro_porcentaje': 10,
-        'hospitales_red': 'Hospital Ángeles, Médica Sur'
-    }
-
+    info = catalogo.get((llave_aseguradora, llave_plan)) or catalogo.get((llave_aseguradora, '')) or PLAN_GENERICO
+    return dict(info)
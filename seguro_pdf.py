@@ -5,10 +5,12 @@ Extracción de texto y procesamiento de tabuladores de seguros
 """
 
 import os
+import re
 import hashlib
 from typing import Dict, Optional, List
 import pdfplumber
 from datetime import datetime
+from busqueda_procedimientos import EscanerPalabrasClave
 
 def extraer_texto_pdf(pdf_bytes: bytes) -> Dict:
     """
@@ -82,111 +84,137 @@ def calcular_hash_pdf(pdf_bytes: bytes) -> str:
     """
     return hashlib.sha256(pdf_bytes).hexdigest()
 
-def detectar_aseguradora_del_texto(texto: str) -> Optional[str]:
+# Palabras clave de cada aseguradora (en orden de prioridad)
+DETECTORES_ASEGURADORA = {
+    'GNP': ['gnp', 'grupo nacional provincial'],
+    'AXA': ['axa', 'axa seguros'],
+    'Seguros Monterrey': ['seguros monterrey', 'monterrey', 'seguro monterrey'],
+    'MetLife': ['metlife', 'met life', 'met life méxico'],
+    'Banorte': ['banorte seguros', 'seguros banorte'],
+    'Qualitas': ['qualitas', 'qualitas compaña'],
+    'Plan Seguros': ['plan seguros', 'plan seguros de méxico'],
+    'Mapfre': ['mapfre'],
+    'Zurich': ['zurich']
+}
+
+# Palabras clave por tipo de documento
+KEYWORDS_TIPO_DOCUMENTO = {
+    'tabulador': [
+        'tabulador', 'honorarios', 'honorario médico', 'cpt', 'procedimiento',
+        'código', 'tarifa', 'precio', 'costo', 'monto', '$', 'pesos'
+    ],
+    'condiciones_generales': [
+        'condiciones generales', 'términos y condiciones', 'cobertura',
+        'exclusiones', 'periodo de espera', 'deducible', 'coaseguro',
+        'vigencia', 'póliza', 'poliza', 'cláusula'
+    ]
+}
+
+# Nombres de planes comunes (en orden de prioridad)
+PLANES_COMUNES = [
+    'línea azul', 'línea azul premium', 'plan alfa', 'plan beta',
+    'plan dorado', 'plan plata', 'plan oro', 'plan premium',
+    'plan básico', 'plan estándar', 'plan plus'
+]
+
+# Palabras después de las cuales suele venir el nombre del plan
+KEYWORDS_PLAN = ['plan:', 'plan ', 'producto:', 'línea:']
+
+def _construir_escaner_pdf() -> EscanerPalabrasClave:
+    """Escáner con todas las señales que se detectan en los PDFs de seguros"""
+    senales = []
+    for aseguradora, palabras in DETECTORES_ASEGURADORA.items():
+        senales += [('aseguradora', aseguradora, palabra) for palabra in palabras]
+    for tipo, palabras in KEYWORDS_TIPO_DOCUMENTO.items():
+        senales += [('tipo_documento', tipo, palabra) for palabra in palabras]
+    senales += [('plan', plan, plan) for plan in PLANES_COMUNES]
+    senales += [('marcador_plan', keyword, keyword) for keyword in KEYWORDS_PLAN]
+    return EscanerPalabrasClave(senales)
+
+_escaner_pdf = _construir_escaner_pdf()
+
+def escanear_senales_pdf(texto: str) -> Dict:
+    """
+    Busca en una sola pasada todas las señales del documento (aseguradora,
+    tipo de documento, plan) con sus conteos y posiciones
+    
+    Args:
+        texto: Texto extraído del PDF
+    
+    Returns:
+        Dict {categoria: {valor: {'conteo', 'palabras_distintas', 'posiciones'}}}
+    """
+    return _escaner_pdf.escanear(texto)['senales']
+
+def detectar_aseguradora_del_texto(texto: str, senales: Optional[Dict] = None) -> Optional[str]:
     """
     Intenta detectar la aseguradora del texto del PDF
     
     Args:
         texto: Texto extraído del PDF
+        senales: Resultado de escanear_senales_pdf (si ya se calculó)
     
     Returns:
         Nombre de la aseguradora detectada o None
     """
-    texto_lower = texto.lower()
-    
-    # Mapeo de palabras clave a aseguradoras
-    detectores = {
-        'gnp': ['gnp', 'grupo nacional provincial'],
-        'axa': ['axa', 'axa seguros'],
-        'monterrey': ['seguros monterrey', 'monterrey', 'seguro monterrey'],
-        'metlife': ['metlife', 'met life', 'met life méxico'],
-        'banorte': ['banorte seguros', 'seguros banorte'],
-        'qualitas': ['qualitas', 'qualitas compaña'],
-        'plan': ['plan seguros', 'plan seguros de méxico'],
-        'mapfre': ['mapfre'],
-        'zurich': ['zurich']
-    }
+    if senales is None:
+        senales = escanear_senales_pdf(texto)
     
-    for aseguradora, palabras_clave in detectores.items():
-        for palabra in palabras_clave:
-            if palabra in texto_lower:
-                # Normalizar nombre
-                mapeo_nombres = {
-                    'gnp': 'GNP',
-                    'axa': 'AXA',
-                    'monterrey': 'Seguros Monterrey',
-                    'metlife': 'MetLife',
-                    'banorte': 'Banorte',
-                    'qualitas': 'Qualitas',
-                    'plan': 'Plan Seguros',
-                    'mapfre': 'Mapfre',
-                    'zurich': 'Zurich'
-                }
-                return mapeo_nombres.get(aseguradora, aseguradora.title())
+    encontradas = senales.get('aseguradora', {})
+    for aseguradora in DETECTORES_ASEGURADORA:
+        if aseguradora in encontradas:
+            return aseguradora
     
     return None
 
-def detectar_tipo_documento(texto: str) -> str:
+def detectar_tipo_documento(texto: str, senales: Optional[Dict] = None) -> str:
     """
     Detecta si el documento es un tabulador o condiciones generales
     
     Args:
         texto: Texto extraído del PDF
+        senales: Resultado de escanear_senales_pdf (si ya se calculó)
     
     Returns:
         'tabulador' o 'condiciones_generales'
     """
-    texto_lower = texto.lower()
-    
-    # Palabras clave para tabulador
-    keywords_tabulador = [
-        'tabulador', 'honorarios', 'honorario médico', 'cpt', 'procedimiento',
-        'código', 'tarifa', 'precio', 'costo', 'monto', '$', 'pesos'
-    ]
+    if senales is None:
+        senales = escanear_senales_pdf(texto)
     
-    # Palabras clave para condiciones generales
-    keywords_condiciones = [
-        'condiciones generales', 'términos y condiciones', 'cobertura',
-        'exclusiones', 'periodo de espera', 'deducible', 'coaseguro',
-        'vigencia', 'póliza', 'poliza', 'cláusula'
-    ]
-    
-    count_tabulador = sum(1 for kw in keywords_tabulador if kw in texto_lower)
-    count_condiciones = sum(1 for kw in keywords_condiciones if kw in texto_lower)
+    tipos = senales.get('tipo_documento', {})
+    count_tabulador = tipos.get('tabulador', {}).get('palabras_distintas', 0)
+    count_condiciones = tipos.get('condiciones_generales', {}).get('palabras_distintas', 0)
     
     if count_tabulador > count_condiciones:
         return 'tabulador'
     else:
         return 'condiciones_generales'
 
-def extraer_plan_del_texto(texto: str) -> Optional[str]:
+def extraer_plan_del_texto(texto: str, senales: Optional[Dict] = None) -> Optional[str]:
     """
     Intenta extraer el nombre del plan del texto del PDF
     
     Args:
         texto: Texto extraído del PDF
+        senales: Resultado de escanear_senales_pdf (si ya se calculó)
     
     Returns:
         Nombre del plan o None
     """
-    texto_lower = texto.lower()
+    if senales is None:
+        senales = escanear_senales_pdf(texto)
     
     # Buscar patrones comunes de planes
-    planes_comunes = [
-        'línea azul', 'línea azul premium', 'plan alfa', 'plan beta',
-        'plan dorado', 'plan plata', 'plan oro', 'plan premium',
-        'plan básico', 'plan estándar', 'plan plus'
-    ]
-    
-    for plan in planes_comunes:
-        if plan in texto_lower:
+    planes = senales.get('plan', {})
+    for plan in PLANES_COMUNES:
+        if plan in planes:
             return plan.title()
     
     # Buscar después de palabras clave
-    keywords_plan = ['plan:', 'plan ', 'producto:', 'línea:']
-    for keyword in keywords_plan:
-        idx = texto_lower.find(keyword)
-        if idx != -1:
+    marcadores = senales.get('marcador_plan', {})
+    for keyword in KEYWORDS_PLAN:
+        if keyword in marcadores:
+            idx = marcadores[keyword]['posiciones'][0]
             # Extraer siguiente palabra(s)
             inicio = idx + len(keyword)
             fin = min(inicio + 50, len(texto))
@@ -196,6 +224,38 @@ def extraer_plan_del_texto(texto: str) -> Optional[str]:
     
     return None
 
+def extraer_datos_plan_del_texto(texto: str) -> Dict:
+    """
+    Intenta extraer deducible, coaseguro y hospitales en red del texto
+    (normalmente de unas condiciones generales) para el catálogo de planes
+    
+    Args:
+        texto: Texto extraído del PDF
+    
+    Returns:
+        Dict solo con los campos encontrados:
+        {'deducible_estimado': float, 'coaseguro_porcentaje': float, 'hospitales_red': str}
+    """
+    datos = {}
+    # Buscar sobre el texto en minúsculas sin re.IGNORECASE: así el motor de regex
+    # salta directo a la palabra inicial literal (mucho más rápido en PDFs grandes)
+    texto_lower = texto.lower()
+    
+    match = re.search(r'deducible[^$\d\n]{0,60}\$\s?(\d{1,3}(?:,\d{3})+|\d{4,})(?:\.\d{2})?', texto_lower)
+    if match:
+        datos['deducible_estimado'] = float(match.group(1).replace(',', ''))
+    
+    match = re.search(r'coaseguro[^%\d\n]{0,60}(\d{1,2}(?:\.\d+)?)\s?%', texto_lower)
+    if match:
+        datos['coaseguro_porcentaje'] = float(match.group(1))
+    
+    match = re.search(r'hospitales (?:en convenio|de la red|en red)[:\s]+([^\n]{5,200})', texto_lower)
+    if match:
+        # Conservar mayúsculas del texto original
+        datos['hospitales_red'] = texto[match.start(1):match.end(1)].strip(' .;')
+    
+    return datos
+
 def extraer_fecha_vigencia(texto: str) -> Optional[str]:
     """
     Intenta extraer fecha de vigencia del texto del PDF
@@ -206,20 +266,19 @@ def extraer_fecha_vigencia(texto: str) -> Optional[str]:
     Returns:
         Fecha en formato YYYY-MM-DD o None
     """
-    import re
     from datetime import datetime
     
-    # Buscar patrones de fecha
+    # Buscar patrones de fecha (sobre el texto en minúsculas, sin re.IGNORECASE)
+    texto_lower = texto.lower()
     patrones_fecha = [
         r'vigencia[:\s]+(\d{1,2})[\/\-](\d{1,2})[\/\-](\d{4})',
         r'vigente[:\s]+(\d{1,2})[\/\-](\d{1,2})[\/\-](\d{4})',
         r'válido[:\s]+(\d{1,2})[\/\-](\d{1,2})[\/\-](\d{4})',
-        r'año[:\s]+(\d{4})',
-        r'(\d{4})[:\s]+vigencia'
+        r'año[:\s]+(\d{4})'
     ]
     
     for patron in patrones_fecha:
-        match = re.search(patron, texto, re.IGNORECASE)
+        match = re.search(patron, texto_lower)
         if match:
             grupos = match.groups()
             if len(grupos) == 3:  # DD/MM/YYYY
@@ -236,8 +295,135 @@ def extraer_fecha_vigencia(texto: str) -> Optional[str]:
                 except:
                     pass
     
+    # Año antes de la palabra (ej: "2024 vigencia"): revisar lo que precede a cada
+    # "vigencia" en vez de intentar el patrón en cada dígito del texto
+    for match in re.finditer('vigencia', texto_lower):
+        anterior = re.search(r'(\d{4})[:\s]+$', texto_lower[max(0, match.start() - 40):match.start()])
+        if anterior:
+            return f"{anterior.group(1)}-01-01"  # Asumir inicio de año
+    
     return None
 
+# Palabras clave de los temas de las secciones de condiciones generales
+TEMAS_CONDICIONES = {
+    'exclusiones': [
+        'exclusión', 'exclusiones', 'excluye', 'excluidos', 'excluidas',
+        'no cubre', 'no se cubre', 'no se cubren', 'no ampara', 'gastos no cubiertos'
+    ],
+    'periodo_espera': [
+        'periodo de espera', 'período de espera', 'periodos de espera', 'períodos de espera',
+        'tiempo de espera', 'meses de antigüedad', 'años de antigüedad'
+    ],
+    'preautorizacion': [
+        'autorización previa', 'preautorización', 'pre-autorización',
+        'programación de cirugía', 'programación de servicios', 'carta pase'
+    ],
+    'preexistencias': ['preexistente', 'preexistentes', 'preexistencia'],
+    'coberturas': ['coberturas', 'gastos cubiertos', 'se cubren', 'beneficios cubiertos'],
+    'deducible_coaseguro': ['deducible', 'coaseguro']
+}
+
+# Tamaño máximo de una sección (las más largas se parten en varias)
+MAX_CARACTERES_SECCION = 4000
+
+# Encabezados: "CLÁUSULA 5. EXCLUSIONES", "Artículo 12", "5.2 Periodos de espera", "EXCLUSIONES"
+_PATRON_ENCABEZADO = re.compile(
+    r'^(?:'
+    r'(?P<tipo>cl[aá]usula|art[ií]culo|cap[ií]tulo|secci[oó]n)\s+(?P<num_tipo>[0-9ivxlc]+(?:\.\d+)*)\.?(?:\s*[-–:.]\s*|\s+)?(?P<titulo_tipo>[^\n]{0,100})'
+    r'|(?P<num>\d{1,2}(?:\.\d{1,2}){0,3})\.?\s+(?P<titulo_num>(?-i:[A-ZÁÉÍÓÚÑ])[^\n]{2,100})'
+    r'|(?P<mayusculas>[A-ZÁÉÍÓÚÑÜ][A-ZÁÉÍÓÚÑÜ ,;()/-]{3,80})'
+    r')\s*$',
+    re.MULTILINE | re.IGNORECASE
+)
+
+def _escaner_temas() -> EscanerPalabrasClave:
+    """Escáner de los temas de condiciones generales"""
+    return EscanerPalabrasClave([
+        ('tema', tema, palabra) for tema, palabras in TEMAS_CONDICIONES.items() for palabra in palabras
+    ])
+
+_escaner_temas_condiciones = _escaner_temas()
+
+def _es_encabezado(match) -> bool:
+    """Descarta falsos encabezados (renglones en mayúsculas sin letras suficientes, montos)"""
+    if match.group('mayusculas'):
+        # El patrón es IGNORECASE: exigir que el renglón realmente esté en mayúsculas
+        texto = match.group('mayusculas')
+        return texto.isupper() and sum(c.isalpha() for c in texto) >= 4
+    return True
+
+def detectar_temas_seccion(titulo: str, texto: str) -> List[str]:
+    """
+    Temas de una sección: los que aparecen en el título, o al menos dos veces
+    en el cuerpo
+    """
+    en_titulo = _escaner_temas_condiciones.escanear(titulo)['senales'].get('tema', {})
+    en_texto = _escaner_temas_condiciones.escanear(texto)['senales'].get('tema', {})
+    return [
+        tema for tema in TEMAS_CONDICIONES
+        if tema in en_titulo or en_texto.get(tema, {}).get('conteo', 0) >= 2
+    ]
+
+def segmentar_condiciones(texto: str) -> List[Dict]:
+    """
+    Divide unas condiciones generales en cláusulas/secciones detectando los
+    encabezados, y clasifica cada sección por tema
+    
+    Args:
+        texto: Texto extraído del PDF
+    
+    Returns:
+        Lista en orden del documento:
+        [{'orden': int, 'numero': str, 'titulo': str, 'texto': str, 'temas': [str, ...]}, ...]
+    """
+    if not texto:
+        return []
+    
+    encabezados = [m for m in _PATRON_ENCABEZADO.finditer(texto) if _es_encabezado(m)]
+    
+    # (numero, titulo, inicio, fin) de cada sección; lo anterior al primer encabezado es el preámbulo
+    limites = []
+    inicio_primero = encabezados[0].start() if encabezados else len(texto)
+    if texto[:inicio_primero].strip():
+        limites.append(('', 'Preámbulo', 0, inicio_primero))
+    for i, match in enumerate(encabezados):
+        fin = encabezados[i + 1].start() if i + 1 < len(encabezados) else len(texto)
+        if match.group('tipo'):
+            numero = f"{match.group('tipo').capitalize()} {match.group('num_tipo')}"
+            titulo = match.group('titulo_tipo')
+        elif match.group('num'):
+            numero, titulo = match.group('num'), match.group('titulo_num')
+        else:
+            numero, titulo = '', match.group('mayusculas')
+        limites.append((numero, titulo.strip(' .-:'), match.start(), fin))
+    
+    secciones = []
+    for numero, titulo, inicio, fin in limites:
+        texto_seccion = texto[inicio:fin].strip()
+        
+        # Partir secciones muy largas en renglones completos
+        partes = []
+        while len(texto_seccion) > MAX_CARACTERES_SECCION:
+            corte = texto_seccion.rfind('\n', 0, MAX_CARACTERES_SECCION)
+            if corte <= 0:
+                corte = MAX_CARACTERES_SECCION
+            partes.append(texto_seccion[:corte].strip())
+            texto_seccion = texto_seccion[corte:].strip()
+        partes.append(texto_seccion)
+        
+        for j, parte in enumerate(partes):
+            if not parte:
+                continue
+            secciones.append({
+                'orden': len(secciones),
+                'numero': numero,
+                'titulo': titulo if j == 0 else f"{titulo} (continuación)",
+                'texto': parte,
+                'temas': detectar_temas_seccion(titulo, parte)
+            })
+    
+    return secciones
+
 def procesar_tabulador_pdf(pdf_bytes: bytes, nombre_archivo: str) -> Dict:
     """
     Procesa un PDF de tabulador completo
@@ -255,6 +441,9 @@ def procesar_tabulador_pdf(pdf_bytes: bytes, nombre_archivo: str) -> Dict:
             'aseguradora': str o None,
             'tipo_documento': str,
             'plan': str o None,
+            'datos_plan': dict (deducible, coaseguro, hospitales encontrados),
+            'senales': dict (conteos y posiciones de escanear_senales_pdf),
+            'secciones': list (cláusulas de segmentar_condiciones; solo condiciones generales),
             'fecha_vigencia': str o None,
             'error': str o None
         }
@@ -275,11 +464,14 @@ def procesar_tabulador_pdf(pdf_bytes: bytes, nombre_archivo: str) -> Dict:
     # Calcular hash
     hash_pdf = calcular_hash_pdf(pdf_bytes)
     
-    # Detectar información
-    aseguradora = detectar_aseguradora_del_texto(texto)
-    tipo_documento = detectar_tipo_documento(texto)
-    plan = extraer_plan_del_texto(texto)
+    # Detectar información (una sola pasada de palabras clave sobre el texto)
+    senales = escanear_senales_pdf(texto)
+    aseguradora = detectar_aseguradora_del_texto(texto, senales)
+    tipo_documento = detectar_tipo_documento(texto, senales)
+    plan = extraer_plan_del_texto(texto, senales)
+    datos_plan = extraer_datos_plan_del_texto(texto)
     fecha_vigencia = extraer_fecha_vigencia(texto)
+    secciones = segmentar_condiciones(texto) if tipo_documento == 'condiciones_generales' else []
     
     return {
         'texto': texto,
@@ -288,6 +480,9 @@ def procesar_tabulador_pdf(pdf_bytes: bytes, nombre_archivo: str) -> Dict:
         'aseguradora': aseguradora,
         'tipo_documento': tipo_documento,
         'plan': plan,
+        'datos_plan': datos_plan,
+        'senales': senales,
+        'secciones': secciones,
         'fecha_vigencia': fecha_vigencia,
         'nombre_archivo': nombre_archivo,
         'error': None
@@ -6,8 +6,149 @@ Usa Gemini para buscar información en documentos PDF de tabuladores de seguros
 
 import os
 import json
+import math
 from typing import Dict, Optional, List
 import requests
+from busqueda_procedimientos import normalizar_nombre, normalizar_texto
+
+# Caracteres de condiciones generales que se envían al consultar cobertura
+MAX_CONTEXTO_COBERTURA = 12000
+
+# Versión de cómo se arma el contexto de cobertura; forma parte de la llave de
+# coberturas_cache. Subirla al cambiar la selección de secciones o los límites
+# (1: primeros 5000 caracteres del documento; 2: secciones relevantes)
+VERSION_CONTEXTO_COBERTURA = 2
+
+# Temas de sección que siempre se envían al consultar cobertura
+TEMAS_COBERTURA = ('exclusiones', 'periodo_espera', 'preautorizacion', 'preexistencias')
+
+# Separador entre secciones no contiguas en el contexto
+SEPARADOR_SECCIONES = '\n\n[...]\n\n'
+
+def normalizar_procedimiento(procedimiento: str) -> str:
+    """
+    Normaliza el nombre de un procedimiento para comparar consultas repetidas
+    (minúsculas, sin acentos, sin puntuación y con espacios colapsados)
+    
+    Ej: "Apendicectomía  Laparoscópica." -> "apendicectomia laparoscopica"
+    """
+    return normalizar_nombre(procedimiento)
+
+def monto_numerico(valor) -> Optional[float]:
+    """
+    Monto de una respuesta de la IA como número, o None si no es válido
+    (la IA a veces responde "12,500.00" o "$12500" en vez de un número)
+    """
+    if isinstance(valor, bool):
+        return None
+    if isinstance(valor, str):
+        valor = valor.replace('$', '').replace(',', '').strip()
+    try:
+        monto = float(valor)
+    except (TypeError, ValueError):
+        return None
+    return monto if math.isfinite(monto) else None
+
+def resultado_desde_historial(consulta_previa: Dict, aseguradora: str, plan_nombre: str) -> Dict:
+    """
+    Construye la respuesta de búsqueda de honorario a partir de una consulta
+    previa guardada en consultas_honorarios (mismo formato que buscar_honorario_en_tabulador)
+    """
+    return {
+        'monto': consulta_previa.get('monto_encontrado'),
+        'codigo_cpt': consulta_previa.get('codigo_cpt') or None,
+        'descripcion': consulta_previa.get('descripcion') or consulta_previa.get('procedimiento', ''),
+        'moneda': 'MXN',
+        'confianza': consulta_previa.get('confianza') or 'media',
+        'notas': f"Respuesta reutilizada de una consulta previa ({consulta_previa.get('fecha_consulta', '')})",
+        'fuente': f"{aseguradora} - {plan_nombre}",
+        'desde_historial': True
+    }
+
+def resultado_desde_partida(partida: Dict, aseguradora: str, plan_nombre: str) -> Dict:
+    """
+    Construye la respuesta de búsqueda de honorario a partir de una partida del
+    tabulador con el mismo código CPT o el mismo nombre normalizado (sin llamar a la IA)
+    """
+    return {
+        'monto': partida.get('monto'),
+        'codigo_cpt': partida.get('codigo'),
+        'descripcion': partida.get('descripcion', ''),
+        'moneda': 'MXN',
+        'confianza': 'alta',
+        'notas': f"Coincidencia exacta en tabulador: {partida.get('linea', '')}",
+        'fuente': f"{aseguradora} - {plan_nombre}"
+    }
+
+def contexto_desde_candidatos(candidatos: List[Dict], contenido_tabulador: str) -> str:
+    """
+    Antepone al texto del tabulador los renglones candidatos del índice de
+    trigramas, para que queden dentro del fragmento que se envía a la IA
+    """
+    if not candidatos:
+        return contenido_tabulador
+    
+    lineas = '\n'.join(c['linea'] for c in candidatos)
+    return f"RENGLONES MÁS PARECIDOS AL PROCEDIMIENTO:\n{lineas}\n\n{contenido_tabulador or ''}"
+
+def seleccionar_secciones_cobertura(
+    secciones: List[Dict],
+    procedimiento: str,
+    max_caracteres: int = MAX_CONTEXTO_COBERTURA
+) -> List[Dict]:
+    """
+    Elige las secciones de condiciones generales que se envían a la IA: las que
+    mencionan el procedimiento (ponderando las palabras poco comunes en el
+    documento) y las de exclusiones, periodos de espera, autorización previa y
+    preexistencias, sin pasar de max_caracteres.
+    
+    Args:
+        secciones: Secciones de segmentar_condiciones (con 'orden', 'texto', 'temas')
+        procedimiento: Nombre del procedimiento
+        max_caracteres: Tamaño máximo del contexto
+    
+    Returns:
+        Secciones elegidas en el orden del documento
+    """
+    # Raíces de las palabras del procedimiento (ej: "apendicectomía" -> "apendi")
+    raices = {palabra[:6] for palabra in normalizar_texto(procedimiento).split() if len(palabra) >= 4}
+    
+    puntajes = {}
+    if raices:
+        normalizados = [normalizar_texto(f"{s.get('titulo', '')} {s['texto']}") for s in secciones]
+        frecuencia = {raiz: sum(1 for texto in normalizados if raiz in texto) for raiz in raices}
+        for seccion, texto in zip(secciones, normalizados):
+            puntaje = sum(
+                math.log((len(secciones) + 1) / frecuencia[raiz]) for raiz in raices if raiz in texto
+            )
+            if puntaje > 0:
+                puntajes[seccion['orden']] = puntaje
+    
+    del_procedimiento = sorted(
+        (s for s in secciones if s['orden'] in puntajes),
+        key=lambda s: puntajes[s['orden']],
+        reverse=True
+    )
+    de_temas = [s for s in secciones if any(tema in TEMAS_COBERTURA for tema in s.get('temas', ()))]
+    
+    # Primero las más relevantes al procedimiento (hasta la mitad), luego los temas fijos
+    elegidas = {}
+    restante = max_caracteres
+    for grupo, limite in ((del_procedimiento, max_caracteres // 2), (de_temas, 0), (del_procedimiento, 0)):
+        for seccion in grupo:
+            costo = len(seccion['texto']) + len(SEPARADOR_SECCIONES)
+            if seccion['orden'] in elegidas or costo > restante:
+                continue
+            if limite and max_caracteres - restante + costo > limite:
+                break
+            elegidas[seccion['orden']] = seccion
+            restante -= costo
+    
+    return sorted(elegidas.values(), key=lambda s: s['orden'])
+
+def contexto_desde_secciones(secciones: List[Dict]) -> str:
+    """Texto de las secciones elegidas, separadas y en orden"""
+    return SEPARADOR_SECCIONES.join(seccion['texto'] for seccion in secciones)
 
 def buscar_honorario_en_tabulador(
     aseguradora: str,
@@ -144,12 +285,150 @@ IMPORTANTE:
             'monto': None
         }
 
+def buscar_honorarios_en_tabulador_lote(
+    aseguradora: str,
+    plan_nombre: str,
+    procedimientos: List[Dict],
+    contenido_tabulador: str = None,
+    api_key: str = None
+) -> List[Dict]:
+    """
+    Busca los honorarios de varios procedimientos en una sola llamada a Gemini
+    
+    Args:
+        aseguradora: Nombre de la aseguradora
+        plan_nombre: Nombre del plan
+        procedimientos: Lista de dicts con 'procedimiento' y 'codigo_cpt' (opcional)
+        contenido_tabulador: Texto del tabulador (idealmente con los renglones candidatos al inicio)
+        api_key: Clave API de Gemini
+    
+    Returns:
+        Lista de resultados en el mismo orden que `procedimientos`,
+        cada uno con el formato de buscar_honorario_en_tabulador
+    """
+    
+    if not api_key:
+        return [{'error': 'API key no proporcionada', 'monto': None} for _ in procedimientos]
+    
+    if not contenido_tabulador:
+        contenido_tabulador = f"Tabulador de {aseguradora} para plan {plan_nombre}"
+    
+    lista_procedimientos = '\n'.join(
+        f"{i}. {p.get('procedimiento', '')}" + (f" (CPT {p['codigo_cpt']})" if p.get('codigo_cpt') else '')
+        for i, p in enumerate(procedimientos)
+    )
+    
+    prompt = f"""Eres un experto en seguros médicos mexicanos. Busca en el siguiente tabulador de honorarios médicos la información de CADA procedimiento solicitado.
+
+ASEGURADORA: {aseguradora}
+PLAN: {plan_nombre}
+PROCEDIMIENTOS SOLICITADOS (índice. nombre):
+{lista_procedimientos}
+
+CONTENIDO DEL TABULADOR:
+{contenido_tabulador[:8000]}
+
+INSTRUCCIONES:
+1. Busca cada procedimiento en el tabulador (usa el código CPT si se proporciona)
+2. Extrae el MONTO que paga la aseguradora por cada procedimiento
+3. Si no encuentras el procedimiento exacto, busca uno similar
+4. Responde SOLO en formato JSON válido, con un elemento por procedimiento
+
+Responde en formato JSON:
+{{
+  "resultados": [
+    {{
+      "indice": numero_del_procedimiento,
+      "monto": numero_o_null,
+      "codigo_cpt": "codigo o null",
+      "descripcion": "descripcion del procedimiento encontrado",
+      "moneda": "MXN",
+      "confianza": "alta/media/baja",
+      "notas": "notas adicionales si aplica"
+    }}
+  ]
+}}
+
+IMPORTANTE: 
+- Si NO encuentras un procedimiento, responde con monto: null y confianza: "baja"
+- El monto debe ser un número (sin símbolos de peso)
+"""
+    
+    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={api_key}"
+    
+    headers = {
+        'Content-Type': 'application/json',
+    }
+    
+    data = {
+        "contents": [{
+            "parts": [{
+                "text": prompt
+            }]
+        }],
+        "generationConfig": {
+            "response_mime_type": "application/json"
+        }
+    }
+    
+    try:
+        response = requests.post(url, headers=headers, json=data, timeout=60)
+        
+        if response.status_code == 200:
+            result = response.json()
+            if 'candidates' in result and len(result['candidates']) > 0:
+                texto_respuesta = result['candidates'][0]['content']['parts'][0]['text']
+                
+                # Limpiar respuesta
+                texto_respuesta = texto_respuesta.strip()
+                if texto_respuesta.startswith('```json'):
+                    texto_respuesta = texto_respuesta[7:]
+                if texto_respuesta.endswith('```'):
+                    texto_respuesta = texto_respuesta[:-3]
+                texto_respuesta = texto_respuesta.strip()
+                
+                datos = json.loads(texto_respuesta)
+                # La IA puede responder el índice como texto ("3")
+                por_indice = {}
+                for r in datos.get('resultados', []):
+                    if isinstance(r, dict):
+                        try:
+                            por_indice[int(r.get('indice'))] = r
+                        except (TypeError, ValueError):
+                            continue
+                
+                resultados = []
+                for i, p in enumerate(procedimientos):
+                    r = por_indice.get(i, {})
+                    resultados.append({
+                        'monto': monto_numerico(r.get('monto')),
+                        'codigo_cpt': r.get('codigo_cpt') or p.get('codigo_cpt'),
+                        'descripcion': r.get('descripcion', p.get('procedimiento', '')),
+                        'moneda': r.get('moneda', 'MXN'),
+                        'confianza': r.get('confianza', 'baja' if not r else 'media'),
+                        'notas': r.get('notas', '' if r else 'Sin respuesta para este procedimiento'),
+                        'fuente': f"{aseguradora} - {plan_nombre}"
+                    })
+                return resultados
+        else:
+            print(f"Error en búsqueda RAG por lote: {response.status_code} - {response.text}")
+            return [{'error': f"Error en API: {response.status_code}", 'monto': None} for _ in procedimientos]
+    
+    except Exception as e:
+        print(f"Error en búsqueda RAG por lote: {e}")
+        import traceback
+        traceback.print_exc()
+        return [{'error': str(e), 'monto': None} for _ in procedimientos]
+    
+    return [{'error': 'Respuesta vacía de la API', 'monto': None} for _ in procedimientos]
+
 def consultar_cobertura_procedimiento(
     aseguradora: str,
     plan_nombre: str,
     procedimiento: str,
     contenido_condiciones: str = None,
-    api_key: str = None
+    api_key: str = None,
+    secciones: List[Dict] = None
 ) -> Dict:
     """
     Consulta si un procedimiento está cubierto por el seguro usando las condiciones generales
@@ -160,6 +439,8 @@ def consultar_cobertura_procedimiento(
         procedimiento: Nombre del procedimiento
         contenido_condiciones: Texto de condiciones generales (opcional)
         api_key: Clave API de Gemini
+        secciones: Secciones de las condiciones (segmentar_condiciones). Si se dan,
+            solo se envían las relevantes en vez del inicio del documento
     
     Returns:
         Dict con:
@@ -178,6 +459,14 @@ def consultar_cobertura_procedimiento(
             'cubierto': None
         }
     
+    if secciones:
+        elegidas = seleccionar_secciones_cobertura(secciones, procedimiento)
+        if elegidas:
+            contenido_condiciones = contexto_desde_secciones(elegidas)
+    
+    if not contenido_condiciones:
+        contenido_condiciones = '\n\n'.join(s['texto'] for s in secciones or [])
+    
     if not contenido_condiciones:
         contenido_condiciones = f"Condiciones generales de {aseguradora} para plan {plan_nombre}"
     
@@ -187,8 +476,8 @@ ASEGURADORA: {aseguradora}
 PLAN: {plan_nombre}
 PROCEDIMIENTO: {procedimiento}
 
-CONDICIONES GENERALES:
-{contenido_condiciones[:5000]}
+CONDICIONES GENERALES{' (cláusulas relevantes)' if secciones else ''}:
+{contenido_condiciones[:MAX_CONTEXTO_COBERTURA if secciones else 5000]}
 
 INSTRUCCIONES:
 1. Determina si el procedimiento "{procedimiento}" está cubierto por este seguro